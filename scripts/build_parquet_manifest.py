@@ -0,0 +1,300 @@
+"""
+Build a footer-only Parquet manifest for each data-asset-cache version.
+
+Every Parquet object under data-asset-cache/<version>/ (unpartitioned tables
+such as platform_swdb_sessions.pqt and hive partitions such as
+platform_pophys/asset_name=<asset>/data.pqt) is described from its footer
+alone: a suffix range read fetches the last FOOTER_GUESS bytes, and a second
+read covers the rest of the footer when it is longer. Footers are read
+concurrently, so a version with thousands of partitions costs a few MB of
+transfer instead of a full download.
+
+Output: data-asset-cache/parquet_manifest_<version>.json, next to
+cache_versions.json (or in --out DIR):
+  {
+    "version": "<version>",
+    "tables": {
+      "<table>": {
+        "schema": [[name, arrow_type], ...],
+        "rows": total_rows,
+        "files": {
+          "<key relative to the version>": {
+            "bytes": object_size,
+            "rows": n,
+            "row_groups": [{"rows": n, "bytes": b, "stats": {column: [min, max, nulls]}}, ...],
+            "schema": [...]          # only when it differs from the table's
+          }, ...
+        }
+      }, ...
+    },
+    "errors": {"<key>": "message", ...}   # only when some footers were unreadable
+  }
+The table is the first path component below the version (minus the .pqt
+suffix); string bounds longer than STATS_MAX_CHARS are left out. Clients
+can prune partitions and row groups on the min/max stats before issuing a
+single data request.
+
+Sources: the public bucket over its REST API (no credentials needed to
+read; writing the manifest back uses boto3), or --local DIR, a directory laid
+out like the bucket (DIR/data-asset-cache/cache_versions.json, ...).
+
+Usage:
+  python scripts/build_parquet_manifest.py [--version V ...] [--force]
+      [--bucket NAME | --endpoint URL | --local DIR] [--workers N] [--out DIR]
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import math
+import pathlib
+import struct
+import sys
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+S3_BUCKET = "allen-data-views"
+S3_ENDPOINT = "https://{bucket}.s3.amazonaws.com/"
+CACHE_PREFIX = "data-asset-cache/"
+VERSIONS_KEY = CACHE_PREFIX + "cache_versions.json"
+MANIFEST_KEY = CACHE_PREFIX + "parquet_manifest_{version}.json"
+MANIFEST_CACHE_CONTROL = "public, max-age=86400"
+PARQUET_SUFFIXES = (".pqt", ".parquet")
+FOOTER_GUESS = 64 * 1024   # bytes; most cache footers fit in one read
+MAGIC = b"PAR1"
+STATS_MAX_CHARS = 64       # longer string bounds (contours, JSON blobs) are useless for pruning
+
+_S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+class S3Source:
+    """Reads a public bucket over the S3 REST API (ListObjectsV2 and ranged GETs)."""
+
+    def __init__(self, bucket: str, endpoint: str = S3_ENDPOINT, timeout: float = 30):
+        self.bucket = bucket
+        self.base = endpoint.format(bucket=bucket)
+        self.timeout = timeout
+
+    def _get(self, url: str, headers=None) -> bytes:
+        req = urllib.request.Request(url, headers=headers or {})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return resp.read()
+
+    def list(self, prefix: str) -> list[tuple[str, int]]:
+        """Return ``(key, size)`` for every object under *prefix*, in key order."""
+        objects = []
+        token = None
+        while True:
+            qs = {"list-type": "2", "prefix": prefix, "max-keys": "1000"}
+            if token:
+                qs["continuation-token"] = token
+            root = ET.fromstring(self._get(self.base + "?" + urllib.parse.urlencode(qs)))
+            for item in root.iter(f"{_S3_NS}Contents"):
+                objects.append((item.findtext(f"{_S3_NS}Key"), int(item.findtext(f"{_S3_NS}Size") or 0)))
+            token = root.findtext(f"{_S3_NS}NextContinuationToken")
+            if root.findtext(f"{_S3_NS}IsTruncated") != "true" or not token:
+                return objects
+
+    def read(self, key: str) -> bytes:
+        return self._get(self.base + urllib.parse.quote(key))
+
+    def read_tail(self, key: str, length: int) -> bytes:
+        """Return the last *length* bytes of *key* (a suffix range read).
+
+        A server that ignores Range sends the whole object; the caller only
+        looks at the tail, so that is slower but still correct.
+        """
+        return self._get(self.base + urllib.parse.quote(key), {"Range": f"bytes=-{length}"})
+
+    def exists(self, key: str) -> bool:
+        return any(found == key for found, _ in self.list(key))
+
+    def write(self, key: str, body: bytes):
+        import boto3
+
+        boto3.client("s3").put_object(
+            Bucket=self.bucket, Key=key, Body=body,
+            ContentType="application/json", CacheControl=MANIFEST_CACHE_CONTROL,
+        )
+
+
+class LocalSource:
+    """A directory laid out like the bucket, for testing and offline builds."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = pathlib.Path(root)
+
+    def list(self, prefix: str) -> list[tuple[str, int]]:
+        base = self.root / prefix.rsplit("/", 1)[0] if "/" in prefix else self.root
+        if not base.is_dir():
+            return []
+        objects = []
+        for path in base.rglob("*"):
+            key = path.relative_to(self.root).as_posix()
+            if path.is_file() and key.startswith(prefix):
+                objects.append((key, path.stat().st_size))
+        return sorted(objects)
+
+    def read(self, key: str) -> bytes:
+        return (self.root / key).read_bytes()
+
+    def read_tail(self, key: str, length: int) -> bytes:
+        with open(self.root / key, "rb") as f:
+            size = f.seek(0, 2)
+            f.seek(max(size - length, 0))
+            return f.read()
+
+    def exists(self, key: str) -> bool:
+        return (self.root / key).is_file()
+
+    def write(self, key: str, body: bytes):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(body)
+
+
+def read_footer(source, key: str, size: int, guess: int = FOOTER_GUESS) -> pq.FileMetaData:
+    """Parse the Parquet footer of *key* with one or two suffix range reads."""
+    if size < len(MAGIC) * 2 + 4:
+        raise ValueError("too small to be a Parquet file")
+    tail = source.read_tail(key, min(guess, size))
+    if len(tail) < 8 or tail[-4:] != MAGIC:
+        raise ValueError("missing Parquet footer magic")
+    footer_len = struct.unpack("<I", tail[-8:-4])[0]
+    if footer_len + 8 > size:
+        raise ValueError(f"footer length {footer_len} exceeds object size {size}")
+    if footer_len + 8 > len(tail):
+        tail = source.read_tail(key, footer_len + 8)
+    return pq.read_metadata(pa.BufferReader(tail[-(footer_len + 8):]))
+
+
+def _json_value(value):
+    """Make a statistics min/max JSON-serialisable (None when it cannot be ordered)."""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        try:
+            return value.decode()
+        except UnicodeDecodeError:
+            return None
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _row_group_stats(row_group) -> dict:
+    stats = {}
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        s = column.statistics
+        if s is None or not s.has_min_max:
+            continue
+        low, high = _json_value(s.min), _json_value(s.max)
+        if any(isinstance(v, str) and len(v) > STATS_MAX_CHARS for v in (low, high)):
+            continue
+        stats[column.path_in_schema] = [low, high, s.null_count]
+    return stats
+
+
+def schema_of(meta: pq.FileMetaData) -> list[list[str]]:
+    return [[field.name, str(field.type)] for field in meta.schema.to_arrow_schema()]
+
+
+def describe(meta: pq.FileMetaData, size: int) -> dict:
+    """Summarise one file's footer: row counts, row-group sizes and column stats."""
+    return {
+        "bytes": size,
+        "rows": meta.num_rows,
+        "row_groups": [
+            {"rows": rg.num_rows, "bytes": rg.total_byte_size, "stats": _row_group_stats(rg)}
+            for rg in (meta.row_group(i) for i in range(meta.num_row_groups))
+        ],
+    }
+
+
+def _scan(source, key: str, size: int):
+    try:
+        return read_footer(source, key, size), None
+    except (OSError, ValueError, pa.ArrowException) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def table_name(relative_key: str) -> str:
+    """``platform_pophys/asset_name=x/data.pqt`` → ``platform_pophys``; ``sessions.pqt`` → ``sessions``."""
+    first = relative_key.split("/", 1)[0]
+    for suffix in PARQUET_SUFFIXES:
+        first = first.removesuffix(suffix)
+    return first
+
+
+def build_manifest(source, version: str, workers: int = 32) -> dict:
+    """Read every Parquet footer under *version* concurrently and assemble its manifest."""
+    prefix = f"{CACHE_PREFIX}{version}/"
+    objects = [(key, size) for key, size in source.list(prefix) if key.endswith(PARQUET_SUFFIXES)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        footers = list(pool.map(lambda obj: _scan(source, *obj), objects))
+
+    tables: dict[str, dict] = {}
+    errors = {}
+    for (key, size), (meta, error) in zip(objects, footers):
+        relative = key[len(prefix):]
+        if error:
+            errors[relative] = error
+            continue
+        schema = schema_of(meta)
+        table = tables.setdefault(table_name(relative), {"schema": schema, "rows": 0, "files": {}})
+        entry = describe(meta, size)
+        if schema != table["schema"]:
+            entry["schema"] = schema
+        table["rows"] += meta.num_rows
+        table["files"][relative] = entry
+
+    manifest = {"version": version, "tables": tables}
+    if errors:
+        manifest["errors"] = errors
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build footer-only Parquet manifests for data-asset-cache versions.")
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--local", type=pathlib.Path, help="directory laid out like the bucket")
+    where.add_argument("--endpoint", default=S3_ENDPOINT, help=f"S3 URL template (default {S3_ENDPOINT})")
+    parser.add_argument("--bucket", default=S3_BUCKET)
+    parser.add_argument("--version", action="append", help="cache version (default: all in cache_versions.json)")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent footer reads")
+    parser.add_argument("--out", type=pathlib.Path, help="write manifests here instead of next to cache_versions.json")
+    parser.add_argument("--force", action="store_true", help="rebuild manifests that already exist")
+    args = parser.parse_args()
+
+    source = LocalSource(args.local) if args.local else S3Source(args.bucket, args.endpoint)
+    versions = args.version or json.loads(source.read(VERSIONS_KEY))
+
+    for version in versions:
+        key = MANIFEST_KEY.format(version=version)
+        if not args.force and not args.out and source.exists(key):
+            print(f"{version}: manifest exists, skipping (--force to rebuild)")
+            continue
+        manifest = build_manifest(source, version, args.workers)
+        body = json.dumps(manifest, separators=(",", ":")).encode() + b"\n"
+        files = sum(len(t["files"]) for t in manifest["tables"].values())
+        print(f"{version}: {len(manifest['tables'])} tables, {files} files, {len(body) / 1024:.1f} KB manifest")
+        for relative, error in manifest.get("errors", {}).items():
+            print(f"  unreadable footer {relative}: {error}", file=sys.stderr)
+        if args.out:
+            args.out.mkdir(parents=True, exist_ok=True)
+            (args.out / key.rsplit("/", 1)[-1]).write_bytes(body)
+        else:
+            source.write(key, body)
+
+
+if __name__ == "__main__":
+    main()
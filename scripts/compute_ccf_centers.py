@@ -1,46 +1,54 @@
 """
-Compute the CCF centroid of each brain structure on the LEFT hemisphere
-using the BrainGlobe Allen Mouse 100µm v1.2 annotation volume.
+Compute the CCF centroid of each brain structure from a BrainGlobe Allen
+Mouse annotation volume (100µm by default; 50, 25 and 10µm also work).
 
-Volume shape: (132, 80, 114) — orientation "asr"
-  axis 0: anterior→posterior  (AP), resolution 100µm
-  axis 1: superior→inferior   (DV), resolution 100µm
-  axis 2: right→left          (LR), resolution 100µm, index 0 = right side
+Volume orientation "asr" (shape and resolution come from the atlas's
+metadata.json, e.g. (132, 80, 114) at 100µm):
+  axis 0: anterior→posterior  (AP)
+  axis 1: superior→inferior   (DV)
+  axis 2: right→left          (LR), index 0 = right side
 
-Left hemisphere: axis-2 indices >= 57  (midline at 5700µm = index 57)
+The midline sits at 5700µm on axis 2; the left hemisphere is everything at
+or beyond it.
 
-The annotation TIFF only contains leaf-level structure IDs.  For every parent
+The annotation mostly contains leaf-level structure IDs. For every parent
 structure we accumulate the voxels of ALL its annotated descendants before
 computing the centroid, so every entry in structures.json gets a valid center.
 
-Output: web/src/subject/allen_mouse_100um_v1.2/ccf_structure_centers.json
+The volume is memory-mapped and reduced one AP plane at a time: voxel ids
+are remapped to dense structure indices and per-structure voxel counts and
+coordinate sums come from np.bincount. A single bottom-up pass over the
+structure_id_path tree then rolls the sums up to every ancestor. Memory use
+is bounded by a few planes, so the 10µm volume (~5 GB) fits comfortably.
+
+Output (default): web/src/subject/<atlas>/ccf_structure_centers.json for the
+left hemisphere, ccf_structure_centers_<hemisphere>.json otherwise:
   { "<structure_id>": [x, y, z], ... }
+  or, with --hemisphere both, { "left": {...}, "right": {...} }
   where x/y/z are three.js coordinates in mm (origin = Bregma):
     x = (ccf_ML - 5700) / 1000
     y = (332 - ccf_DV) / 1000
     z = (5400 - ccf_AP) / 1000
+
+Usage:
+  python scripts/compute_ccf_centers.py [--resolution 25 | --atlas NAME]
+      [--hemisphere left|right|both] [--atlas-dir DIR] [--out FILE]
 """
 
+import argparse
 import json
 import pathlib
+
 import numpy as np
 import tifffile
 
-ATLAS_DIR = pathlib.Path.home() / ".brainglobe" / "allen_mouse_100um_v1.2"
-STRUCTURES_PATH = (
-    pathlib.Path(__file__).parent.parent
-    / "web/src/subject/allen_mouse_100um_v1.2/structures.json"
-)
-OUT_PATH = (
-    pathlib.Path(__file__).parent.parent
-    / "web/src/subject/allen_mouse_100um_v1.2/ccf_structure_centers.json"
-)
-
-RES = 100.0          # µm per voxel
+REPO_DIR = pathlib.Path(__file__).parent.parent
+BRAINGLOBE_DIR = pathlib.Path.home() / ".brainglobe"
+DEFAULT_ATLAS = "allen_mouse_100um_v1.2"
+
 BREGMA_AP = 5400.0   # µm
 BREGMA_DV = 332.0    # µm
 BREGMA_ML = 5700.0   # µm
-MIDLINE_IDX = 57     # axis-2 index of midline (5700µm / 100µm)
 
 
 def ccf_to_threejs(ap_um, dv_um, ml_um):
@@ -50,79 +58,127 @@ def ccf_to_threejs(ap_um, dv_um, ml_um):
     return x, y, z
 
 
-def main():
-    # ── 1. Load annotation (left hemisphere only) ───────────────────────────
-    print("Loading annotation TIFF…")
-    ann = tifffile.imread(str(ATLAS_DIR / "annotation.tiff"))
-    print(f"  shape={ann.shape}, dtype={ann.dtype}")
-    left = ann[:, :, MIDLINE_IDX:]   # shape (132, 80, 57)
-
-    # For each voxel record its AP/DV/LR index.
-    ap_idx, dv_idx, lr_sub_idx = np.nonzero(left)         # skip background (0)
-    sid_flat = left[ap_idx, dv_idx, lr_sub_idx].astype(np.int64)
-    lr_idx = lr_sub_idx + MIDLINE_IDX                      # full-volume LR index
-
-    # Per-leaf-structure accumulators: sum_ap, sum_dv, sum_ml, count
-    leaf_stats: dict[int, list] = {}
-    for ap, dv, lr, sid in zip(ap_idx, dv_idx, lr_idx, sid_flat):
-        sid = int(sid)
-        if sid not in leaf_stats:
-            leaf_stats[sid] = [0.0, 0.0, 0.0, 0]
-        s = leaf_stats[sid]
-        s[0] += int(ap)
-        s[1] += int(dv)
-        s[2] += int(lr)
-        s[3] += 1
-    print(f"  {len(leaf_stats)} leaf structures annotated in left hemisphere")
-
-    # ── 2. Build ancestor map from structures.json ──────────────────────────
-    with open(STRUCTURES_PATH) as f:
-        structs = json.load(f)
-
-    # Map each structure id → its full id-path (list of ancestor ids, root→self)
-    id_to_path: dict[int, list[int]] = {
-        s["id"]: s["structure_id_path"] for s in structs
-    }
-    all_structure_ids = list(id_to_path.keys())
-
-    # For each structure, accumulate stats from every leaf descendant whose
-    # id-path contains this structure's id.
-    # Build reverse map: ancestor_id → [leaf_ids that descend from it]
-    ancestor_to_leaves: dict[int, list[int]] = {sid: [] for sid in all_structure_ids}
-    for leaf_id in leaf_stats:
-        path = id_to_path.get(leaf_id, [leaf_id])
-        for ancestor_id in path:
-            if ancestor_id in ancestor_to_leaves:
-                ancestor_to_leaves[ancestor_id].append(leaf_id)
-
-    # ── 3. Compute centroid for every structure ──────────────────────────────
+def open_annotation(path: pathlib.Path) -> np.ndarray:
+    """Memory-map the annotation TIFF, decoding into a temporary memmap if it is compressed."""
+    try:
+        return tifffile.memmap(str(path), mode="r")
+    except ValueError:
+        return tifffile.imread(str(path), out="memmap")
+
+
+def load_structures(atlas_dir: pathlib.Path, atlas: str) -> list[dict]:
+    """Load *atlas*'s structures.json from its atlas directory or the repo copy."""
+    candidates = (atlas_dir / "structures.json", REPO_DIR / "web/src/subject" / atlas / "structures.json")
+    for path in candidates:
+        if path.exists():
+            with open(path) as f:
+                return json.load(f)
+    raise FileNotFoundError(f"No structures.json for {atlas} (looked in {', '.join(map(str, candidates))})")
+
+
+def accumulate(ann: np.ndarray, ids: np.ndarray, lr_slice: slice) -> np.ndarray:
+    """Return per-structure ``[count, sum_ap, sum_dv, sum_lr]`` (voxel indices) for *lr_slice*.
+
+    Rows follow *ids* (sorted); voxels whose id is not a known structure
+    (including background 0) are dropped.
+    """
+    n = len(ids)
+    stats = np.zeros((4, n + 1))
+    _, depth, width = ann.shape
+    lr_start = lr_slice.start or 0
+    dv_grid, lr_grid = np.meshgrid(
+        np.arange(depth, dtype=np.float64),
+        np.arange(lr_start, lr_slice.stop if lr_slice.stop is not None else width, dtype=np.float64),
+        indexing="ij",
+    )
+    dv_grid, lr_grid = dv_grid.ravel(), lr_grid.ravel()
+    for ap in range(ann.shape[0]):
+        labels = np.asarray(ann[ap, :, lr_slice]).ravel()
+        dense = np.searchsorted(ids, labels)
+        dense[dense == n] = n - 1
+        dense[ids[dense] != labels] = n          # background and unknown ids
+        counts = np.bincount(dense, minlength=n + 1)
+        stats[0] += counts
+        stats[1] += counts * ap
+        stats[2] += np.bincount(dense, weights=dv_grid, minlength=n + 1)
+        stats[3] += np.bincount(dense, weights=lr_grid, minlength=n + 1)
+    return stats[:, :n]
+
+
+def roll_up(stats: np.ndarray, ids: np.ndarray, structures: list[dict]) -> np.ndarray:
+    """Add every structure's sums into its parent's, deepest structures first."""
+    index = {int(sid): i for i, sid in enumerate(ids)}
+    depth = np.zeros(len(ids), dtype=np.int64)
+    parent = np.full(len(ids), -1, dtype=np.int64)
+    for s in structures:
+        path = s["structure_id_path"]
+        i = index[s["id"]]
+        depth[i] = len(path)
+        if len(path) > 1 and path[-2] in index:
+            parent[i] = index[path[-2]]
+    totals = stats.copy()
+    for d in range(depth.max(), 1, -1):
+        level = np.nonzero((depth == d) & (parent >= 0))[0]
+        np.add.at(totals, (slice(None), parent[level]), totals[:, level])
+    return totals
+
+
+def centers_from(totals: np.ndarray, ids: np.ndarray, resolution) -> dict:
+    res_ap, res_dv, res_lr = resolution
     centers = {}
-    for struct_id in all_structure_ids:
-        leaves = ancestor_to_leaves.get(struct_id, [])
-        if not leaves:
-            continue
-        sum_ap = sum_dv = sum_ml = 0.0
-        count = 0
-        for leaf_id in leaves:
-            s = leaf_stats[leaf_id]
-            sum_ap += s[0]; sum_dv += s[1]; sum_ml += s[2]; count += s[3]
-        if count == 0:
-            continue
-        ap_um = sum_ap / count * RES + RES / 2
-        dv_um = sum_dv / count * RES + RES / 2
-        ml_um = sum_ml / count * RES + RES / 2
+    for i in np.nonzero(totals[0])[0]:
+        count = totals[0, i]
+        ap_um = totals[1, i] / count * res_ap + res_ap / 2
+        dv_um = totals[2, i] / count * res_dv + res_dv / 2
+        ml_um = totals[3, i] / count * res_lr + res_lr / 2
         x, y, z = ccf_to_threejs(ap_um, dv_um, ml_um)
-        centers[str(struct_id)] = [round(x, 3), round(y, 3), round(z, 3)]
+        centers[str(int(ids[i]))] = [round(x, 3), round(y, 3), round(z, 3)]
+    return centers
 
-    print(f"  computed centers for {len(centers)} / {len(all_structure_ids)} structures")
 
-    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(OUT_PATH, "w") as f:
-        json.dump(centers, f, separators=(",", ":"))
+def main():
+    parser = argparse.ArgumentParser(description="Compute CCF structure centroids for the 3D brain views.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--atlas", default=None, help=f"BrainGlobe atlas name (default {DEFAULT_ATLAS})")
+    group.add_argument("--resolution", type=int, help="shorthand for allen_mouse_<N>um_v1.2")
+    parser.add_argument("--hemisphere", choices=("left", "right", "both"), default="left")
+    parser.add_argument("--atlas-dir", type=pathlib.Path, help="defaults to ~/.brainglobe/<atlas>")
+    parser.add_argument("--out", type=pathlib.Path)
+    args = parser.parse_args()
+
+    atlas = args.atlas or (f"allen_mouse_{args.resolution}um_v1.2" if args.resolution else DEFAULT_ATLAS)
+    atlas_dir = args.atlas_dir or BRAINGLOBE_DIR / atlas
+    suffix = "" if args.hemisphere == "left" else f"_{args.hemisphere}"
+    out_path = args.out or REPO_DIR / "web/src/subject" / atlas / f"ccf_structure_centers{suffix}.json"
+
+    # ── 1. Open annotation (memory-mapped) ──────────────────────────────────
+    with open(atlas_dir / "metadata.json") as f:
+        resolution = json.load(f)["resolution"]
+    print(f"Opening {atlas} annotation…")
+    ann = open_annotation(atlas_dir / "annotation.tiff")
+    midline = int(round(BREGMA_ML / resolution[2]))
+    print(f"  shape={ann.shape}, dtype={ann.dtype}, resolution={resolution}µm, midline index {midline}")
+
+    structures = load_structures(atlas_dir, atlas)
+    ids = np.array(sorted(s["id"] for s in structures), dtype=np.int64)
+
+    # ── 2. Per-structure sums, rolled up the hierarchy ──────────────────────
+    hemispheres = {"left": slice(midline, None), "right": slice(0, midline)}
+    result = {}
+    for name in (("left", "right") if args.hemisphere == "both" else (args.hemisphere,)):
+        stats = accumulate(ann, ids, hemispheres[name])
+        print(f"  {int(np.count_nonzero(stats[0]))} structures annotated in {name} hemisphere")
+        result[name] = centers_from(roll_up(stats, ids, structures), ids, resolution)
+        print(f"  computed {name} centers for {len(result[name])} / {len(ids)} structures")
+
+    # ── 3. Save ─────────────────────────────────────────────────────────────
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(result if args.hemisphere == "both" else result[args.hemisphere], f, separators=(",", ":"))
         f.write("\n")
 
-    size_kb = OUT_PATH.stat().st_size / 1024
-    print(f"Saved to {OUT_PATH}  ({size_kb:.1f} KB)")
+    size_kb = out_path.stat().st_size / 1024
+    print(f"Saved to {out_path}  ({size_kb:.1f} KB)")
 
 
 if __name__ == "__main__":
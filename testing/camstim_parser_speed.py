@@ -0,0 +1,153 @@
+"""
+Measures camstim message parsing throughput on a synthetic corpus.
+
+Compares the original per-row parser (kept below as ``legacy_parse`` for
+reference) against web/camstim_parser.py, first checking that both produce
+identical output for every message.
+
+Run: python testing/camstim_parser_speed.py [--rows N] [--repeat R] [--json]
+"""
+
+import argparse
+import html
+import json
+import random
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from web import camstim_parser  # noqa: E402
+
+_LEGACY_KNOWN_KEYS = (
+    "MID", "UID", "Action", "Resource_ID", "Descriptive_name", "Mode",
+    "Checksum", "Json_checksum", "Duration_min", "Return_code",
+    "Long_frames", "Extra-long_frames", "Wheel_rotations",
+)
+
+
+def legacy_parse(msg: str) -> dict:
+    """The parser docdb_proxy.py used before camstim_parser.py, verbatim."""
+    if not msg:
+        return {}
+    msg = html.unescape(msg)
+    key_alt = "|".join(re.escape(k) for k in _LEGACY_KNOWN_KEYS)
+    pattern = re.compile(rf",\s*(?={key_alt})\s*")
+    parts = pattern.split(", " + msg)
+    out: dict[str, str] = {}
+    for chunk in parts:
+        chunk = chunk.strip().strip(",").strip()
+        if not chunk:
+            continue
+        idx = chunk.find(",")
+        if idx == -1:
+            continue
+        key = chunk[:idx].strip()
+        val = chunk[idx + 1:].strip().rstrip(",").strip()
+        if key:
+            out[key] = val
+    return out
+
+
+def build_corpus(rows: int, seed: int = 0) -> list:
+    """Messages shaped like eng-logtools camstim rows, including awkward ones.
+
+    Mixes reordered keys, HTML-escaped text, commas inside values, unknown
+    keys, trailing commas, odd spacing, non-Completed actions, "None" ids and
+    empty messages.
+    """
+    rng = random.Random(seed)
+    descriptive = [
+        "OPHYS_1_images_A", "HAB, day 2", "Dynamic Routing &amp; Templeton",
+        "TRAINING_5_images_B_epilogue", "receptive field &#44; mapping",
+    ]
+    actions = ["Completed"] * 6 + ["Started", "Aborted", "Failed"]
+    out = []
+    for i in range(rows):
+        fields = [
+            ("MID", rng.choice([str(600000 + rng.randrange(99999)), "None", ""])),
+            ("UID", rng.choice(["jdoe", "asmith", "None", "svc_camstim"])),
+            ("Action", rng.choice(actions)),
+            ("Resource_ID", f"C:/ProgramData/camstim/scripts/stim_{rng.randrange(40)}.py"),
+            ("Descriptive_name", rng.choice(descriptive)),
+            ("Mode", rng.choice(["Production", "Test"])),
+            ("Checksum", f"{rng.getrandbits(64):016x}"),
+            ("Json_checksum", f"{rng.getrandbits(64):016x}"),
+            ("Duration_min", f"{rng.uniform(0, 120):.2f}"),
+            ("Return_code", rng.choice(["0", "0", "0", "1", "-1"])),
+            ("Long_frames", str(rng.randrange(50))),
+            ("Extra-long_frames", str(rng.randrange(5))),
+            ("Wheel_rotations", f"{rng.uniform(0, 400):.1f}"),
+        ]
+        if rng.random() < 0.5:
+            rng.shuffle(fields)
+        if rng.random() < 0.1:
+            fields.insert(rng.randrange(len(fields)), ("Operator_note", "ok, re-run"))
+        if rng.random() < 0.1:
+            fields = fields[: rng.randrange(3, len(fields))]
+        sep = rng.choice([", ", ",", " ,  "])
+        msg = sep.join(f"{k}{sep}{v}" for k, v in fields)
+        if rng.random() < 0.05:
+            msg += ","
+        if rng.random() < 0.15:
+            msg = msg.replace(",", "&#44;", 2).replace("&", "&amp;", 1)
+        if i % 97 == 0:
+            msg = ""
+        out.append(msg)
+    return out
+
+
+def check_equivalence(corpus: list) -> int:
+    """Assert the new parser matches ``legacy_parse``; return #Completed rows."""
+    count = 0
+    for msg in corpus:
+        expected = legacy_parse(msg)
+        if camstim_parser.parse_message(msg) != expected:
+            raise AssertionError(f"parse_message differs for {msg!r}")
+        want = expected if expected.get("Action") == "Completed" else None
+        if camstim_parser.parse_completed(msg) != want:
+            raise AssertionError(f"parse_completed differs for {msg!r}")
+        count += want is not None
+    return count
+
+
+def bench(corpus: list, repeat: int) -> dict:
+    """Best-of-*repeat* rows/sec for the legacy parser and both new APIs."""
+    cases = {
+        "legacy_per_row": lambda: [legacy_parse(m) for m in corpus],
+        "parse_message_per_row": lambda: [camstim_parser.parse_message(m) for m in corpus],
+        "parse_completed_per_row": lambda: [camstim_parser.parse_completed(m) for m in corpus],
+    }
+    results = {}
+    for name, fn in cases.items():
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        results[name] = {"seconds": round(best, 4), "rows_per_sec": round(len(corpus) / best)}
+    base = results["legacy_per_row"]["seconds"]
+    for r in results.values():
+        r["speedup"] = round(base / r["seconds"], 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.rows)
+    completed = check_equivalence(corpus)
+    results = bench(corpus, args.repeat)
+
+    if args.json:
+        print(json.dumps({"rows": len(corpus), "completed": completed, "results": results}))
+        return
+    print(f"{len(corpus)} messages ({completed} Completed), outputs identical to legacy parser")
+    for name, r in results.items():
+        print(f"  {name:24s} {r['rows_per_sec']:>10,} rows/s  {r['seconds']:.3f} s  x{r['speedup']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+Load-tests docdb_proxy.py against local stand-ins for its upstreams.
+
+The proxy runs in a forked child with its DocDB clients, S3 endpoint and
+log-server pool replaced by local fakes:
+  - DocDB: records shaped like example_metadata.json (v2) and
+    metadata_v1.json (v1), served after --docdb-latency seconds
+  - S3: the ListObjectsV2 stub from test_docdb_proxy.py with --s3-keys keys
+  - MySQL: a fake connection returning --log-rows camstim messages
+The parent drives a weighted mix of routes over keep-alive connections at
+each --concurrency level and reports req/s, p50/p95/p99 latency (overall
+and per route) and the child's peak RSS. With --baseline, the run fails
+if throughput drops or p99 grows by more than --tolerance.
+
+Run: python testing/proxy_load_test.py [--mode threaded|async]
+     [--concurrency 1,8,32] [--duration 10] [--json] [--out FILE]
+     [--baseline FILE]
+"""
+
+import argparse
+import copy
+import http.client
+import json
+import logging
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import patch
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from testing.camstim_parser_speed import build_corpus  # noqa: E402
+from testing.test_docdb_proxy import FakeS3Handler  # noqa: E402
+from web import docdb_proxy  # noqa: E402
+
+BUCKET = "bench-bucket"
+CAMSTIM_PAYLOAD = {
+    "user": "bench", "password": "bench", "table": "last_2month",
+    "startDate": "2026-01-01", "endDate": "2026-03-01",
+}
+
+DEFAULT_MIX = {
+    "search_v2": 35,
+    "search_v1": 10,
+    "search_stream": 5,
+    "search_batch": 5,
+    "by_name": 15,
+    "s3_list": 15,
+    "camstim_completed": 10,
+    "camstim_summary": 5,
+}
+
+
+class StubDocDbClient:
+    """MetadataDbClient stand-in over *count* copies of a template record."""
+
+    def __init__(self, version, template, count, latency):
+        self.version = version
+        self.latency = latency
+        self.records = []
+        for i in range(count):
+            record = copy.deepcopy(template)
+            record["_id"] = f"{i:08d}"
+            record["name"] = f"bench_{version}_{i}"
+            self.records.append(record)
+        self.by_name = {r["name"]: r for r in self.records}
+
+    def retrieve_docdb_records(self, filter_query=None, projection=None, sort=None, limit=0):
+        time.sleep(self.latency)
+        filter_query = filter_query or {}
+        names = filter_query.get("name", {}).get("$in") if isinstance(filter_query.get("name"), dict) else None
+        if names is not None:
+            matches = [self.by_name[n] for n in names if n in self.by_name]
+        else:
+            bound = None
+            for clause in filter_query.get("$and", [filter_query]):
+                bound = clause.get("_id", {}).get("$gt", bound)
+            matches = [r for r in self.records if bound is None or r["_id"] > bound]
+        if limit:
+            matches = matches[:limit]
+        if projection:
+            keep = {k for k, v in projection.items() if v} | {"_id"}
+            return [{k: v for k, v in r.items() if k in keep} for r in matches]
+        return [dict(r) for r in matches]
+
+
+class _FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        self.offset = 0
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchmany(self, size):
+        batch = self.rows[self.offset:self.offset + size]
+        self.offset += len(batch)
+        return batch
+
+
+class FakeLogServerConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, cursorclass=None):
+        return _FakeCursor(self.rows)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        pass
+
+
+def _log_rows(count):
+    start = datetime(2026, 1, 1)
+    return [
+        {
+            "datetime": start + timedelta(minutes=7 * i),
+            "client_address": f"W10DT{i % 12} / 10.0.0.{i % 12}",
+            "version": "1.0",
+            "message": message,
+        }
+        for i, message in enumerate(build_corpus(count, seed=1))
+    ]
+
+
+def _serve_proxy(config, ready):
+    """Child process: install the fakes and serve the proxy until terminated."""
+    s3 = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+    s3.daemon_threads = True
+    FakeS3Handler.keys = [
+        f"run{i % 4}/session{i // 40}/figure_{i}.png" for i in range(config["s3_keys"])
+    ]
+    FakeS3Handler.requests = []
+    threading.Thread(target=s3.serve_forever, daemon=True).start()
+
+    v2 = json.loads((ROOT / "example_metadata.json").read_text())
+    v1 = json.loads((ROOT / "metadata_v1.json").read_text())
+    latency = config["docdb_latency"]
+    rows = _log_rows(config["log_rows"])
+    pool = docdb_proxy.LogServerPool(
+        lambda user, password: FakeLogServerConnection(rows), max_idle=8, idle_timeout=300
+    )
+    patch.object(docdb_proxy, "client_v2", StubDocDbClient("v2", v2, config["records"], latency)).start()
+    patch.object(docdb_proxy, "client_v1", StubDocDbClient("v1", v1, config["records"], latency)).start()
+    patch.object(docdb_proxy, "S3_ENDPOINT", f"http://127.0.0.1:{s3.server_port}/{{bucket}}/").start()
+    patch.object(docdb_proxy, "S3_LIST_ALLOWED_BUCKETS", {BUCKET}).start()
+    patch.object(docdb_proxy, "log_server_pool", pool).start()
+    for name in (docdb_proxy.log.name, "docdb_proxy"):
+        logging.getLogger(name).setLevel("ERROR")
+
+    if config["mode"] == "async":
+        import asyncio
+
+        async def run():
+            server = docdb_proxy.AsyncProxyServer("127.0.0.1", 0)
+            await server.start()
+            ready.put(server.server_port)
+            await asyncio.Event().wait()
+
+        asyncio.run(run())
+    else:
+        server = docdb_proxy.ProxyHTTPServer(("127.0.0.1", 0), docdb_proxy.DocDbProxyHandler)
+        ready.put(server.server_port)
+        server.serve_forever()
+
+
+def _request_for(op, rng, config):
+    """Return ``(method, path, body)`` for one request of kind *op*."""
+    distinct = config["distinct_filters"]
+    names = [f"bench_v2_{rng.randrange(config['records'])}" for _ in range(3)]
+    if op == "search_v2":
+        return "POST", "/metadata/search", {"filter": {"subject.subject_id": str(rng.randrange(distinct))}, "limit": 50}
+    if op == "search_v1":
+        return "POST", "/v1/metadata/search", {
+            "filter": {"subject.subject_id": str(rng.randrange(distinct))},
+            "projection": {"name": 1, "subject": 1, "data_description": 1},
+            "limit": 50,
+        }
+    if op == "search_stream":
+        return "POST", "/metadata/search", {"filter": {}, "limit": 100, "stream": True, "batch_size": 50}
+    if op == "search_batch":
+        return "POST", "/metadata/search/batch", {"queries": [
+            {"filter": {"subject.subject_id": str(rng.randrange(distinct))}, "limit": 20} for _ in range(5)
+        ]}
+    if op == "by_name":
+        return "POST", "/metadata/by-name", {"names": names, "projection": {"name": 1, "subject": 1}}
+    if op == "s3_list":
+        return "GET", f"/s3-list?bucket={BUCKET}&prefix=run{rng.randrange(4)}", None
+    if op == "camstim_completed":
+        return "POST", "/log-server/camstim-completed", {**CAMSTIM_PAYLOAD, "stream": rng.random() < 0.5}
+    if op == "camstim_summary":
+        return "POST", "/log-server/camstim-summary", CAMSTIM_PAYLOAD
+    raise ValueError(op)
+
+
+def _client(port, config, mix, deadline, seed, samples):
+    rng = random.Random(seed)
+    ops, weights = zip(*mix.items())
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    while time.monotonic() < deadline:
+        op = rng.choices(ops, weights)[0]
+        method, path, body = _request_for(op, rng, config)
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if data else {}
+        # Each simulated user gets its own admission-control token bucket, as behind nginx.
+        headers["X-Real-IP"] = f"10.0.{seed // 250 % 250}.{seed % 250 + 1}"
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 400
+            if response.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+        samples.append((op, time.perf_counter() - start, ok))
+    conn.close()
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _summarize(samples, seconds):
+    latencies = sorted(s[1] for s in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if not s[2]),
+        "req_per_sec": round(len(samples) / seconds, 1),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def _peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_level(port, pid, config, mix, concurrency, duration):
+    samples: list = []
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=_client, args=(port, config, mix, deadline, 1000 * concurrency + i, samples))
+        for i in range(concurrency)
+    ]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    by_op = {op: _summarize([s for s in samples if s[0] == op], elapsed) for op in mix}
+    return {
+        "concurrency": concurrency,
+        **_summarize(samples, elapsed),
+        "peak_rss_kb": _peak_rss_kb(pid),
+        "routes": by_op,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Return regressions of *result* against *baseline*, matched by concurrency."""
+    previous = {level["concurrency"]: level for level in baseline["levels"]}
+    problems = []
+    for level in result["levels"]:
+        old = previous.get(level["concurrency"])
+        if old is None:
+            continue
+        c = level["concurrency"]
+        if level["req_per_sec"] < old["req_per_sec"] * (1 - tolerance):
+            problems.append(f"c={c}: req/s {old['req_per_sec']} -> {level['req_per_sec']}")
+        if old["p99_ms"] and level["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            problems.append(f"c={c}: p99 {old['p99_ms']}ms -> {level['p99_ms']}ms")
+        if level["errors"] > old["errors"]:
+            problems.append(f"c={c}: errors {old['errors']} -> {level['errors']}")
+    return problems
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown route {op!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--mix", type=_parse_mix, default=DEFAULT_MIX, help="e.g. search_v2=3,s3_list=1")
+    parser.add_argument("--docdb-latency", type=float, default=0.02)
+    parser.add_argument("--records", type=int, default=200, help="records per DocDB version")
+    parser.add_argument("--distinct-filters", type=int, default=50, help="controls search cache hit rate")
+    parser.add_argument("--s3-keys", type=int, default=2000)
+    parser.add_argument("--log-rows", type=int, default=5000)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--out", help="also write results to this file")
+    parser.add_argument("--baseline", help="fail if worse than this earlier --out file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    config = {
+        "mode": args.mode,
+        "docdb_latency": args.docdb_latency,
+        "records": args.records,
+        "distinct_filters": args.distinct_filters,
+        "s3_keys": args.s3_keys,
+        "log_rows": args.log_rows,
+    }
+    ctx = multiprocessing.get_context("fork")
+    ready = ctx.Queue()
+    proxy = ctx.Process(target=_serve_proxy, args=(config, ready), daemon=True)
+    proxy.start()
+    try:
+        port = ready.get(timeout=30)
+        if args.warmup:
+            run_level(port, proxy.pid, config, args.mix, 4, args.warmup)
+        levels = [
+            run_level(port, proxy.pid, config, args.mix, int(c), args.duration)
+            for c in args.concurrency.split(",")
+        ]
+    finally:
+        proxy.terminate()
+        proxy.join()
+
+    result = {"config": {**config, "mix": args.mix, "duration": args.duration}, "levels": levels}
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2) + "\n")
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"docdb_proxy {args.mode}, DocDB latency {args.docdb_latency * 1000:.0f} ms")
+        for level in levels:
+            rss = f"{level['peak_rss_kb'] / 1024:.0f} MB" if level["peak_rss_kb"] else "n/a"
+            print(
+                f"  c={level['concurrency']:<4} {level['req_per_sec']:>8} req/s  "
+                f"p50 {level['p50_ms']} ms  p95 {level['p95_ms']} ms  p99 {level['p99_ms']} ms  "
+                f"errors {level['errors']}  peak RSS {rss}"
+            )
+
+    if args.baseline:
+        problems = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import unittest
+
+from testing.camstim_parser_speed import build_corpus, check_equivalence, legacy_parse
+from web.camstim_parser import may_be_completed, parse_completed, parse_message
+
+
+class CamstimParserTests(unittest.TestCase):
+	def test_reordered_keys_and_commas_in_values(self):
+		msg = "Action, Completed, Descriptive_name, HAB, day 2, MID, 612345, UID, jdoe,"
+
+		self.assertEqual(
+			parse_message(msg),
+			{"Action": "Completed", "Descriptive_name": "HAB, day 2", "MID": "612345", "UID": "jdoe"},
+		)
+
+	def test_html_escaped_text_is_unescaped_once(self):
+		msg = "MID, 1, Action, Completed, Descriptive_name, A &amp;amp; B&#44; C"
+
+		self.assertEqual(parse_message(msg)["Descriptive_name"], "A &amp; B, C")
+		self.assertEqual(parse_message(msg), legacy_parse(msg))
+
+	def test_rejects_non_completed_messages(self):
+		messages = ["MID, 1, Action, Started", "", "MID, 2, Action, Completed", "garbage"]
+
+		self.assertEqual([parse_completed(m) for m in messages], [None, None, {"MID": "2", "Action": "Completed"}, None])
+		self.assertFalse(may_be_completed("MID, 1, Action, Started, Descriptive_name, Completed"))
+		self.assertTrue(may_be_completed("Action&#44; Completed"))
+
+	def test_matches_legacy_parser_on_synthetic_corpus(self):
+		corpus = build_corpus(5_000, seed=7)
+
+		completed = check_equivalence(corpus)
+
+		self.assertGreater(completed, 1_000)
+		self.assertLess(completed, len(corpus))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,79 @@
+import pathlib
+import tempfile
+import unittest
+
+try:
+	import numpy as np
+	import tifffile  # noqa: F401
+except ImportError:
+	np = None
+
+if np is not None:
+	from scripts.compute_ccf_centers import accumulate, ccf_to_threejs, centers_from, load_structures, roll_up
+
+STRUCTURES = [
+	{"id": 997, "structure_id_path": [997]},
+	{"id": 8, "structure_id_path": [997, 8]},
+	{"id": 10, "structure_id_path": [997, 8, 10]},
+	{"id": 11, "structure_id_path": [997, 8, 11]},
+	{"id": 12, "structure_id_path": [997, 8, 11, 12]},
+	{"id": 20, "structure_id_path": [997, 20]},
+	{"id": 30, "structure_id_path": [997, 30]},
+]
+
+
+def legacy_centers(ann, structures, lr_start, lr_stop, res):
+	"""The per-voxel, per-structure loop compute_ccf_centers.py used before the bincount roll-up."""
+	part = ann[:, :, lr_start:lr_stop]
+	ap_idx, dv_idx, lr_sub_idx = np.nonzero(part)
+	sid_flat = part[ap_idx, dv_idx, lr_sub_idx].astype(np.int64)
+	leaf_stats = {}
+	for ap, dv, lr, sid in zip(ap_idx, dv_idx, lr_sub_idx + lr_start, sid_flat):
+		s = leaf_stats.setdefault(int(sid), [0.0, 0.0, 0.0, 0])
+		s[0] += int(ap)
+		s[1] += int(dv)
+		s[2] += int(lr)
+		s[3] += 1
+	id_to_path = {s["id"]: s["structure_id_path"] for s in structures}
+	ancestor_to_leaves = {sid: [] for sid in id_to_path}
+	for leaf_id in leaf_stats:
+		for ancestor_id in id_to_path.get(leaf_id, [leaf_id]):
+			if ancestor_id in ancestor_to_leaves:
+				ancestor_to_leaves[ancestor_id].append(leaf_id)
+	centers = {}
+	for struct_id, leaves in ancestor_to_leaves.items():
+		if not leaves:
+			continue
+		sums = [sum(leaf_stats[leaf][k] for leaf in leaves) for k in range(4)]
+		ap_um, dv_um, ml_um = (sums[k] / sums[3] * res + res / 2 for k in range(3))
+		x, y, z = ccf_to_threejs(ap_um, dv_um, ml_um)
+		centers[str(struct_id)] = [round(x, 3), round(y, 3), round(z, 3)]
+	return centers
+
+
+@unittest.skipIf(np is None, "numpy and tifffile not installed")
+class CcfCentersTests(unittest.TestCase):
+	def test_roll_up_matches_per_structure_loop(self):
+		rng = np.random.default_rng(3)
+		# 0 is background, 99 is an id missing from structures.json, 30 is never annotated.
+		ann = rng.choice(np.array([0, 0, 8, 10, 11, 12, 20, 99], dtype=np.uint32), size=(9, 7, 12))
+		ids = np.array(sorted(s["id"] for s in STRUCTURES), dtype=np.int64)
+
+		for name, lr_start, lr_stop in (("left", 6, None), ("right", 0, 6)):
+			with self.subTest(hemisphere=name):
+				stats = accumulate(ann, ids, slice(lr_start, lr_stop))
+				centers = centers_from(roll_up(stats, ids, STRUCTURES), ids, (100.0, 100.0, 100.0))
+
+				self.assertEqual(centers, legacy_centers(ann, STRUCTURES, lr_start, lr_stop, 100.0))
+				self.assertEqual(set(centers), {"997", "8", "10", "11", "12", "20"})
+
+	def test_missing_structures_for_atlas_is_an_error(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			with self.assertRaises(FileNotFoundError):
+				load_structures(pathlib.Path(tmp), "allen_mouse_25um_v1.2")
+
+			self.assertTrue(load_structures(pathlib.Path(tmp), "allen_mouse_100um_v1.2"))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,15 +1,67 @@
+import asyncio
+import hashlib
+import http.client
+import io
 import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import threading
 import time
 import unittest
 import urllib.error
+import urllib.parse
 import urllib.request
-from http.server import ThreadingHTTPServer
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
 from unittest.mock import patch
 
 import pymysql
+import pymysql.cursors
 
-from web.docdb_proxy import DocDbProxyHandler
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+try:
+	import duckdb
+except ImportError:
+	duckdb = None
+
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+from web import docdb_proxy
+from web.docdb_proxy import (
+	AdmissionController,
+	AdmissionRejected,
+	AsyncProxyServer,
+	CamstimMirror,
+	DocDbProxyHandler,
+	Histogram,
+	LazyDocDbClient,
+	LogServerConnectError,
+	LogServerPool,
+	NameLookupBatcher,
+	ProxyMetrics,
+	S3ListingIndex,
+	SearchResultCache,
+	ThumbnailCache,
+	UpstreamGuard,
+	UpstreamTimeout,
+	UpstreamUnavailable,
+	Warmup,
+	_flatten_record,
+	_request_cost,
+)
 
 
 class ProxyServerTestCase(unittest.TestCase):
@@ -41,6 +93,14 @@ class ProxyServerTestCase(unittest.TestCase):
 		with response:
 			return response.status, json.loads(response.read())
 
+	def exchange(self, connection, method, path, payload=None, etag=None):
+		"""Send one request on a kept-alive *connection*; return status, headers, body."""
+		headers = {"If-None-Match": etag} if etag else {}
+		body = json.dumps(payload).encode() if payload is not None else None
+		connection.request(method, path, body=body, headers=headers)
+		response = connection.getresponse()
+		return response.status, response.headers, response.read()
+
 
 class ProxyEndpointTests(ProxyServerTestCase):
 	def test_s3_list_rejects_unapproved_bucket(self):
@@ -86,6 +146,1525 @@ class ProxyEndpointTests(ProxyServerTestCase):
 		self.assertEqual(status, 502)
 		self.assertEqual(body, {"error": "S3 list failed: timed out"})
 
+	def test_rate_limited_client_gets_429_with_retry_after(self):
+		controller = AdmissionController(docdb_proxy.ADMISSION_BULKHEADS, {}, 60, 4, 0.5, 1)
+		path = "/s3-list?bucket=private-bucket"
+		with patch.object(docdb_proxy, "admission", controller):
+			first = self.request(path)
+			try:
+				urllib.request.urlopen(self.base_url + path, timeout=2)
+			except urllib.error.HTTPError as error:
+				second = (error.status, error.headers["Retry-After"], json.loads(error.read()))
+
+		self.assertEqual(first[0], 400)
+		self.assertEqual(second, (429, "2", {"error": "Proxy overloaded (rate_limited), retry later"}))
+
+	def test_s3_list_revalidates_from_stored_etag(self):
+		calls = []
+
+		def lister(bucket, prefix, start_after=None):
+			calls.append(prefix)
+			return [{"key": f"{prefix}fig.png"}], f"{prefix}fig.png"
+
+		path = "/s3-list?bucket=aind-analysis-prod-o5171v&prefix=plots"
+		connection = http.client.HTTPConnection(urllib.parse.urlsplit(self.base_url).netloc, timeout=2)
+		with patch.object(docdb_proxy, "s3_index", S3ListingIndex(60, 900, 100)):
+			with patch.object(docdb_proxy, "_s3_list_objects", side_effect=lister):
+				status, headers, body = self.exchange(connection, "GET", path)
+				etag = headers["ETag"]
+				with patch("json.dumps", side_effect=AssertionError("re-serialized")):
+					not_modified = self.exchange(connection, "GET", path, etag=f"W/{etag}")
+				changed = self.exchange(connection, "GET", path, etag='"other"')
+		connection.close()
+
+		self.assertEqual((status, headers["Cache-Control"]), (200, docdb_proxy.S3_LIST_CACHE_CONTROL))
+		self.assertEqual(etag, docdb_proxy._strong_etag(body))
+		self.assertEqual(not_modified[:3:2], (304, b""))
+		self.assertEqual(not_modified[1]["ETag"], etag)
+		self.assertEqual((changed[0], changed[2]), (200, body))
+		self.assertEqual(calls, ["plots/"])
+
+
+class SearchCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.now = 0.0
+		self.cache = SearchResultCache(100, ttl=10, stale_ttl=20, clock=lambda: self.now)
+
+	def test_key_ignores_dict_ordering(self):
+		first = SearchResultCache.make_key("v2", {"a": 1, "b": 2}, None, 10)
+		second = SearchResultCache.make_key("v2", {"b": 2, "a": 1}, None, 10)
+
+		self.assertEqual(first, second)
+		self.assertNotEqual(first, SearchResultCache.make_key("v1", {"a": 1, "b": 2}, None, 10))
+
+	def test_hit_then_stale_then_miss(self):
+		calls = []
+
+		def load():
+			calls.append(1)
+			return b"x" * len(calls)
+
+		self.assertEqual(self.cache.get_or_load("k", load), (b"x", "miss"))
+		self.assertEqual(self.cache.get_or_load("k", load), (b"x", "hit"))
+
+		self.now = 15
+		self.assertEqual(self.cache.get_or_load("k", load), (b"x", "stale"))
+		for _ in range(50):
+			if self.cache.stats()["bytes"] == 2:
+				break
+			time.sleep(0.01)
+		self.assertEqual(len(calls), 2)
+
+		self.now = 100
+		self.assertEqual(self.cache.get_or_load("k", load), (b"xxx", "miss"))
+
+	def test_evicts_least_recently_used_by_size(self):
+		self.cache.get_or_load("a", lambda: b"a" * 40)
+		self.cache.get_or_load("b", lambda: b"b" * 40)
+		self.cache.get_or_load("a", lambda: b"")
+		self.cache.get_or_load("c", lambda: b"c" * 40)
+
+		stats = self.cache.stats()
+		self.assertEqual((stats["entries"], stats["bytes"], stats["evictions"]), (2, 80, 1))
+		self.assertEqual(self.cache.get_or_load("a", lambda: b"new")[1], "hit")
+
+	def test_etag_is_stored_with_the_body(self):
+		body, etag, status = self.cache.get_with_etag("k", lambda: b"x")
+
+		self.assertEqual((body, etag, status), (b"x", docdb_proxy._strong_etag(b"x"), "miss"))
+		self.assertEqual(self.cache.get_with_etag("k", lambda: b"y"), (b"x", etag, "hit"))
+
+	def test_serves_old_entry_when_reload_fails(self):
+		cache = SearchResultCache(100, ttl=10, stale_ttl=20, stale_if_error=50, clock=lambda: self.now)
+		_, etag, _ = cache.get_with_etag("k", lambda: b"x")
+
+		def fail():
+			raise ValueError("boom")
+
+		self.now = 40
+		self.assertEqual(cache.get_with_etag("k", fail), (b"x", etag, "stale-error"))
+		self.now = 70
+		with self.assertRaises(ValueError):
+			cache.get_with_etag("k", fail)
+
+	def test_errors_are_not_cached(self):
+		def fail():
+			raise ValueError("boom")
+
+		with self.assertRaises(ValueError):
+			self.cache.get_or_load("k", fail)
+
+		self.assertEqual(self.cache.get_or_load("k", lambda: b"ok"), (b"ok", "miss"))
+
+
+class SearchEndpointTests(ProxyServerTestCase):
+	def setUp(self):
+		docdb_proxy.search_cache.clear()
+		super().setUp()
+
+	def tearDown(self):
+		super().tearDown()
+		docdb_proxy.search_cache.clear()
+
+	def test_concurrent_identical_searches_share_one_upstream_call(self):
+		release = threading.Event()
+		calls = []
+
+		def retrieve(**kwargs):
+			calls.append(kwargs)
+			release.wait(timeout=2)
+			return [{"name": "asset"}]
+
+		results = []
+		payload = {"filter": {"subject_id": "123"}, "limit": 5}
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", side_effect=retrieve):
+			threads = [
+				threading.Thread(target=lambda: results.append(self.request("/metadata/search", payload)))
+				for _ in range(5)
+			]
+			for thread in threads:
+				thread.start()
+			time.sleep(0.2)
+			release.set()
+			for thread in threads:
+				thread.join(timeout=2)
+
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(results, [(200, [{"name": "asset"}])] * 5)
+
+	def test_matching_if_none_match_returns_304(self):
+		payload = {"filter": {"subject_id": "123"}, "limit": 5}
+		connection = http.client.HTTPConnection(urllib.parse.urlsplit(self.base_url).netloc, timeout=2)
+
+		def retrieve(filter_query=None, limit=0):
+			return [{"name": "a"}] * (limit - 4)
+
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", side_effect=retrieve):
+			status, headers, body = self.exchange(connection, "POST", "/metadata/search", payload)
+			not_modified = self.exchange(connection, "POST", "/metadata/search", payload, headers["ETag"])
+			other = self.exchange(connection, "POST", "/metadata/search", {**payload, "limit": 6}, headers["ETag"])
+		connection.close()
+
+		self.assertEqual((status, json.loads(body)), (200, [{"name": "a"}]))
+		self.assertEqual((headers["Vary"], headers["Cache-Control"]), ("Accept", docdb_proxy.SEARCH_CACHE_CONTROL))
+		self.assertEqual((not_modified[0], not_modified[2], not_modified[1]["X-Cache"]), (304, b"", None))
+		self.assertEqual(other[0], 200)
+		self.assertNotEqual(other[1]["ETag"], headers["ETag"])
+
+	def test_open_breaker_fails_fast_with_503(self):
+		guard = UpstreamGuard("docdb_v2", docdb_proxy.docdb_call_executor, 1, 0, 10, 1, 1, 30)
+		calls = []
+
+		def retrieve(**kwargs):
+			calls.append(kwargs)
+			raise RuntimeError("upstream down")
+
+		with patch.dict(docdb_proxy.docdb_guards, {"v2": guard}):
+			with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", side_effect=retrieve):
+				first = self.request("/metadata/search", {"filter": {}})
+				try:
+					urllib.request.urlopen(urllib.request.Request(
+						self.base_url + "/metadata/search", data=b'{"filter": {"a": 1}}',
+					), timeout=2)
+				except urllib.error.HTTPError as error:
+					second = (error.status, error.headers["Retry-After"])
+
+		self.assertEqual(first, (500, {"error": "upstream down"}))
+		self.assertEqual(second, (503, "30"))
+		self.assertEqual(len(calls), 1)
+
+	def test_upstream_failure_returns_500(self):
+		with patch.object(
+			docdb_proxy.client_v1,
+			"retrieve_docdb_records",
+			side_effect=RuntimeError("upstream down"),
+		):
+			status, body = self.request("/v1/metadata/search", {"filter": {}})
+
+		self.assertEqual((status, body), (500, {"error": "upstream down"}))
+
+
+class FakeDocDbClient:
+	version = "v2"
+
+	def __init__(self, records, fail_after=None):
+		self.records = records
+		self.fail_after = fail_after
+		self.calls = []
+
+	def retrieve_docdb_records(self, filter_query=None, projection=None, sort=None, limit=0):
+		self.calls.append({"filter_query": filter_query, "projection": projection, "limit": limit})
+		if self.fail_after is not None and len(self.calls) > self.fail_after:
+			raise RuntimeError("upstream reset")
+		bound = None
+		for clause in (filter_query or {}).get("$and", [filter_query or {}]):
+			bound = clause.get("_id", {}).get("$gt", bound)
+		matches = [dict(r) for r in self.records if bound is None or r["_id"] > bound]
+		return matches[:limit] if limit else matches
+
+
+class SearchStreamTests(ProxyServerTestCase):
+	def stream(self, path, payload, headers=None):
+		request = urllib.request.Request(
+			self.base_url + path,
+			data=json.dumps(payload).encode(),
+			headers={"Content-Type": "application/json", **(headers or {})},
+		)
+		with urllib.request.urlopen(request, timeout=2) as response:
+			content_type = response.headers["Content-Type"]
+			lines = [json.loads(line) for line in response.read().splitlines()]
+		return content_type, lines
+
+	def test_streams_pages_as_ndjson_with_trailing_meta(self):
+		fake = FakeDocDbClient([{"_id": f"{i:03d}", "name": f"asset-{i}"} for i in range(7)])
+
+		with patch.object(docdb_proxy, "client_v2", fake):
+			content_type, lines = self.stream(
+				"/metadata/search",
+				{"filter": {}, "limit": 0, "batch_size": 3},
+				headers={"Accept": "application/x-ndjson"},
+			)
+
+		self.assertEqual(content_type, "application/x-ndjson")
+		self.assertEqual([r["name"] for r in lines[:-1]], [f"asset-{i}" for i in range(7)])
+		self.assertEqual(lines[-1], {"_meta": {"count": 7, "cursor": "006", "complete": True}})
+		self.assertEqual([c["limit"] for c in fake.calls], [3, 3, 3])
+
+	def test_resumes_from_cursor_and_honours_limit(self):
+		fake = FakeDocDbClient([{"_id": f"{i:03d}", "name": f"asset-{i}"} for i in range(10)])
+
+		with patch.object(docdb_proxy, "client_v2", fake):
+			_, lines = self.stream(
+				"/metadata/search",
+				{
+					"filter": {"subject_id": "1"},
+					"limit": 4,
+					"stream": True,
+					"cursor": "004",
+					"batch_size": 3,
+					"projection": {"name": 1, "_id": 0},
+				},
+			)
+
+		self.assertEqual(lines[:-1], [{"name": f"asset-{i}"} for i in range(5, 9)])
+		self.assertEqual(lines[-1]["_meta"]["cursor"], "008")
+		self.assertEqual(fake.calls[0]["projection"], {"name": 1, "_id": 1})
+		self.assertEqual(
+			fake.calls[0]["filter_query"],
+			{"$and": [{"subject_id": "1"}, {"_id": {"$gt": "004"}}]},
+		)
+
+	def test_pages_after_the_first_outlive_the_request_deadline(self):
+		fake = FakeDocDbClient([{"_id": f"{i:03d}"} for i in range(8)])
+		retrieve = fake.retrieve_docdb_records
+
+		def slow(**kwargs):
+			time.sleep(0.1)
+			return retrieve(**kwargs)
+
+		with patch.object(docdb_proxy, "client_v2", fake), \
+			patch.object(fake, "retrieve_docdb_records", slow), \
+			patch.dict(docdb_proxy.ADMISSION_DEADLINES, {"/metadata/search": 0.25}):
+			_, lines = self.stream("/metadata/search", {"filter": {}, "limit": 0, "batch_size": 2, "stream": True})
+
+		self.assertEqual(lines[-1], {"_meta": {"count": 8, "cursor": "007", "complete": True}})
+
+	def test_midstream_failure_is_reported_in_meta(self):
+		fake = FakeDocDbClient([{"_id": f"{i:03d}"} for i in range(6)], fail_after=1)
+
+		with patch.object(docdb_proxy, "client_v2", fake):
+			_, lines = self.stream("/metadata/search", {"limit": 0, "stream": True, "batch_size": 2})
+
+		self.assertEqual(
+			lines[-1],
+			{"_meta": {"count": 2, "cursor": "001", "complete": False, "error": "upstream reset"}},
+		)
+
+
+class ColumnarSearchTests(ProxyServerTestCase):
+	records = [
+		{"name": "a", "subject": {"subject_id": "1", "sex": "Male"}, "tags": ["x"], "n": 1},
+		{"name": "b", "subject": {"subject_id": "2"}, "n": "two"},
+	]
+
+	def setUp(self):
+		docdb_proxy.search_cache.clear()
+		super().setUp()
+
+	def tearDown(self):
+		super().tearDown()
+		docdb_proxy.search_cache.clear()
+
+	def fetch(self, payload, accept):
+		request = urllib.request.Request(
+			self.base_url + "/metadata/search",
+			data=json.dumps(payload).encode(),
+			headers={"Content-Type": "application/json", "Accept": accept},
+		)
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", return_value=self.records):
+			with urllib.request.urlopen(request, timeout=2) as response:
+				return response.headers["Content-Type"], response.read()
+
+	def test_flatten_record_uses_dotted_paths(self):
+		self.assertEqual(
+			_flatten_record({"a": {"b": {"c": 1}, "d": {}}, "e": [1]}),
+			{"a.b.c": 1, "a.d": {}, "e": [1]},
+		)
+
+	@unittest.skipIf(pyarrow is None, "pyarrow not installed")
+	def test_arrow_stream_has_dotted_columns(self):
+		content_type, data = self.fetch({"filter": {}}, "application/vnd.apache.arrow.stream")
+
+		table = pyarrow.ipc.open_stream(data).read_all()
+		self.assertEqual(content_type, "application/vnd.apache.arrow.stream")
+		self.assertEqual(table.column_names, ["name", "subject.subject_id", "subject.sex", "tags", "n"])
+		self.assertEqual(table.column("subject.sex").to_pylist(), ["Male", None])
+		self.assertEqual(table.column("tags").to_pylist(), ['["x"]', None])
+		self.assertEqual(table.column("n").to_pylist(), ["1", "two"])
+
+	@unittest.skipIf(pyarrow is None, "pyarrow not installed")
+	def test_parquet_format_field(self):
+		content_type, data = self.fetch({"filter": {}, "format": "parquet"}, "*/*")
+
+		table = pyarrow.parquet.read_table(pyarrow.BufferReader(data))
+		self.assertEqual(content_type, "application/vnd.apache.parquet")
+		self.assertEqual(table.column("subject.subject_id").to_pylist(), ["1", "2"])
+
+	def test_non_string_format_is_rejected(self):
+		for fmt in (["arrow"], {"arrow": 1}, 7):
+			with self.subTest(fmt=fmt):
+				status, body = self.request("/metadata/search", {"filter": {}, "format": fmt})
+
+				self.assertEqual((status, body), (400, {"error": f"Invalid format: {fmt}"}))
+
+
+@unittest.skipIf(duckdb is None or pyarrow is None, "duckdb and pyarrow not installed")
+class CacheAggregateTests(ProxyServerTestCase):
+	def setUp(self):
+		super().setUp()
+		self.tmp = tempfile.TemporaryDirectory()
+		events = os.path.join(self.tmp.name, "bdc-v0.39", "platform_swdb_events", "asset_name=a1")
+		os.makedirs(events)
+		pyarrow.parquet.write_table(
+			pyarrow.table({"kind": ["lick", "reward", "lick", "lick"], "t": [0.5, 1.0, 2.0, 3.5]}),
+			os.path.join(events, "data.pqt"),
+		)
+		running = os.path.join(self.tmp.name, "bdc-v0.39", "platform_swdb_running", "asset_name=a1")
+		os.makedirs(running)
+		pyarrow.parquet.write_table(
+			pyarrow.table({"timestamps": [float(i) for i in range(100)], "speed": [1.0] * 100}),
+			os.path.join(running, "data.pqt"),
+		)
+		sources = {**docdb_proxy.CACHE_AGGREGATE_SOURCES, "data-asset-cache": {"base": self.tmp.name, "version": None}}
+		self.patchers = [
+			patch.object(docdb_proxy, "CACHE_AGGREGATE_SOURCES", sources),
+			patch.object(docdb_proxy, "aggregate_cache", SearchResultCache(10_000_000, 3600, 0)),
+		]
+		for patcher in self.patchers:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+		self.tmp.cleanup()
+		super().tearDown()
+
+	def test_event_counts_are_memoized_per_version(self):
+		payload = {"query": "swdb_event_counts", "version": "bdc-v0.39", "params": {"asset": "a1"}}
+		connection = http.client.HTTPConnection("127.0.0.1", self.server.server_port, timeout=5)
+		self.addCleanup(connection.close)
+
+		status, headers, body = self.exchange(connection, "POST", "/cache-aggregate", payload)
+		with patch.object(docdb_proxy, "_run_aggregate", side_effect=AssertionError("scanned twice")):
+			again = self.exchange(connection, "POST", "/cache-aggregate", payload)
+			arrow = self.exchange(connection, "POST", "/cache-aggregate", {**payload, "format": "arrow"})
+			revalidated = self.exchange(connection, "POST", "/cache-aggregate", payload, etag=headers["ETag"])
+
+		self.assertEqual(status, 200)
+		self.assertEqual(headers["X-Cache"], "MISS")
+		self.assertEqual(json.loads(body), [
+			{"kind": "lick", "n": 3, "first_t": 0.5, "last_t": 3.5},
+			{"kind": "reward", "n": 1, "first_t": 1.0, "last_t": 1.0},
+		])
+		self.assertEqual(again[1]["X-Cache"], "HIT")
+		self.assertEqual(again[2], body)
+		self.assertEqual(arrow[1]["Content-Type"], "application/vnd.apache.arrow.stream")
+		self.assertEqual(pyarrow.ipc.open_stream(arrow[2]).read_all().column("n").to_pylist(), [3, 1])
+		self.assertEqual(revalidated[0], 304)
+
+	def test_params_are_bound_with_defaults(self):
+		payload = {"query": "swdb_running", "version": "bdc-v0.39", "params": {"asset": "a1", "max_points": 10}}
+
+		status, rows = self.request("/cache-aggregate", payload)
+
+		self.assertEqual(status, 200)
+		self.assertEqual(len(rows), 10)
+		self.assertEqual(rows[0], {"timestamps": 9.0, "speed": 1.0})
+
+	def test_rejects_unlisted_queries_and_bad_params(self):
+		cases = [
+			({"query": "SELECT 1", "version": "bdc-v0.39"}, "Unknown query: SELECT 1"),
+			({"query": "swdb_event_counts", "version": "bdc-v0.39"}, "Missing param: asset"),
+			({"query": "swdb_event_counts", "version": "..", "params": {"asset": "a1"}}, "Invalid version: .."),
+			(
+				{"query": "swdb_event_counts", "version": "v", "params": {"asset": "a1') UNION SELECT 1 --"}},
+				"Invalid asset: a1') UNION SELECT 1 --",
+			),
+			({"query": "swdb_running", "version": "v", "params": {"asset": "a1", "max_points": 0}},
+				"max_points must be an integer between 1 and 1000000"),
+			({"query": "swdb_running", "version": "v", "params": {"asset": "a1", "sql": "x"}}, "Unknown params: sql"),
+		]
+		for payload, error in cases:
+			with self.subTest(payload=payload):
+				self.assertEqual(self.request("/cache-aggregate", payload), (400, {"error": error}))
+
+	def test_catalogue_lists_queries(self):
+		status, body = self.request("/cache-aggregate")
+
+		self.assertEqual(status, 200)
+		self.assertEqual(
+			body["queries"]["swdb_running"]["params"],
+			{"asset": {"type": "name", "default": None}, "max_points": {"type": "int", "default": 4000}},
+		)
+
+
+class SearchBatchTests(ProxyServerTestCase):
+	def setUp(self):
+		docdb_proxy.search_cache.clear()
+		super().setUp()
+
+	def tearDown(self):
+		super().tearDown()
+		docdb_proxy.search_cache.clear()
+
+	def test_results_keep_order_with_per_item_errors(self):
+		def retrieve_v2(filter_query=None, limit=0, projection=None):
+			if filter_query.get("name") == "bad":
+				raise RuntimeError("bad filter")
+			return [{"name": filter_query["name"], "limit": limit}]
+
+		queries = [
+			{"filter": {"name": "a"}, "limit": 1},
+			{"filter": {"name": "bad"}},
+			{"filter": {"name": "c"}, "version": "v1"},
+			{"filter": {}, "version": "v9"},
+		]
+		with (
+			patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", side_effect=retrieve_v2),
+			patch.object(docdb_proxy.client_v1, "retrieve_docdb_records", return_value=[{"v": 1}]),
+		):
+			status, body = self.request("/metadata/search/batch", {"queries": queries})
+
+		self.assertEqual(status, 200)
+		self.assertEqual(
+			body["results"],
+			[
+				{"status": 200, "records": [{"name": "a", "limit": 1}]},
+				{"status": 500, "error": "bad filter"},
+				{"status": 200, "records": [{"v": 1}]},
+				{"status": 400, "error": "Invalid version: v9"},
+			],
+		)
+
+	def test_sub_queries_run_concurrently(self):
+		barrier = threading.Barrier(3, timeout=1)
+
+		def retrieve(filter_query=None, limit=0, projection=None):
+			barrier.wait()
+			return [filter_query]
+
+		queries = [{"filter": {"i": i}} for i in range(3)]
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", side_effect=retrieve):
+			status, body = self.request("/metadata/search/batch", queries)
+
+		self.assertEqual(status, 200)
+		self.assertEqual([r["records"] for r in body["results"]], [[{"i": i}] for i in range(3)])
+
+	def test_rejects_non_list_body(self):
+		status, body = self.request("/metadata/search/batch", {"queries": {"filter": {}}})
+
+		self.assertEqual((status, body), (400, {"error": "Expected a list of queries"}))
+
+	def test_by_name_endpoint_returns_records_keyed_by_name(self):
+		records = [{"name": "asset-1", "subject": {"subject_id": "1"}}]
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", return_value=records) as retrieve:
+			status, body = self.request("/metadata/by-name", {"names": ["asset-1", "asset-2"]})
+
+		self.assertEqual(status, 200)
+		self.assertEqual(body, {"records": {"asset-1": records[0], "asset-2": None}})
+		retrieve.assert_called_once_with(filter_query={"name": {"$in": ["asset-1", "asset-2"]}}, limit=0)
+
+
+class NameLookupBatcherTests(unittest.TestCase):
+	def setUp(self):
+		self.batcher = NameLookupBatcher(window=0.05, max_names=2)
+		self.calls = []
+		self.first_call_started = threading.Event()
+		self.release = threading.Event()
+		self.client = FakeDocDbClient([])
+		self.client.retrieve_docdb_records = self.retrieve
+
+	def retrieve(self, filter_query=None, projection=None, limit=0):
+		self.calls.append((sorted(filter_query["name"]["$in"]), projection))
+		self.first_call_started.set()
+		self.release.wait(timeout=2)
+		return [{"name": n, "subject": n.upper()} for n in filter_query["name"]["$in"] if n != "missing"]
+
+	def test_lone_lookup_is_sent_immediately(self):
+		self.release.set()
+		started = time.monotonic()
+
+		result = self.batcher.lookup(self.client, ["a"])
+
+		self.assertLess(time.monotonic() - started, 0.04)
+		self.assertEqual(result, {"a": {"name": "a", "subject": "A"}})
+
+	def test_lookups_during_inflight_call_are_merged(self):
+		results = {}
+
+		def lookup(names):
+			results[tuple(names)] = self.batcher.lookup(self.client, names, {"subject": 1})
+
+		first = threading.Thread(target=lookup, args=(["a"],))
+		first.start()
+		self.assertTrue(self.first_call_started.wait(timeout=1))
+		followers = [threading.Thread(target=lookup, args=(names,)) for names in (["b"], ["c", "b"], ["missing"])]
+		for thread in followers:
+			thread.start()
+		time.sleep(0.01)
+		self.release.set()
+		for thread in [first, *followers]:
+			thread.join(timeout=2)
+
+		self.assertEqual(self.calls[0], (["a"], {"subject": 1, "name": 1}))
+		self.assertEqual(sorted(names for call in self.calls[1:] for names in call[0]), ["b", "c", "missing"])
+		self.assertEqual(len(self.calls), 3)
+		self.assertEqual(results[("c", "b")], {"c": {"name": "c", "subject": "C"}, "b": {"name": "b", "subject": "B"}})
+		self.assertEqual(results[("missing",)], {"missing": None})
+		self.assertEqual(self.batcher.stats()["batches"], 2)
+
+
+class AdmissionControllerTests(unittest.TestCase):
+	def setUp(self):
+		self.now = 0.0
+		self.controller = self.make()
+
+	def make(self, capacity=1, deadline=15, burst=3):
+		return AdmissionController(
+			{"/r": capacity}, {}, deadline, queue_max=4,
+			client_rate=1, client_burst=burst, clock=lambda: self.now,
+		)
+
+	def test_token_bucket_limits_each_client(self):
+		for _ in range(3):
+			self.controller.release(self.controller.acquire("/r", "a", 1))
+
+		with self.assertRaises(AdmissionRejected) as caught:
+			self.controller.acquire("/r", "a", 1)
+		self.assertEqual((caught.exception.status, caught.exception.retry_after), (429, 1))
+
+		self.controller.release(self.controller.acquire("/r", "b", 1))
+		self.now = 1
+		self.controller.release(self.controller.acquire("/r", "a", 1))
+		self.assertIsNone(self.controller.acquire("/unlimited", "a", 100))
+
+	def test_waiters_are_admitted_round_robin_across_clients(self):
+		controller = self.make(burst=10)
+		held = controller.acquire("/r", "a", 1)
+		order = []
+
+		def wait(client, tag):
+			ticket = controller.acquire("/r", client, 1)
+			order.append(tag)
+			controller.release(ticket)
+
+		threads = []
+		for client, tag in (("a", "a1"), ("a", "a2"), ("b", "b1")):
+			threads.append(threading.Thread(target=wait, args=(client, tag)))
+			threads[-1].start()
+			time.sleep(0.05)
+		controller.release(held)
+		for thread in threads:
+			thread.join(timeout=2)
+
+		self.assertEqual(order, ["a1", "b1", "a2"])
+		self.assertEqual(controller.stats()["queued"], 3)
+
+	def test_sheds_when_estimated_wait_passes_deadline(self):
+		ticket = self.controller.acquire("/r", "a", 1)
+		self.now = 10
+		self.controller.release(ticket)
+		held = self.controller.acquire("/r", "a", 1)
+
+		with self.assertRaises(AdmissionRejected) as caught:
+			self.controller.acquire("/r", "b", 1)
+
+		self.assertEqual(
+			(caught.exception.status, caught.exception.reason, caught.exception.retry_after),
+			(503, "deadline", 10),
+		)
+		self.controller.release(held)
+		self.controller.release(self.controller.acquire("/r", "b", 1))
+
+	def test_request_cost_scales_with_limit_and_date_span(self):
+		year = {"startDate": "2025-01-01", "endDate": "2026-01-01"}
+
+		self.assertEqual(_request_cost("/metadata/search", {"limit": 50}), 1)
+		self.assertEqual(_request_cost("/metadata/search", {"limit": 5000}), 6)
+		self.assertEqual(_request_cost("/metadata/search", {"limit": 0}), docdb_proxy.ADMISSION_MAX_COST)
+		self.assertEqual(_request_cost("/metadata/search/batch", {"queries": [{"limit": 10}] * 3}), 3)
+		self.assertEqual(_request_cost("/log-server/camstim-summary", year), docdb_proxy.ADMISSION_MAX_COST)
+		self.assertEqual(_request_cost("/log-server/camstim-summary", {**year, "endDate": "2025-01-20"}), 1)
+		self.assertEqual(_request_cost("/s3-list", None), 1)
+
+
+class UpstreamGuardTests(unittest.TestCase):
+	def setUp(self):
+		self.now = 0.0
+		self.executor = docdb_proxy.ThreadPoolExecutor(max_workers=4)
+
+	def tearDown(self):
+		self.executor.shutdown(wait=True)
+
+	def make(self, **kwargs):
+		options = dict(
+			hedge_min_delay=0.05, hedge_max_ratio=1, window=10, min_samples=1,
+			failures=2, cooldown=10, clock=lambda: self.now,
+		)
+		return UpstreamGuard("up", self.executor, **{**options, **kwargs})
+
+	def test_slow_call_is_hedged_and_first_answer_wins(self):
+		guard = self.make(clock=time.monotonic)
+		guard.call(lambda: "warm", 1)
+		release = threading.Event()
+		attempts = []
+
+		def fn():
+			attempts.append(1)
+			if len(attempts) == 1:
+				release.wait(timeout=2)
+				return "primary"
+			return "hedge"
+
+		self.assertEqual(guard.call(fn, 1), "hedge")
+		release.set()
+		self.assertEqual(len(attempts), 2)
+		self.assertEqual((guard.stats()["hedges"], guard.stats()["hedge_wins"]), (1, 1))
+
+	def test_breaker_opens_after_consecutive_failures_then_recovers(self):
+		guard = self.make()
+
+		def fail():
+			raise RuntimeError("down")
+
+		for _ in range(2):
+			with self.assertRaises(RuntimeError):
+				guard.call(fail, 1)
+		with self.assertRaises(UpstreamUnavailable) as caught:
+			guard.call(lambda: "unreached", 1)
+		self.assertEqual((caught.exception.retry_after, guard.stats()["state"]), (10, "open"))
+
+		self.now = 11
+		self.assertEqual(guard.call(lambda: "ok", 1), "ok")
+		self.assertEqual(guard.stats()["state"], "closed")
+
+	def test_client_errors_do_not_trip_the_breaker(self):
+		guard = self.make()
+		error = RuntimeError("bad filter")
+		error.response = type("Response", (), {"status_code": 400})()
+
+		def fail():
+			raise error
+
+		for _ in range(3):
+			with self.assertRaises(RuntimeError):
+				guard.call(fail, 1)
+		self.assertEqual(guard.stats()["state"], "closed")
+
+	def test_call_is_bounded_by_timeout(self):
+		guard = self.make()
+		release = threading.Event()
+
+		with self.assertRaises(UpstreamTimeout):
+			guard.call(lambda: release.wait(timeout=2), 0.05)
+		release.set()
+		with self.assertRaises(UpstreamTimeout):
+			guard.call(lambda: "unreached", 0)
+		self.assertEqual(guard.stats()["timeouts"], 1)
+
+	def test_expired_budget_skips_upstream_and_breaker(self):
+		guard = self.make()
+		calls = []
+
+		for _ in range(5):
+			with self.assertRaises(UpstreamTimeout):
+				guard.call(lambda: calls.append(1), 1, budget=0)
+
+		self.assertEqual(calls, [])
+		self.assertEqual((guard.stats()["state"], guard.stats()["expired"]), ("closed", 5))
+		self.assertEqual(guard.call(lambda: "ok", 1), "ok")
+
+	def test_budget_cut_timeouts_do_not_open_or_reopen_the_breaker(self):
+		guard = self.make()
+		release = threading.Event()
+		self.addCleanup(release.set)
+
+		def fail():
+			raise RuntimeError("down")
+
+		for _ in range(3):
+			with self.assertRaises(UpstreamTimeout):
+				guard.call(lambda: release.wait(timeout=2), 1, budget=0.02)
+		self.assertEqual(guard.stats()["state"], "closed")
+
+		for _ in range(2):
+			with self.assertRaises(RuntimeError):
+				guard.call(fail, 1)
+		self.now = 11
+		with self.assertRaises(UpstreamTimeout):
+			guard.call(lambda: release.wait(timeout=2), 1, budget=0.02)
+		self.assertEqual(guard.stats()["opens"], 1)
+		release.set()
+		self.assertEqual(guard.call(lambda: "ok", 1), "ok")
+		self.assertEqual(guard.stats()["state"], "closed")
+
+
+class S3ListingIndexTests(unittest.TestCase):
+	def setUp(self):
+		self.now = 0.0
+		self.index = S3ListingIndex(ttl=10, full_refresh=100, max_images=5, clock=lambda: self.now)
+		self.keys = ["p/a.png", "p/b.txt", "p/c.png"]
+		self.calls = []
+
+	def lister(self, bucket, prefix, start_after=None):
+		self.calls.append(start_after)
+		keys = [k for k in self.keys if start_after is None or k > start_after]
+		images = [{"key": k} for k in keys if k.endswith(".png")]
+		return images, keys[-1] if keys else start_after
+
+	def test_refresh_lists_only_keys_after_last_seen(self):
+		self.assertEqual(self.index.images("b", "p/", self.lister), [{"key": "p/a.png"}, {"key": "p/c.png"}])
+		self.index.images("b", "p/", self.lister)
+
+		self.keys += ["p/d.png", "p/e.csv"]
+		self.now = 20
+		images = self.index.images("b", "p/", self.lister)
+
+		self.assertEqual([i["key"] for i in images], ["p/a.png", "p/c.png", "p/d.png"])
+		self.assertEqual(self.calls, [None, "p/c.png"])
+
+		self.now = 40
+		self.index.images("b", "p/", self.lister)
+		self.assertEqual(self.calls[-1], "p/e.csv")
+
+		self.now = 150
+		self.index.images("b", "p/", self.lister)
+		self.assertEqual(self.calls[-1], None)
+		self.assertEqual(self.index.stats()["full_lists"], 2)
+
+	def test_concurrent_refreshes_share_one_listing(self):
+		release = threading.Event()
+
+		def slow_lister(bucket, prefix, start_after=None):
+			release.wait(timeout=2)
+			return self.lister(bucket, prefix, start_after)
+
+		threads = [threading.Thread(target=self.index.images, args=("b", "p/", slow_lister)) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		time.sleep(0.05)
+		release.set()
+		for thread in threads:
+			thread.join(timeout=2)
+
+		self.assertEqual(self.calls, [None])
+		self.assertEqual(self.index.stats()["coalesced"], 3)
+
+	def test_evicts_least_recently_used_prefix(self):
+		self.index.images("b", "p/", self.lister)
+		self.index.images("b", "q/", self.lister)
+		self.index.images("b", "r/", self.lister)
+
+		self.assertEqual(self.index.stats(), {**self.index.stats(), "prefixes": 2, "images": 4, "evictions": 1})
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+	"""Path-style ListObjectsV2 stand-in: GET /<bucket>/?list-type=2&..."""
+
+	protocol_version = "HTTP/1.1"
+	keys: list = []
+	objects: dict = {}
+	page_size = 1000
+	requests: list = []
+	connections: set = set()
+
+	def do_GET(self):
+		parts = urllib.parse.urlsplit(self.path)
+		if not parts.query:
+			self.send_object(urllib.parse.unquote(parts.path).split("/", 2)[2])
+			return
+		query = urllib.parse.parse_qs(parts.query)
+		arg = {k: v[0] for k, v in query.items()}
+		type(self).requests.append(arg)
+		type(self).connections.add(self.client_address)
+		prefix = arg.get("prefix", "")
+		delimiter = arg.get("delimiter")
+		after = arg.get("continuation-token") or arg.get("start-after") or ""
+		max_keys = min(int(arg.get("max-keys", 1000)), self.page_size)
+
+		entries = []
+		for key in sorted(self.keys):
+			if not key.startswith(prefix):
+				continue
+			rest = key[len(prefix):]
+			if delimiter and delimiter in rest:
+				entry = ("prefix", prefix + rest.split(delimiter, 1)[0] + delimiter)
+			else:
+				entry = ("key", key)
+			if entry[1] > after and entry not in entries:
+				entries.append(entry)
+		page, truncated = entries[:max_keys], len(entries) > max_keys
+
+		parts = ['<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">']
+		parts.append(f"<Prefix>{escape(prefix)}</Prefix>")
+		for kind, value in page:
+			if kind == "key":
+				body = self.objects.get(value, b".")
+				etag = hashlib.md5(body).hexdigest()
+				parts.append(
+					f"<Contents><Key>{escape(value)}</Key><ETag>&quot;{etag}&quot;</ETag>"
+					f"<Size>{len(body)}</Size></Contents>"
+				)
+			else:
+				parts.append(f"<CommonPrefixes><Prefix>{escape(value)}</Prefix></CommonPrefixes>")
+		parts.append(f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>")
+		if truncated:
+			parts.append(f"<NextContinuationToken>{escape(page[-1][1])}</NextContinuationToken>")
+		parts.append("</ListBucketResult>")
+		body = "".join(parts).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/xml")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_object(self, key):
+		byte_range = self.headers.get("Range")
+		type(self).requests.append({"object": key, **({"range": byte_range} if byte_range else {})})
+		if key not in self.objects:
+			self.send_error(403)
+			return
+		body = self.objects[key]
+		if byte_range:
+			first, last = byte_range.removeprefix("bytes=").split("-")
+			start = max(len(body) - int(last), 0) if not first else int(first)
+			end = len(body) if not first or not last else int(last) + 1
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(body)}")
+			body = body[start:end]
+		else:
+			self.send_response(200)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, fmt, *args):
+		pass
+
+
+class S3ListingEngineTests(unittest.TestCase):
+	def setUp(self):
+		FakeS3Handler.keys = sorted(
+			[f"run/{a}/{b}/fig{i}.png" for a in "xyz" for b in "ab" for i in range(7)]
+			+ ["run/top.png", "run/notes.txt", "run/x/summary.svg", "run/z/b/zz.csv"]
+		)
+		FakeS3Handler.page_size = 3
+		FakeS3Handler.requests = []
+		FakeS3Handler.connections = set()
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		endpoint = f"http://127.0.0.1:{self.server.server_port}/{{bucket}}/"
+		self.patcher = patch.object(docdb_proxy, "S3_ENDPOINT", endpoint)
+		self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def expected(self):
+		return [k for k in FakeS3Handler.keys if k.endswith((".png", ".svg"))]
+
+	def test_fan_out_matches_serial_listing(self):
+		images, last_key = docdb_proxy._s3_list_objects("bucket", "run/")
+
+		self.assertEqual([i["key"] for i in images], self.expected())
+		self.assertEqual(last_key, FakeS3Handler.keys[-1])
+		self.assertEqual(images[1]["name"], "fig0.png")
+		self.assertTrue(images[1]["url"].endswith("/bucket/run/x/a/fig0.png"))
+		self.assertIn("/", {r.get("delimiter") for r in FakeS3Handler.requests})
+
+	def test_connections_are_reused(self):
+		docdb_proxy._s3_list_objects("bucket", "run/")
+
+		self.assertGreater(len(FakeS3Handler.requests), 10)
+		self.assertLessEqual(len(FakeS3Handler.connections), docdb_proxy.S3_LIST_WORKERS)
+		self.assertLess(len(FakeS3Handler.connections), len(FakeS3Handler.requests))
+
+	def test_incremental_listing_starts_after_last_key(self):
+		images, last_key = docdb_proxy._s3_list_objects("bucket", "run/", start_after="run/z/a/fig6.png")
+
+		self.assertEqual([i["key"] for i in images], [k for k in self.expected() if k > "run/z/a/fig6.png"])
+		self.assertEqual(last_key, "run/z/b/zz.csv")
+
+	def test_upstream_error_status_raises(self):
+		with patch.object(FakeS3Handler, "do_GET", lambda handler: handler.send_error(403)):
+			with self.assertRaises(urllib.error.HTTPError):
+				docdb_proxy._s3_list_objects("bucket", "run/")
+
+
+class ThumbnailCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.cache = ThumbnailCache(self.tmp.name, max_bytes=250)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_hits_are_served_from_disk(self):
+		digest = ThumbnailCache.digest("bucket", "a.png", 480)
+		self.cache.get_or_create(digest, lambda: (b"x" * 10, "image/webp"))
+
+		reopened = ThumbnailCache(self.tmp.name, max_bytes=250)
+		result = reopened.get_or_create(digest, lambda: self.fail("should be cached"))
+
+		self.assertEqual(result, (b"x" * 10, "image/webp"))
+		self.assertEqual(reopened.stats()["hits"], 1)
+
+	def test_evicts_least_recently_used_files(self):
+		for name in ("a", "b"):
+			self.cache.get_or_create(name, lambda: (b"x" * 100, "image/webp"))
+		self.cache.get_or_create("a", lambda: self.fail("should be cached"))
+		self.cache.get_or_create("c", lambda: (b"x" * 100, "image/webp"))
+
+		self.assertEqual(sorted(os.listdir(self.tmp.name)), ["a", "c"])
+		self.assertEqual(self.cache.stats()["evictions"], 1)
+
+
+@unittest.skipIf(Image is None, "Pillow not installed")
+class ThumbnailEndpointTests(ProxyServerTestCase):
+	bucket = "aind-analysis-prod-o5171v"
+
+	def setUp(self):
+		super().setUp()
+		image = io.BytesIO()
+		Image.new("RGB", (2000, 1000), "red").save(image, "PNG")
+		FakeS3Handler.objects = {"plots/fig.png": image.getvalue()}
+		FakeS3Handler.requests = []
+		self.s3 = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+		self.s3.daemon_threads = True
+		threading.Thread(target=self.s3.serve_forever, daemon=True).start()
+		self.tmp = tempfile.TemporaryDirectory()
+		endpoint = f"http://127.0.0.1:{self.s3.server_port}/{{bucket}}/"
+		self.patchers = [
+			patch.object(docdb_proxy, "S3_ENDPOINT", endpoint),
+			patch.object(docdb_proxy, "thumb_cache", ThumbnailCache(self.tmp.name, 10_000_000)),
+		]
+		for patcher in self.patchers:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+		self.s3.shutdown()
+		self.s3.server_close()
+		self.tmp.cleanup()
+		super().tearDown()
+
+	def fetch(self, query):
+		try:
+			response = urllib.request.urlopen(f"{self.base_url}/s3-thumb?{query}", timeout=5)
+		except urllib.error.HTTPError as error:
+			response = error
+		with response:
+			return response.status, response.headers["Content-Type"], response.read()
+
+	def test_thumbnail_is_downscaled_and_cached(self):
+		query = f"bucket={self.bucket}&key=plots/fig.png&w=300"
+
+		first = self.fetch(query)
+		second = self.fetch(query)
+
+		self.assertEqual(first, second)
+		status, content_type, data = first
+		self.assertEqual((status, content_type), (200, "image/webp"))
+		self.assertEqual(Image.open(io.BytesIO(data)).size, (320, 160))
+		self.assertEqual(FakeS3Handler.requests, [{"object": "plots/fig.png"}])
+
+	def test_overwritten_object_gets_a_new_thumbnail(self):
+		self.enterContext(patch.object(FakeS3Handler, "keys", ["plots/fig.png"]))
+		with patch.object(docdb_proxy, "s3_index", S3ListingIndex(10, 100, 100)):
+			_, listing = self.request(f"/s3-list?bucket={self.bucket}&prefix=plots")
+			first = self.fetch(listing["images"][0]["thumb_url"].split("?", 1)[1])
+		image = io.BytesIO()
+		Image.new("RGB", (1000, 1000), "blue").save(image, "PNG")
+		FakeS3Handler.objects["plots/fig.png"] = image.getvalue()
+		with patch.object(docdb_proxy, "s3_index", S3ListingIndex(10, 100, 100)):
+			_, relisted = self.request(f"/s3-list?bucket={self.bucket}&prefix=plots")
+			second = self.fetch(relisted["images"][0]["thumb_url"].split("?", 1)[1])
+
+		self.assertIn("&v=", listing["images"][0]["thumb_url"])
+		self.assertNotEqual(listing["images"][0]["thumb_url"], relisted["images"][0]["thumb_url"])
+		self.assertEqual(Image.open(io.BytesIO(first[2])).size, (480, 240))
+		self.assertEqual(Image.open(io.BytesIO(second[2])).size, (480, 480))
+
+	def test_rejects_unapproved_bucket_and_missing_object(self):
+		status, _, body = self.fetch("bucket=private&key=a.png")
+		self.assertEqual((status, json.loads(body)), (400, {"error": "Bucket not allowed: private"}))
+
+		status, _, body = self.fetch(f"loc=s3://{self.bucket}/plots/missing.png")
+		self.assertEqual((status, json.loads(body)), (404, {"error": "S3 object not found: plots/missing.png"}))
+
+	def test_s3_list_entries_carry_thumb_url(self):
+		images = [{"key": "plots/fig.png"}, {"key": "plots/diagram.svg"}]
+		with patch.object(DocDbProxyHandler, "_s3_list_images", return_value=images):
+			status, body = self.request(f"/s3-list?bucket={self.bucket}&prefix=plots")
+
+		self.assertEqual(status, 200)
+		self.assertEqual(
+			body["images"][0]["thumb_url"],
+			f"/s3-thumb?bucket={self.bucket}&key=plots%2Ffig.png&w=480",
+		)
+		self.assertIsNone(body["images"][1]["thumb_url"])
+
+
+class FakeCursor:
+	def __init__(self, connection):
+		self.connection = connection
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+	def execute(self, sql, args=None):
+		self.connection.queries.append((sql, args))
+
+	def fetchall(self):
+		return list(self.connection.rows)
+
+	def fetchmany(self, size):
+		self.connection.fetches += 1
+		batch = self.connection.rows[self.connection.offset:self.connection.offset + size]
+		self.connection.offset += len(batch)
+		return batch
+
+
+class FakeConnection:
+	def __init__(self, rows=(), alive=True):
+		self.rows = rows
+		self.alive = alive
+		self.closed = False
+		self.queries = []
+		self.cursor_classes = []
+		self.offset = 0
+		self.fetches = 0
+
+	def cursor(self, cursorclass=None):
+		self.cursor_classes.append(cursorclass)
+		return FakeCursor(self)
+
+	def ping(self, reconnect=True):
+		if not self.alive:
+			raise pymysql.err.OperationalError(2006, "gone away")
+
+	def close(self):
+		self.closed = True
+
+
+class LogServerPoolTests(unittest.TestCase):
+	def setUp(self):
+		self.now = 0.0
+		self.opened = []
+		self.pool = LogServerPool(self.connect, max_idle=2, idle_timeout=60, clock=lambda: self.now)
+
+	def connect(self, user, password):
+		if password == "bad":
+			raise pymysql.err.OperationalError(1045, "Access denied")
+		conn = FakeConnection()
+		self.opened.append((user, conn))
+		return conn
+
+	def test_reuses_connection_for_same_credentials_only(self):
+		with self.pool.connection("u", "p") as first:
+			pass
+		with self.pool.connection("u", "p") as second:
+			pass
+		with self.pool.connection("u", "other") as third:
+			pass
+
+		self.assertIs(first, second)
+		self.assertIsNot(first, third)
+		self.assertEqual(self.pool.stats()["reused"], 1)
+
+	def test_dead_and_idle_connections_are_replaced(self):
+		with self.pool.connection("u", "p") as first:
+			pass
+		first.alive = False
+		with self.pool.connection("u", "p") as second:
+			pass
+		self.now = 120
+		with self.pool.connection("u", "p") as third:
+			pass
+
+		self.assertTrue(first.closed and second.closed)
+		self.assertEqual(len({id(c) for c in (first, second, third)}), 3)
+
+	def test_failed_block_discards_connection(self):
+		with self.assertRaises(RuntimeError):
+			with self.pool.connection("u", "p") as conn:
+				raise RuntimeError("query failed")
+
+		self.assertTrue(conn.closed)
+		self.assertEqual(self.pool.stats()["idle"], 0)
+
+	def test_auth_error_invalidates_pooled_connections_for_user(self):
+		with self.pool.connection("u", "p") as old:
+			pass
+		with self.pool.connection("v", "p") as other_user:
+			pass
+
+		with self.assertRaises(LogServerConnectError) as ctx:
+			with self.pool.connection("u", "bad"):
+				pass
+		with self.pool.connection("u", "p") as fresh:
+			pass
+
+		self.assertEqual(ctx.exception.__cause__.args[0], 1045)
+		self.assertTrue(old.closed)
+		self.assertFalse(other_user.closed)
+		self.assertIsNot(fresh, old)
+		self.assertEqual(self.pool.stats()["invalidated"], 1)
+
+
+class CamstimCompletedTests(ProxyServerTestCase):
+	payload = {
+		"user": "test-user",
+		"password": "secret",
+		"startDate": "2026-01-01",
+		"endDate": "2026-01-02",
+	}
+
+	@staticmethod
+	def log_row(mid, action="Completed"):
+		return {
+			"datetime": None,
+			"client_address": "W10DT1 / 10.0.0.1",
+			"version": "1.0",
+			"message": f"MID, {mid}, UID, 9, Action, {action}, Duration_min, 5",
+		}
+
+	def test_repeat_queries_reuse_pooled_connection(self):
+		rows = [self.log_row(123)]
+		pool = LogServerPool(lambda u, p: FakeConnection(rows), max_idle=2, idle_timeout=60)
+
+		with patch.object(docdb_proxy, "log_server_pool", pool):
+			first = self.request("/log-server/camstim-completed", self.payload)
+			second = self.request("/log-server/camstim-completed", self.payload)
+
+		self.assertEqual(first, second)
+		self.assertEqual(first[1]["count"], 1)
+		self.assertEqual(first[1]["rows"][0]["instrument_id"], "W10DT1")
+		self.assertEqual(pool.stats()["created"], 1)
+		self.assertEqual(pool.stats()["reused"], 1)
+
+	def test_stream_mode_uses_unbuffered_cursor_and_trailing_summary(self):
+		rows = [self.log_row(i, "Completed" if i % 3 else "Started") for i in range(1, 8)]
+		conn = FakeConnection(rows)
+		pool = LogServerPool(lambda u, p: conn, max_idle=2, idle_timeout=60)
+		request = urllib.request.Request(
+			self.base_url + "/log-server/camstim-completed",
+			data=json.dumps({**self.payload, "table": "last_2week", "stream": True}).encode(),
+			headers={"Content-Type": "application/json"},
+		)
+
+		with (
+			patch.object(docdb_proxy, "log_server_pool", pool),
+			patch.object(docdb_proxy, "LOG_SERVER_STREAM_BATCH", 3),
+		):
+			with urllib.request.urlopen(request, timeout=2) as response:
+				lines = [json.loads(line) for line in response.read().splitlines()]
+
+		self.assertEqual([r["fields"]["MID"] for r in lines[:-1]], ["1", "2", "4", "5", "7"])
+		self.assertEqual(
+			lines[-1],
+			{"_meta": {"count": 5, "scanned": 7, "table": "last_2week", "complete": True}},
+		)
+		self.assertEqual(conn.cursor_classes, [pymysql.cursors.SSDictCursor])
+		self.assertEqual(conn.fetches, 4)
+
+	def test_stream_mode_maps_authentication_errors(self):
+		error = pymysql.err.OperationalError(1045, "Access denied")
+
+		with patch("pymysql.connect", side_effect=error):
+			status, body = self.request("/log-server/camstim-completed", {**self.payload, "stream": True})
+
+		self.assertEqual((status, body), (401, {"error": "Authentication failed"}))
+
+	def test_summary_buckets_by_instrument_subject_and_day(self):
+		rows = [
+			{**self.log_row(1), "datetime": datetime(2026, 1, 1, 9)},
+			{**self.log_row(1), "datetime": datetime(2026, 1, 1, 15), "message": (
+				"MID, 1, UID, 9, Action, Completed, Duration_min, 2.5, Long_frames, 3, Return_code, 1"
+			)},
+			{**self.log_row(1), "datetime": datetime(2026, 1, 2, 9)},
+			{**self.log_row(2, "Started"), "datetime": datetime(2026, 1, 1, 9)},
+		]
+		pool = LogServerPool(lambda u, p: FakeConnection(rows), max_idle=2, idle_timeout=60)
+
+		with patch.object(docdb_proxy, "log_server_pool", pool):
+			status, body = self.request("/log-server/camstim-summary", self.payload)
+
+		self.assertEqual(status, 200)
+		self.assertEqual(body["count"], 3)
+		self.assertEqual(body["buckets"], [
+			{
+				"instrument_id": "W10DT1", "mid": "1", "date": "2026-01-01", "count": 2,
+				"duration_min": 7.5, "long_frames": 3, "return_codes": {"": 1, "1": 1},
+			},
+			{
+				"instrument_id": "W10DT1", "mid": "1", "date": "2026-01-02", "count": 1,
+				"duration_min": 5.0, "long_frames": 0, "return_codes": {"": 1},
+			},
+		])
+
+
+class CamstimMirrorTests(ProxyServerTestCase):
+	payload = CamstimCompletedTests.payload
+
+	def setUp(self):
+		super().setUp()
+		self.tmp = tempfile.TemporaryDirectory()
+		self.now = 0.0
+		self.log = []
+		self.fetches = []
+		self.mirror = CamstimMirror(
+			os.path.join(self.tmp.name, "mirror.db"), "log_server", 60, self.fetch, clock=lambda: self.now
+		)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+		super().tearDown()
+
+	def add_event(self, when, mid, action="Completed"):
+		row = CamstimCompletedTests.log_row(mid, action)
+		self.log.append({**row, "datetime": datetime.fromisoformat(when)})
+
+	def fetch(self, req):
+		self.fetches.append((req["table"], req["start_date"], req["end_date"]))
+		start = datetime.fromisoformat(req["start_date"])
+		end = datetime.fromisoformat(req["end_date"])
+		raw = [r for r in self.log if start <= r["datetime"] < end]
+		yield docdb_proxy._camstim_completed_rows(raw), {"scanned": len(raw)}
+
+	def mids(self, start, end):
+		return [json.loads(r)["fields"]["MID"] for r in self.mirror.rows(start, end)]
+
+	def test_syncs_from_watermark_and_backfills_earlier_ranges(self):
+		self.add_event("2026-02-01T10:00:00", 1)
+		self.add_event("2026-02-03T09:00:00", 2)
+		self.add_event("2026-02-03T09:30:00", 3, "Started")
+		self.mirror.sync({**self.payload, "start_date": "2026-02-01"})
+		self.add_event("2026-02-04T08:00:00", 4)
+		self.mirror.sync({**self.payload, "start_date": "2026-02-02"})
+		self.now = 61
+		self.mirror.sync({**self.payload, "start_date": "2026-02-02"})
+		self.add_event("2026-01-15T12:00:00", 5)
+		self.mirror.sync({**self.payload, "start_date": "2026-01-01"})
+
+		self.assertEqual(self.fetches, [
+			("log_server", "2026-02-01", "9999-12-31"),
+			("log_server", "2026-02-03 09:00:00", "9999-12-31"),
+			("log_server", "2026-01-01", "2026-02-01"),
+		])
+		self.assertEqual(self.mids("2026-01-01", "2026-03-01"), ["4", "2", "1", "5"])
+		self.assertEqual(self.mids("2026-02-01", "2026-02-04"), ["2", "1"])
+		self.assertEqual(self.mirror.stats()["rows"], 4)
+		self.assertEqual(self.mirror.stats()["low"], "2026-01-01")
+
+	def test_endpoint_serves_mirrored_rows_after_auth_ping(self):
+		self.add_event("2026-01-01T10:00:00", 7)
+		pool = LogServerPool(lambda u, p: FakeConnection(), max_idle=2, idle_timeout=60)
+
+		with (
+			patch.object(docdb_proxy, "camstim_mirror", self.mirror),
+			patch.object(docdb_proxy, "log_server_pool", pool),
+		):
+			status, body = self.request("/log-server/camstim-completed", {**self.payload, "table": "last_2week"})
+			summary = self.request("/log-server/camstim-summary", {**self.payload, "table": "last_2week"})
+
+		self.assertEqual(status, 200)
+		self.assertEqual((body["count"], body["table"]), (1, "log_server"))
+		self.assertEqual((summary[0], summary[1]["table"]), (200, "log_server"))
+		self.assertEqual(self.fetches[0][0], "log_server")
+		self.assertEqual(body["rows"][0]["fields"]["MID"], "7")
+		self.assertEqual(body["rows"][0]["datetime"], "2026-01-01T10:00:00")
+		self.assertEqual(pool.stats()["created"], 2)
+
+	def test_revoked_password_is_refused_despite_pooled_connection(self):
+		self.add_event("2026-01-01T10:00:00", 7)
+		revoked = []
+
+		def connect(user, password):
+			if revoked:
+				raise pymysql.err.OperationalError(1045, "Access denied")
+			return FakeConnection()
+
+		pool = LogServerPool(connect, max_idle=2, idle_timeout=60)
+		with (
+			patch.object(docdb_proxy, "camstim_mirror", self.mirror),
+			patch.object(docdb_proxy, "log_server_pool", pool),
+		):
+			first = self.request("/log-server/camstim-completed", self.payload)
+			revoked.append(True)
+			second = self.request("/log-server/camstim-completed", self.payload)
+
+		self.assertEqual(first[0], 200)
+		self.assertEqual(second, (401, {"error": "Authentication failed"}))
+		self.assertEqual(pool.stats()["idle"], 0)
+
+	def test_covered_reads_do_not_wait_on_an_upstream_sync(self):
+		self.add_event("2026-02-01T10:00:00", 1)
+		self.mirror.sync({**self.payload, "start_date": "2026-02-01"})
+		fetching, release = threading.Event(), threading.Event()
+		fetch = self.mirror._fetch
+
+		def slow_fetch(req):
+			fetching.set()
+			self.assertTrue(release.wait(timeout=2))
+			yield from fetch(req)
+
+		self.mirror._fetch = slow_fetch
+		self.now = 61
+		refresh = threading.Thread(target=self.mirror.sync, args=({**self.payload, "start_date": "2026-02-01"},))
+		refresh.start()
+		self.assertTrue(fetching.wait(timeout=1))
+		fetching.clear()
+		started = time.monotonic()
+		self.mirror.sync({**self.payload, "start_date": "2026-02-01"})
+		mids = self.mids("2026-02-01", "2026-03-01")
+		elapsed = time.monotonic() - started
+		release.set()
+		refresh.join(timeout=2)
+
+		self.assertLess(elapsed, 0.5)
+		self.assertEqual(mids, ["1"])
+		self.assertFalse(fetching.is_set())
+		self.assertEqual(self.mirror.stats()["syncs"], 1)
+
+	def test_endpoint_rejects_bad_credentials_before_serving_mirror(self):
+		self.add_event("2026-01-01T10:00:00", 7)
+		self.mirror.sync({**self.payload, "start_date": "2026-01-01"})
+		error = pymysql.err.OperationalError(1045, "Access denied")
+
+		with (
+			patch.object(docdb_proxy, "camstim_mirror", self.mirror),
+			patch("pymysql.connect", side_effect=error),
+		):
+			status, body = self.request("/log-server/camstim-completed", {**self.payload, "password": "bad"})
+
+		self.assertEqual((status, body), (401, {"error": "Authentication failed"}))
+		self.assertEqual(self.mirror.stats()["served"], 0)
+
+
+class MetricsTests(ProxyServerTestCase):
+	def setUp(self):
+		super().setUp()
+		docdb_proxy.search_cache.clear()
+		self.patcher = patch.object(docdb_proxy, "metrics", ProxyMetrics())
+		self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		docdb_proxy.search_cache.clear()
+		super().tearDown()
+
+	def scrape(self):
+		with urllib.request.urlopen(self.base_url + "/metrics", timeout=2) as response:
+			self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+			samples = {}
+			for line in response.read().decode().splitlines():
+				if line and not line.startswith("#"):
+					name, value = line.rsplit(" ", 1)
+					samples[name] = float(value)
+			return samples
+
+	def test_histogram_buckets_are_cumulative(self):
+		histogram = Histogram("t_seconds", "test", ("route",), buckets=(0.1, 1))
+		for value in (0.05, 0.1, 0.5, 3):
+			histogram.observe(("/x",), value)
+
+		self.assertEqual(histogram.render()[2:], [
+			't_seconds_bucket{route="/x",le="0.1"} 2',
+			't_seconds_bucket{route="/x",le="1"} 3',
+			't_seconds_bucket{route="/x",le="+Inf"} 4',
+			't_seconds_sum{route="/x"} 3.650000',
+			't_seconds_count{route="/x"} 4',
+		])
+
+	def test_records_route_upstream_status_and_bytes(self):
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", return_value=[{"name": "a"}]):
+			self.request("/metadata/search", {"filter": {"metrics": 1}})
+			self.request("/metadata/search", {"filter": {"metrics": 1}})
+		self.request("/nowhere")
+
+		samples = self.scrape()
+
+		self.assertEqual(
+			samples['docdb_proxy_request_duration_seconds_count{route="/metadata/search",method="POST"}'], 2
+		)
+		self.assertEqual(samples['docdb_proxy_upstream_duration_seconds_count{upstream="docdb_v2"}'], 1)
+		self.assertEqual(samples['docdb_proxy_responses_total{route="/metadata/search",status="200"}'], 2)
+		self.assertEqual(samples['docdb_proxy_responses_total{route="other",status="404"}'], 1)
+		self.assertEqual(samples['docdb_proxy_response_bytes_total{route="/metadata/search"}'], 2 * len(b'[{"name": "a"}]'))
+		self.assertEqual(samples['docdb_proxy_serialize_duration_seconds_count{route="other"}'], 1)
+		self.assertEqual(samples['docdb_proxy_requests_in_flight{route="/metadata/search"}'], 0)
+		self.assertEqual(samples['docdb_proxy_requests_in_flight{route="/metrics"}'], 1)
+
+
+class TracingTests(ProxyServerTestCase):
+	def setUp(self):
+		super().setUp()
+		docdb_proxy.search_cache.clear()
+		self.patcher = patch.object(docdb_proxy, "SLOW_REQUEST_SECONDS", 0)
+		self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		docdb_proxy.search_cache.clear()
+		super().tearDown()
+
+	def slow_entries(self, *requests):
+		with self.assertLogs("docdb_proxy.slow", "WARNING") as logs:
+			for path, data in requests:
+				self.request(path, data)
+			deadline = time.monotonic() + 1
+			while len(logs.output) < len(requests) and time.monotonic() < deadline:
+				time.sleep(0.01)
+		return [json.loads(line.split(":", 2)[2]) for line in logs.output]
+
+	def test_slow_search_logs_canonical_filter_and_counts(self):
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", return_value=[{"n": 1}, {"n": 2}]):
+			(entry,) = self.slow_entries(
+				("/metadata/search", {"filter": {"b": 1, "a": {"$in": [2]}}, "limit": 5}),
+			)
+
+		self.assertEqual(entry["route"], "/metadata/search")
+		self.assertEqual(entry["status"], 200)
+		self.assertEqual(entry["filter"], '{"a":{"$in":[2]},"b":1}')
+		self.assertEqual((entry["limit"], entry["records"], entry["cache"]), (5, 2, "miss"))
+		self.assertEqual(entry["bytes"], len(b'[{"n": 1}, {"n": 2}]'))
+		self.assertGreaterEqual(entry["ms"], entry["upstream_ms"])
+
+	def test_log_server_trace_omits_credentials(self):
+		pool = LogServerPool(lambda u, p: FakeConnection([]), max_idle=2, idle_timeout=60)
+
+		with patch.object(docdb_proxy, "log_server_pool", pool):
+			(entry,) = self.slow_entries(("/log-server/camstim-completed", CamstimCompletedTests.payload))
+
+		self.assertEqual(entry["start_date"], "2026-01-01")
+		self.assertNotIn("secret", json.dumps(entry))
+		self.assertNotIn("test-user", json.dumps(entry))
+
+	def test_profile_returns_collapsed_stacks_for_local_callers(self):
+		stop = threading.Event()
+
+		def busy_profile_target():
+			while not stop.is_set():
+				sum(range(1000))
+
+		worker = threading.Thread(target=busy_profile_target)
+		worker.start()
+		try:
+			with urllib.request.urlopen(self.base_url + "/debug/profile?seconds=0.2", timeout=2) as response:
+				stacks = response.read().decode().splitlines()
+		finally:
+			stop.set()
+			worker.join()
+		forwarded = urllib.request.Request(
+			self.base_url + "/debug/profile?seconds=1", headers={"X-Forwarded-For": "10.0.0.1"}
+		)
+		with self.assertRaises(urllib.error.HTTPError) as ctx:
+			urllib.request.urlopen(forwarded, timeout=2)
+
+		target = [line for line in stacks if "busy_profile_target" in line]
+		self.assertTrue(target)
+		self.assertTrue(target[0].split(" ")[-1].isdigit())
+		self.assertEqual(ctx.exception.code, 403)
+		self.assertEqual(self.request("/debug/profile?seconds=0")[0], 400)
+
 
 class SlowHandler(DocDbProxyHandler):
 	slow_request_started = threading.Event()
@@ -103,6 +1682,56 @@ class SlowHandler(DocDbProxyHandler):
 		super().do_GET()
 
 
+class StartupTests(ProxyServerTestCase):
+	def setUp(self):
+		docdb_proxy.search_cache.clear()
+		super().setUp()
+
+	def tearDown(self):
+		super().tearDown()
+		docdb_proxy.search_cache.clear()
+
+	def test_lazy_client_is_built_once_under_concurrency(self):
+		built = []
+
+		def build(host, version):
+			time.sleep(0.05)
+			built.append(version)
+			return type("Client", (), {"host": host, "api_version": version})()
+
+		lazy = LazyDocDbClient("docdb.example", "v2")
+		with patch("aind_data_access_api.document_db.MetadataDbClient", side_effect=build):
+			self.assertFalse(lazy.built)
+			threads = [threading.Thread(target=lazy.get) for _ in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join(timeout=2)
+
+		self.assertEqual(built, ["v2"])
+		self.assertEqual((lazy.built, lazy.api_version, lazy.version), (True, "v2", "v2"))
+
+	def test_readyz_waits_for_warmup_of_searches_and_prefixes(self):
+		query = {"filter": {"subject.subject_id": "1"}, "limit": 10}
+		warm = Warmup([query], ["s3://aind-analysis-prod-o5171v/plots"], timeout=2)
+		index = S3ListingIndex(60, 900, 100)
+		with patch.object(docdb_proxy, "warmup", warm), patch.object(docdb_proxy, "s3_index", index):
+			self.assertEqual(self.request("/healthz"), (200, {"status": "ok"}))
+			status, body = self.request("/readyz")
+			self.assertEqual((status, body["ready"]), (503, False))
+
+			listing = ([{"key": "plots/a.png"}], "plots/a.png")
+			with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", return_value=[{"name": "a"}]):
+				with patch.object(docdb_proxy, "_s3_list_objects", return_value=listing):
+					warm.run()
+			status, body = self.request("/readyz")
+
+		self.assertEqual((status, body["ready"]), (200, True))
+		self.assertEqual((body["searches"], body["s3_prefixes"], body["errors"]), (1, 1, 0))
+		self.assertEqual(docdb_proxy.search_cache.stats()["entries"], 1)
+		self.assertEqual(index.stats()["images"], 1)
+
+
 class ProxyConcurrencyTests(ProxyServerTestCase):
 	handler_class = SlowHandler
 
@@ -135,6 +1764,188 @@ class ProxyConcurrencyTests(ProxyServerTestCase):
 		slow_thread.join(timeout=2)
 		self.assertEqual(slow_result["response"], (200, {"request": "slow"}))
 
+	def test_idle_keep_alive_connection_is_closed(self):
+		self.assertEqual(DocDbProxyHandler.timeout, docdb_proxy.KEEPALIVE_TIMEOUT)
+		with patch.object(SlowHandler, "timeout", 0.2):
+			connection = http.client.HTTPConnection("127.0.0.1", self.server.server_port, timeout=2)
+			self.addCleanup(connection.close)
+			status, _, body = self.exchange(connection, "GET", "/fast")
+			started = time.monotonic()
+			closed = connection.sock.recv(1)
+			elapsed = time.monotonic() - started
+
+		self.assertEqual((status, json.loads(body)), (200, {"request": "fast"}))
+		self.assertEqual(closed, b"")
+		self.assertLess(elapsed, 1.5)
+
+
+class AsyncProxyServerTestCase(ProxyServerTestCase):
+	limits = None
+	queue_timeout = None
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+		self.server = AsyncProxyServer(
+			"127.0.0.1", 0, self.handler_class, limits=self.limits, queue_timeout=self.queue_timeout
+		)
+		asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result(timeout=2)
+		self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+	def tearDown(self):
+		asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result(timeout=2)
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join(timeout=2)
+		self.loop.close()
+
+
+class AsyncProxyEndpointTests(AsyncProxyServerTestCase, ProxyEndpointTests):
+	"""The threaded endpoint tests, served by the asyncio core."""
+
+
+class AsyncCamstimCompletedTests(AsyncProxyServerTestCase, CamstimCompletedTests):
+	"""Includes chunked NDJSON streaming through the event loop."""
+
+
+class AsyncProxyServerTests(AsyncProxyServerTestCase):
+	handler_class = SlowHandler
+	limits = {"docdb_v1": 1, "docdb_v2": 1, "s3": 1, "mysql": 1, "local": 1}
+	queue_timeout = 0.2
+
+	def setUp(self):
+		SlowHandler.slow_request_started.clear()
+		SlowHandler.release_slow_request.clear()
+		super().setUp()
+
+	def tearDown(self):
+		SlowHandler.release_slow_request.set()
+		super().tearDown()
+
+	def test_keep_alive_reuses_one_connection(self):
+		conn = http.client.HTTPConnection("127.0.0.1", self.server.server_port, timeout=2)
+		try:
+			for _ in range(3):
+				conn.request("GET", "/fast")
+				response = conn.getresponse()
+				self.assertEqual(json.loads(response.read()), {"request": "fast"})
+			sock = conn.sock
+			conn.request("GET", "/fast")
+			conn.getresponse().read()
+			self.assertIs(conn.sock, sock)
+		finally:
+			conn.close()
+
+	def test_saturated_upstream_queues_then_answers_503(self):
+		slow_thread = threading.Thread(target=self.request, args=("/slow",))
+		slow_thread.start()
+		self.assertTrue(SlowHandler.slow_request_started.wait(timeout=1))
+
+		request = urllib.request.Request(self.base_url + "/fast")
+		with self.assertRaises(urllib.error.HTTPError) as ctx:
+			urllib.request.urlopen(request, timeout=2)
+		with patch.object(docdb_proxy.client_v2, "retrieve_docdb_records", return_value=[]):
+			status, body = self.request("/metadata/search", {"filter": {"busy": False}})
+
+		SlowHandler.release_slow_request.set()
+		slow_thread.join(timeout=2)
+		self.assertEqual(ctx.exception.code, 503)
+		self.assertEqual(ctx.exception.headers["Retry-After"], "1")
+		self.assertEqual(json.loads(ctx.exception.read()), {"error": "Upstream busy: local"})
+		self.assertEqual((status, body), (200, []))
+
+	def test_batch_searches_queue_apart_from_single_version_searches(self):
+		self.assertEqual(docdb_proxy._upstream_for("/metadata/search/batch"), "docdb_batch")
+		self.assertEqual(docdb_proxy._upstream_for("/metadata/search"), "docdb_v2")
+		self.assertEqual(docdb_proxy._upstream_for("/v1/metadata/search"), "docdb_v1")
+		self.assertIn("docdb_batch", docdb_proxy.UPSTREAM_LIMITS)
+
+
+class WorkerCountTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp.cleanup)
+		self.root = self.tmp.name
+
+	def write(self, name, text):
+		path = os.path.join(self.root, name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write(text)
+
+	def test_reads_cgroup_v2_and_v1_quotas(self):
+		self.assertIsNone(docdb_proxy._cgroup_cpu_quota(self.root))
+		self.write("cpu/cpu.cfs_quota_us", "200000\n")
+		self.write("cpu/cpu.cfs_period_us", "100000\n")
+		self.assertEqual(docdb_proxy._cgroup_cpu_quota(self.root), 2.0)
+		self.write("cpu.max", "max 100000\n")
+		self.assertIsNone(docdb_proxy._cgroup_cpu_quota(self.root))
+		self.write("cpu.max", "150000 100000\n")
+		self.assertEqual(docdb_proxy._cgroup_cpu_quota(self.root), 1.5)
+
+	def test_auto_follows_quota_and_is_capped(self):
+		with patch("os.sched_getaffinity", return_value=set(range(64))):
+			with patch.object(docdb_proxy, "_cgroup_cpu_quota", return_value=1.5):
+				self.assertEqual(docdb_proxy._worker_count("auto"), 2)
+			with patch.object(docdb_proxy, "_cgroup_cpu_quota", return_value=None):
+				self.assertEqual(docdb_proxy._worker_count("auto"), docdb_proxy.WORKER_AUTO_MAX)
+		self.assertEqual(docdb_proxy._worker_count("12"), 12)
+
+
+@unittest.skipUnless(os.path.exists(f"/proc/{os.getpid()}/task/{os.getpid()}/children"), "needs /proc children")
+class PreforkSupervisorTests(unittest.TestCase):
+	def setUp(self):
+		with socket.socket() as sock:
+			sock.bind(("127.0.0.1", 0))
+			self.port = sock.getsockname()[1]
+		self.proc = subprocess.Popen(
+			[sys.executable, "web/docdb_proxy.py", "--workers", "2", "--port", str(self.port)],
+			cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+		)
+
+	def tearDown(self):
+		if self.proc.poll() is None:
+			self.proc.kill()
+			self.proc.wait()
+
+	def workers(self):
+		with open(f"/proc/{self.proc.pid}/task/{self.proc.pid}/children") as f:
+			return set(f.read().split())
+
+	def wait_for(self, predicate, timeout=10):
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			result = predicate()
+			if result:
+				return result
+			time.sleep(0.05)
+		self.fail("timed out")
+
+	def serving(self):
+		try:
+			with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/metadata/cache-stats", timeout=2) as response:
+				return response.status == 200
+		except OSError:
+			return False
+
+	def test_reload_and_crash_restart_keep_serving(self):
+		self.wait_for(self.serving)
+		first = self.wait_for(lambda: len(self.workers()) == 2 and self.workers())
+
+		self.proc.send_signal(signal.SIGHUP)
+		reloaded = self.wait_for(lambda: not self.workers() & first and len(self.workers()) == 2 and self.workers())
+		self.assertTrue(self.serving())
+		crashed = next(iter(reloaded))
+		os.kill(int(crashed), signal.SIGKILL)
+		restarted = self.wait_for(lambda: crashed not in self.workers() and len(self.workers()) == 2 and self.workers())
+		self.assertTrue(self.serving())
+
+		self.proc.terminate()
+		self.assertEqual(self.proc.wait(timeout=10), 0)
+		self.assertEqual(len(restarted & reloaded), 1)
+
 
 if __name__ == "__main__":
 	unittest.main()
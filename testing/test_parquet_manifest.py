@@ -0,0 +1,111 @@
+import json
+import pathlib
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+from testing.test_docdb_proxy import FakeS3Handler
+
+if pyarrow is not None:
+	from scripts.build_parquet_manifest import LocalSource, S3Source, build_manifest, read_footer
+
+VERSION = "bdc-v0.39"
+
+
+def write_cache(root: pathlib.Path):
+	"""Lay out a small versioned cache: one partitioned table, one flat table and a broken file."""
+	base = root / "data-asset-cache" / VERSION
+	for asset, n in (("a1", 250), ("a2", 40)):
+		partition = base / "platform_pophys" / f"asset_name={asset}"
+		partition.mkdir(parents=True)
+		table = pyarrow.table({
+			"roi_id": list(range(n)),
+			"area": [float(i) * 1.5 for i in range(n)],
+			"contour": ["x" * 4000] * n,
+		})
+		pyarrow.parquet.write_table(
+			table, partition / "data.pqt", row_group_size=100, compression="none", use_dictionary=False,
+		)
+	sessions = pyarrow.table({
+		"session": ["s1", "s2", "s3"],
+		"start": [datetime(2025, 1, d) for d in (3, 1, 2)],
+	})
+	pyarrow.parquet.write_table(sessions, base / "platform_swdb_sessions.pqt")
+	(base / "broken.pqt").write_bytes(b"not parquet at all")
+	(root / "data-asset-cache" / "cache_versions.json").write_text(json.dumps([VERSION]))
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow not installed")
+class ParquetManifestTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.root = pathlib.Path(self.tmp.name)
+		write_cache(self.root)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_local_manifest_records_rows_row_groups_and_stats(self):
+		manifest = build_manifest(LocalSource(self.root), VERSION, workers=4)
+
+		pophys = manifest["tables"]["platform_pophys"]
+		self.assertEqual(pophys["rows"], 290)
+		self.assertEqual(pophys["schema"][0], ["roi_id", "int64"])
+		a1 = pophys["files"]["platform_pophys/asset_name=a1/data.pqt"]
+		self.assertEqual([rg["rows"] for rg in a1["row_groups"]], [100, 100, 50])
+		self.assertEqual(a1["row_groups"][2]["stats"]["roi_id"], [200, 249, 0])
+		self.assertNotIn("schema", a1)
+		self.assertNotIn("contour", a1["row_groups"][0]["stats"])
+		sessions = manifest["tables"]["platform_swdb_sessions"]["files"]["platform_swdb_sessions.pqt"]
+		self.assertEqual(sessions["row_groups"][0]["stats"]["start"][:2], ["2025-01-01T00:00:00", "2025-01-03T00:00:00"])
+		self.assertEqual(list(manifest["errors"]), ["broken.pqt"])
+		json.dumps(manifest)
+
+	def test_s3_stand_in_reads_only_footers(self):
+		FakeS3Handler.objects = {
+			path.relative_to(self.root).as_posix(): path.read_bytes()
+			for path in self.root.rglob("*") if path.is_file()
+		}
+		FakeS3Handler.keys = sorted(FakeS3Handler.objects)
+		FakeS3Handler.page_size = 2
+		FakeS3Handler.requests = []
+		server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+		server.daemon_threads = True
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		source = S3Source("bucket", f"http://127.0.0.1:{server.server_port}/{{bucket}}/")
+
+		manifest = build_manifest(source, VERSION, workers=4)
+
+		self.assertEqual(manifest, build_manifest(LocalSource(self.root), VERSION))
+		reads = [r for r in FakeS3Handler.requests if "object" in r]
+		self.assertTrue(all(r["range"].startswith("bytes=-") for r in reads))
+		size = len(FakeS3Handler.objects[f"data-asset-cache/{VERSION}/platform_pophys/asset_name=a1/data.pqt"])
+		self.assertGreater(size, 64 * 1024 * 10)
+
+	def test_long_footer_takes_a_second_range_read(self):
+		source = LocalSource(self.root)
+		key = f"data-asset-cache/{VERSION}/platform_pophys/asset_name=a1/data.pqt"
+		size = (self.root / key).stat().st_size
+		lengths = []
+		read_tail = source.read_tail
+		source.read_tail = lambda k, n: lengths.append(n) or read_tail(k, n)
+
+		meta = read_footer(source, key, size, guess=16)
+
+		self.assertEqual(meta.num_rows, 250)
+		self.assertEqual(len(lengths), 2)
+		self.assertLess(lengths[1], size)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,74 @@
+"""
+camstim_parser.py — Parser for camstim agent log messages.
+
+The camstim agent logs one "key, value, key, value, ..." message per event,
+with keys in varying orders and values that may themselves contain commas,
+so messages are split on ", <known key>" boundaries rather than on every
+comma. The log server may also HTML-escape the text.
+
+The /log-server endpoints only want 'Action, Completed' events, so besides
+``parse_message`` this module offers ``parse_completed``, which rejects other
+messages with a cheap pre-check before running the full parse.
+"""
+
+import html
+import re
+
+# Keys we expect in a camstim 'Action, Completed' message.
+KNOWN_KEYS = (
+    "MID", "UID", "Action", "Resource_ID", "Descriptive_name", "Mode",
+    "Checksum", "Json_checksum", "Duration_min", "Return_code",
+    "Long_frames", "Extra-long_frames", "Wheel_rotations",
+)
+
+_split = re.compile(
+    r",\s*(?=" + "|".join(re.escape(k) for k in KNOWN_KEYS) + r")\s*"
+).split
+
+# A chunk parses to Action=Completed only if the text has "Action", a comma
+# and "Completed" separated by nothing but whitespace.
+_completed_action = re.compile(r"Action\s*,\s*Completed").search
+
+
+def _parse_unescaped(msg: str) -> dict:
+    out: dict[str, str] = {}
+    for chunk in _split(", " + msg):
+        chunk = chunk.strip().strip(",").strip()
+        if not chunk:
+            continue
+        key, sep, val = chunk.partition(",")
+        if not sep:
+            continue
+        key = key.strip()
+        if key:
+            out[key] = val.strip().rstrip(",").strip()
+    return out
+
+
+def _unescape(msg: str) -> str:
+    # html.unescape is not idempotent ("&amp;lt;"), so it must run exactly once.
+    return html.unescape(msg) if "&" in msg else msg
+
+
+def parse_message(msg: str) -> dict:
+    """Parse one message into ``{key: value}``; later duplicates win."""
+    if not msg:
+        return {}
+    return _parse_unescaped(_unescape(msg))
+
+
+def may_be_completed(msg: str) -> bool:
+    """Cheap pre-check for 'Action, Completed' messages.
+
+    False guarantees ``parse_message(msg).get("Action") != "Completed"``;
+    True only means the full parse is needed.
+    """
+    return bool(msg) and _completed_action(_unescape(msg)) is not None
+
+
+def parse_completed(msg: str) -> dict | None:
+    """Parse *msg* if its Action is Completed; return None for anything else."""
+    if not may_be_completed(msg):
+        return None
+    fields = parse_message(msg)
+    return fields if fields.get("Action") == "Completed" else None
@@ -5,33 +5,91 @@ docdb_proxy.py — Local HTTP proxy for server-side data services.
 Listens on :3001 and exposes:
   POST /metadata/search          {"filter": {...}, "limit": N, "projection": {...}}
   POST /v1/metadata/search       (DocDB v1 variant)
+  POST /metadata/search/batch    {"queries": [{"filter", "projection", "limit", "version"}, ...]}
+  POST /metadata/by-name         {"names": [...], "projection": {...}, "version": "v2"}
+  GET  /metadata/cache-stats     search result cache counters
+    (search accepts "stream": true or Accept: application/x-ndjson for
+    paginated NDJSON output resumable via "cursor", and "format": "arrow" |
+    "parquet" or the matching Accept type for flattened columnar output)
     GET  /s3-list                  public S3 image listing with bucket allow-list
-    POST /log-server/camstim-completed
+    GET  /s3-thumb                 cached thumbnail of a listed S3 image
+    POST /log-server/camstim-completed  (NDJSON with "stream": true)
+    POST /log-server/camstim-summary    per instrument/subject/day rollups
+    GET  /healthz  /readyz         liveness; readiness (503 until warm-up is done)
+    POST /cache-aggregate          {"query", "version", "params", "format"}: a named
+                                   aggregate over the cache Parquet (GET lists them)
+    (JSON search and /s3-list responses carry a strong ETag and answer a
+    matching If-None-Match with 304 Not Modified)
 
 DocDB requests use aind_data_access_api. S3 and log-server requests run
 server-side where the required network resources are accessible.
 
 Usage:
   python web/docdb_proxy.py    (or via `npm run docdb`)
+  python web/docdb_proxy.py --async    (asyncio core, bounded upstream concurrency)
+  python web/docdb_proxy.py --workers auto    (pre-forked workers, one per usable core)
 """
 
-import html
+import argparse
+import asyncio
+import bisect
+import contextlib
+import functools
+import hashlib
+import http
+import http.client
+import io
+import itertools
 import json
 import logging
+import math
+import os
 import re
+import select
+import sys
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
 import urllib.parse
-import urllib.request
 import xml.etree.ElementTree as ET
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from aind_data_access_api.document_db import MetadataDbClient
+try:
+    from camstim_parser import parse_completed
+except ImportError:  # imported as web.docdb_proxy (tests) rather than run from web/
+    from web.camstim_parser import parse_completed
 
 # pymysql is only needed by the /log-server endpoint. Import it lazily there so
 # a missing optional dependency can't crash the whole proxy at startup (which
-# would 502 every endpoint, including DocDB and S3 listing).
+# would 502 every endpoint, including DocDB and S3 listing). pyarrow (columnar
+# search output), Pillow (/s3-thumb) and duckdb (/cache-aggregate) are handled
+# the same way.
+# aind_data_access_api (which pulls in boto3) is imported when a DocDB client
+# is first used, so the port is bound before that cost is paid.
+
+_IMPORT_STARTED = time.monotonic()
 
 PORT = 3001
 HOST = "127.0.0.1"
+DOCDB_HOST = "api.allenneuraldynamics.org"
+
+# Optional warm-up, run on a background thread once the port is bound: both
+# DocDB clients are built, then WARMUP_SEARCHES ({"version", "filter",
+# "projection", "limit"}, exactly as the pages send them, so they land on
+# the same search cache keys) are replayed and WARMUP_S3_PREFIXES
+# ("s3://bucket/prefix/") are listed into the S3 index. GET /readyz answers
+# 503 until warm-up finishes or WARMUP_TIMEOUT passes; GET /healthz answers
+# 200 whenever the process is serving.
+WARMUP_SEARCHES: list[dict] = []
+WARMUP_S3_PREFIXES: list[str] = []
+WARMUP_TIMEOUT = 60
 
 LOG_SERVER_HOST = "eng-logtools"
 LOG_SERVER_PORT = 3306
@@ -39,12 +97,81 @@ LOG_SERVER_DATABASE = "mpe"
 LOG_SERVER_ALLOWED_TABLES = {"last_2week", "last_2month", "last_year", "log_server"}
 LOG_SERVER_CONNECT_TIMEOUT = 10
 LOG_SERVER_READ_TIMEOUT = 60
+LOG_SERVER_AUTH_ERROR_CODES = (1045, 1044, 1698)
+
+# Pooled log-server connections skip the TCP + MySQL auth handshake on
+# repeat queries (the sessions page issues one request per quarter).
+LOG_SERVER_POOL_MAX_IDLE = 4
+LOG_SERVER_POOL_IDLE_TIMEOUT = 300
+
+# Streamed camstim-completed responses read this many rows per fetch from an
+# unbuffered server-side cursor.
+LOG_SERVER_STREAM_BATCH = 500
+
+# Opt-in local mirror of camstim-completed rows. When set to a SQLite file
+# path, /log-server/camstim-completed authenticates the caller against the
+# log server, syncs new rows from CAMSTIM_MIRROR_SOURCE_TABLE (at most every
+# CAMSTIM_MIRROR_SYNC_INTERVAL seconds) and answers date ranges from the
+# local index instead of a LIKE scan on eng-logtools. The request's "table"
+# is ignored: every date range is read from the mirror, and responses report
+# CAMSTIM_MIRROR_SOURCE_TABLE as their "table".
+CAMSTIM_MIRROR_PATH = None
+CAMSTIM_MIRROR_SOURCE_TABLE = "log_server"
+CAMSTIM_MIRROR_SYNC_INTERVAL = 60
+
+# Every request gets one JSON trace line (route, status, timings, bytes and
+# the canonical filter/prefix/date range it asked for) on the
+# "docdb_proxy.trace" logger at TRACE_LOG_LEVEL. Requests slower than
+# SLOW_REQUEST_SECONDS go to "docdb_proxy.slow" at WARNING instead, written
+# to SLOW_QUERY_LOG_PATH when set. Long filters are cut at TRACE_MAX_CHARS.
+TRACE_LOG_LEVEL = logging.DEBUG
+TRACE_MAX_CHARS = 2000
+SLOW_REQUEST_SECONDS = 2.0
+SLOW_QUERY_LOG_PATH = None
 
 logging.basicConfig(level=logging.INFO, format="[docdb-proxy] %(message)s")
 log = logging.getLogger(__name__)
+trace_log = logging.getLogger("docdb_proxy.trace")
+slow_log = logging.getLogger("docdb_proxy.slow")
+if SLOW_QUERY_LOG_PATH:
+    _slow_handler = logging.FileHandler(SLOW_QUERY_LOG_PATH)
+    _slow_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_log.addHandler(_slow_handler)
+    slow_log.propagate = False
+
+
+class LazyDocDbClient:
+    """MetadataDbClient stand-in that builds the real client on first use.
+
+    Attribute access is forwarded to the client, which is imported and
+    constructed once under a lock, so concurrent first requests share it.
+    """
+
+    def __init__(self, host: str, version: str):
+        self.host = host
+        self.version = version
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from aind_data_access_api.document_db import MetadataDbClient
+
+                    self._client = MetadataDbClient(host=self.host, version=self.version)
+        return self._client
+
+    @property
+    def built(self) -> bool:
+        return self._client is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
 
-client_v2 = MetadataDbClient(host="api.allenneuraldynamics.org", version="v2")
-client_v1 = MetadataDbClient(host="api.allenneuraldynamics.org", version="v1")
+client_v2 = LazyDocDbClient(DOCDB_HOST, "v2")
+client_v1 = LazyDocDbClient(DOCDB_HOST, "v1")
 
 # The analysis-framework dashboard queries the DocDB `analysis` database
 # directly from the browser (that API is public + CORS-enabled), so no proxy
@@ -59,39 +186,669 @@ S3_LIST_ALLOWED_BUCKETS = {
 }
 S3_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp")
 S3_LIST_TIMEOUT = 30
+S3_ENDPOINT = "https://{bucket}.s3.amazonaws.com/"
 
-_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Full listings discover sub-prefixes with delimiter=/ this many levels deep
+# and list each level concurrently on S3_LIST_WORKERS threads, reusing up to
+# S3_POOL_MAX_IDLE keep-alive connections per bucket host.
+S3_LIST_FANOUT_DEPTH = 2
+S3_LIST_WORKERS = 16
+S3_POOL_MAX_IDLE = 16
+
+# /s3-thumb serves size-bounded derivatives of listed raster images from an
+# on-disk LRU cache, so figure grids don't pull full-resolution PNGs.
+# Requested widths round up to THUMB_WIDTH_STEP to bound cached variants.
+THUMB_CACHE_DIR = os.path.join(tempfile.gettempdir(), "zombie-s3-thumbs")
+THUMB_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+THUMB_DEFAULT_WIDTH = 480
+THUMB_MAX_WIDTH = 1600
+THUMB_WIDTH_STEP = 80
+THUMB_MAX_SOURCE_BYTES = 64 * 1024 * 1024
+THUMB_QUALITY = 80
+THUMB_SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+# /s3-list results are indexed per (bucket, prefix). Within S3_INDEX_TTL a
+# listing is served from memory; after that only keys past the last one seen
+# are listed, with a full re-list every S3_INDEX_FULL_REFRESH seconds.
+S3_INDEX_TTL = 60
+S3_INDEX_FULL_REFRESH = 15 * 60
+S3_INDEX_MAX_IMAGES = 500_000
+
+# Search result cache. Dashboards fan the same filter/projection/limit out
+# from many tabs within seconds, so identical searches are answered from memory
+# and concurrent misses share one upstream DocDB call.
+SEARCH_CACHE_MAX_BYTES = 256 * 1024 * 1024
+SEARCH_CACHE_TTL = 30
+SEARCH_CACHE_STALE_TTL = 300
+SEARCH_CACHE_STALE_IF_ERROR = 3600
 
-# Keys we expect in a camstim 'Action, Completed' message. The agent emits
-# them in varying orders, so we split on lookahead boundaries instead of
-# assuming a fixed sequence.
-_CAMSTIM_KNOWN_KEYS = (
-    "MID", "UID", "Action", "Resource_ID", "Descriptive_name", "Mode",
-    "Checksum", "Json_checksum", "Duration_min", "Return_code",
-    "Long_frames", "Extra-long_frames", "Wheel_rotations",
+# Conditional responses: JSON search results and /s3-list listings carry a
+# strong ETag over the body, and a matching If-None-Match gets a bodiless 304.
+# DocDB records change underneath us, so browsers revalidate searches after
+# the cache TTL; listings of write-once analysis outputs can be reused longer.
+SEARCH_CACHE_CONTROL = (
+    f"public, max-age={SEARCH_CACHE_TTL}, stale-while-revalidate={SEARCH_CACHE_STALE_TTL}"
 )
+SEARCH_VARY = "Accept"
+S3_LIST_CACHE_CONTROL = "public, max-age=300, stale-while-revalidate=3600"
+S3_LIST_VARY = "Accept-Encoding"
 
+# Streaming search mode pages through DocDB in _id order and writes each page
+# as NDJSON lines, so memory stays flat regardless of result size.
+SEARCH_STREAM_BATCH_SIZE = 200
+SEARCH_STREAM_MAX_BATCH_SIZE = 1000
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
 
-def _parse_camstim_message(msg: str) -> dict:
-    if not msg:
-        return {}
-    msg = html.unescape(msg)
-    key_alt = "|".join(re.escape(k) for k in _CAMSTIM_KNOWN_KEYS)
-    pattern = re.compile(rf",\s*(?={key_alt})\s*")
-    parts = pattern.split(", " + msg)
-    out: dict[str, str] = {}
-    for chunk in parts:
-        chunk = chunk.strip().strip(",").strip()
-        if not chunk:
-            continue
-        idx = chunk.find(",")
-        if idx == -1:
-            continue
-        key = chunk[:idx].strip()
-        val = chunk[idx + 1:].strip().rstrip(",").strip()
-        if key:
-            out[key] = val
-    return out
+# Columnar search output, negotiated via Accept or the body's "format" field.
+ARROW_STREAM_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+COLUMNAR_FORMATS = {
+    "arrow": ARROW_STREAM_CONTENT_TYPE,
+    "parquet": PARQUET_CONTENT_TYPE,
+}
+
+# POST /cache-aggregate runs one entry of CACHE_AGGREGATES, a fixed catalogue
+# of parameterized aggregates (clients never send SQL), with an embedded
+# DuckDB over the cache Parquet, so a heavy scan runs once here instead of in
+# every browser tab. Each entry reads one table under
+# CACHE_AGGREGATE_SOURCES[source]/<version>/; cache versions are immutable,
+# so results are memoized per (query, version, params) for
+# AGGREGATE_CACHE_TTL. Params are checked against the declared types: "name"
+# values (asset names) may be spliced into the table path, everything else is
+# bound as a DuckDB $parameter. GET /cache-aggregate lists the catalogue.
+CACHE_AGGREGATE_SOURCES = {
+    "data-asset-cache": {
+        "base": "https://allen-data-views.s3.us-west-2.amazonaws.com/data-asset-cache",
+        "version": None,
+    },
+    "dynamic-routing": {
+        "base": "https://aind-scratch-data.s3.us-west-2.amazonaws.com/dynamic-routing/cache/nwb_components",
+        "version": "v0.0.272",
+    },
+}
+CACHE_AGGREGATES = {
+    # dynamic_routing/player.js session list: one row per session.
+    "dr_sessions": {
+        "source": "dynamic-routing",
+        "table": "consolidated/performance.parquet",
+        "params": {},
+        "sql": """
+            SELECT
+                session_id,
+                ANY_VALUE(subject_id) AS subject_id,
+                ANY_VALUE(date)::VARCHAR AS session_date,
+                COUNT(*) AS n_blocks,
+                COUNT(DISTINCT rewarded_modality) AS n_mods,
+                SUM(n_trials) AS n_trials,
+                SUM(n_responses) AS n_responses,
+                SUM(n_contingent_rewards) AS n_rewards,
+                STRING_AGG(rewarded_modality, '' ORDER BY block_index) AS mod_seq,
+                AVG(cross_modality_dprime) AS mean_dprime
+            FROM {table}
+            GROUP BY session_id
+            ORDER BY session_date DESC, subject_id ASC
+        """,
+    },
+    # swdb/data.js loadRunning: running speed thinned to at most max_points.
+    "swdb_running": {
+        "source": "data-asset-cache",
+        "table": "platform_swdb_running/asset_name={asset}/data.pqt",
+        "params": {"asset": ("name", None), "max_points": ("int", 4000)},
+        "sql": """
+            WITH src AS (
+                SELECT timestamps, speed, row_number() OVER (ORDER BY timestamps) AS rn,
+                       count(*) OVER () AS n
+                FROM {table}
+            )
+            SELECT timestamps, speed
+            FROM src
+            WHERE rn % greatest(1, CAST(ceil(n / $max_points::DOUBLE) AS BIGINT)) = 0
+            ORDER BY timestamps
+        """,
+    },
+    # Per-kind event counts and time span for one SWDB asset.
+    "swdb_event_counts": {
+        "source": "data-asset-cache",
+        "table": "platform_swdb_events/asset_name={asset}/data.pqt",
+        "params": {"asset": ("name", None)},
+        "sql": """
+            SELECT kind, COUNT(*) AS n, MIN(t) AS first_t, MAX(t) AS last_t
+            FROM {table}
+            GROUP BY kind
+            ORDER BY kind
+        """,
+    },
+}
+AGGREGATE_MAX_INT = 1_000_000
+AGGREGATE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+AGGREGATE_CACHE_TTL = 24 * 3600
+AGGREGATE_CACHE_CONTROL = "public, max-age=3600"
+
+# /metadata/search/batch runs its sub-queries on a bounded pool; sub-queries
+# still running when the batch timeout passes are reported as 504 in place.
+SEARCH_BATCH_WORKERS = 16
+SEARCH_BATCH_MAX_QUERIES = 100
+SEARCH_BATCH_TIMEOUT = 60
+
+# DocDB calls run on DOCDB_CALL_WORKERS threads behind an UpstreamGuard per
+# API version. A call still running after the p95 of recent calls (at least
+# DOCDB_HEDGE_MIN_DELAY seconds) gets a duplicate and the first answer wins;
+# at most DOCDB_HEDGE_MAX_RATIO of calls are hedged. DOCDB_BREAKER_FAILURES
+# consecutive upstream errors open the breaker: calls fail fast with 503 for
+# DOCDB_BREAKER_COOLDOWN seconds, then one trial call decides whether it
+# closes. A call may take DOCDB_CALL_TIMEOUT seconds or whatever is left of
+# its request's admission deadline, whichever is less; only a call that ran
+# the full DOCDB_CALL_TIMEOUT counts as a breaker failure, and one whose
+# request has no budget left never reaches DocDB. Streamed searches are held
+# to the deadline only until their first page. While DocDB fails,
+# cached searches up to SEARCH_CACHE_STALE_IF_ERROR seconds old are served.
+DOCDB_CALL_WORKERS = 128
+DOCDB_CALL_TIMEOUT = 55
+DOCDB_HEDGE_MIN_DELAY = 0.5
+DOCDB_HEDGE_MAX_RATIO = 0.1
+DOCDB_HEDGE_WINDOW = 200
+DOCDB_HEDGE_MIN_SAMPLES = 20
+DOCDB_BREAKER_FAILURES = 5
+DOCDB_BREAKER_COOLDOWN = 30
+
+# /metadata/by-name merges lookups that arrive while an upstream lookup of the
+# same projection shape is already running into one {"name": {"$in": [...]}}
+# query. A lookup that finds nothing in flight is sent immediately.
+NAME_BATCH_WINDOW = 0.005
+NAME_BATCH_MAX_NAMES = 500
+
+# --async serving mode: requests queue on the event loop for a slot of the
+# upstream they block on, for at most UPSTREAM_QUEUE_TIMEOUT seconds before a
+# 503. The handler pool has one thread per slot; "local" covers routes that
+# only touch in-process state. /metadata/search/batch queues as "docdb_batch":
+# its sub-queries may go to either DocDB version, so it takes neither's slots.
+UPSTREAM_LIMITS = {
+    "docdb_v1": 8, "docdb_v2": 16, "docdb_batch": 4, "s3": 16, "mysql": 8, "parquet": 4, "local": 4,
+}
+UPSTREAM_QUEUE_TIMEOUT = 10
+ASYNC_MAX_BODY_BYTES = 16 * 1024 * 1024
+
+# Both serving cores close a keep-alive connection that stays idle for
+# KEEPALIVE_TIMEOUT seconds, so idle clients can't pin handler threads that
+# admission control never sees.
+KEEPALIVE_TIMEOUT = 75
+
+# --workers N: a supervisor pre-forks N workers that share the port through
+# SO_REUSEPORT. Retired workers get WORKER_GRACEFUL_TIMEOUT seconds to finish
+# in-flight requests; on reload, new workers have WORKER_READY_TIMEOUT
+# seconds to start listening before the old ones are retired anyway.
+# --workers auto starts one worker per usable core, where the container's
+# cgroup CPU quota (cpu.max, or cpu.cfs_quota_us on cgroup v1) also limits
+# usable cores, and never more than WORKER_AUTO_MAX: each worker keeps its
+# own search cache and DocDB call pool.
+WORKER_GRACEFUL_TIMEOUT = 30
+WORKER_READY_TIMEOUT = 10
+WORKER_RESTART_DELAY = 1
+WORKER_AUTO_MAX = 4
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Admission control runs before routing. Each route in ADMISSION_BULKHEADS
+# may have that many cost units in progress; further requests wait, taken
+# round-robin across clients, and are shed with 503 + Retry-After once their
+# estimated wait would outlast nginx's proxy_read_timeout for the route
+# (ADMISSION_DEADLINES, else ADMISSION_DEFAULT_DEADLINE). Each client
+# (X-Real-IP) also spends cost units from a token bucket refilled at
+# ADMISSION_CLIENT_RATE per second up to ADMISSION_CLIENT_BURST; requests
+# past it get 429. A request costs 1 unit, plus one per
+# ADMISSION_ROWS_PER_COST searched rows or ADMISSION_DAYS_PER_COST days of
+# camstim log, up to ADMISSION_MAX_COST; limit 0 (unbounded) costs the most.
+# State is per process, so each --workers worker admits independently.
+ADMISSION_BULKHEADS = {
+    "/metadata/search": 32, "/v1/metadata/search": 16, "/metadata/search/batch": 32,
+    "/metadata/by-name": 16, "/s3-list": 16, "/s3-thumb": 16,
+    "/log-server/camstim-completed": 8, "/log-server/camstim-summary": 8,
+    "/cache-aggregate": 4,
+}
+ADMISSION_DEADLINES = {"/log-server/camstim-completed": 120, "/log-server/camstim-summary": 120}
+ADMISSION_DEFAULT_DEADLINE = 60
+ADMISSION_QUEUE_MAX = 64
+ADMISSION_CLIENT_RATE = 20
+ADMISSION_CLIENT_BURST = 100
+ADMISSION_MAX_CLIENTS = 4096
+ADMISSION_ROWS_PER_COST = 1000
+ADMISSION_DAYS_PER_COST = 30
+ADMISSION_MAX_COST = 8
+
+# GET /metrics exposes Prometheus text-format metrics for this process (each
+# --workers process keeps its own). Routes outside METRICS_ROUTES are
+# labelled "other" to keep series bounded.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_ROUTES = frozenset({
+    "/metadata/search", "/v1/metadata/search", "/metadata/search/batch",
+    "/metadata/by-name", "/metadata/cache-stats", "/metrics",
+    "/s3-list", "/s3-thumb",
+    "/log-server/camstim-completed", "/log-server/camstim-summary",
+    "/debug/profile", "/healthz", "/readyz", "/cache-aggregate",
+})
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# GET /debug/profile?seconds=N samples every thread's stack for N seconds and
+# returns collapsed stacks ("frame;frame;frame count"), the input format of
+# flamegraph.pl and speedscope. Only one profile runs at a time, and only for
+# direct loopback callers (nginx does not route /debug).
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_CACHE_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def _label_pairs(names, values) -> str:
+    return ",".join(
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    )
+
+
+class Histogram:
+    """Prometheus-style histogram with one series per tuple of label values.
+
+    observe() finds the bucket with bisect before taking the lock, so the
+    critical section is two list updates.
+    """
+
+    def __init__(self, name, help_text, label_names, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            snapshot = sorted((k, list(v)) for k, v in self._series.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in snapshot:
+            pairs = _label_pairs(self.label_names, labels)
+            total = 0
+            for bound, n in zip((*self.buckets, "+Inf"), series):
+                total += n
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{pairs}{"," if pairs else ""}le="{le}"}} {total}')
+            lines.append(f"{self.name}_sum{{{pairs}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{pairs}}} {total}")
+        return lines
+
+
+class MetricCounter:
+    """Prometheus counter (or, with kind="gauge", a gauge) keyed by label values."""
+
+    def __init__(self, name, help_text, label_names, kind="counter"):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(
+            f"{self.name}{{{_label_pairs(self.label_names, labels)}}} {value:g}"
+            for labels, value in snapshot
+        )
+        return lines
+
+
+class ProxyMetrics:
+    """Request, upstream and serialization metrics exposed at /metrics."""
+
+    def __init__(self):
+        self.requests = Histogram(
+            "docdb_proxy_request_duration_seconds",
+            "Time to handle a request, including any streamed body.",
+            ("route", "method"),
+        )
+        self.upstream_seconds = Histogram(
+            "docdb_proxy_upstream_duration_seconds",
+            "Time spent in blocking DocDB, S3 and MySQL calls.",
+            ("upstream",),
+        )
+        self.serialize_seconds = Histogram(
+            "docdb_proxy_serialize_duration_seconds",
+            "Time spent JSON-encoding response bodies.",
+            ("route",),
+        )
+        self.responses = MetricCounter(
+            "docdb_proxy_responses_total", "Responses by route and status code.", ("route", "status")
+        )
+        self.response_bytes = MetricCounter(
+            "docdb_proxy_response_bytes_total", "Response body bytes by route.", ("route",)
+        )
+        self.in_flight = MetricCounter(
+            "docdb_proxy_requests_in_flight", "Requests currently being handled.", ("route",), kind="gauge"
+        )
+        self.admission_wait_seconds = Histogram(
+            "docdb_proxy_admission_wait_seconds",
+            "Time admitted requests waited for room in their route's bulkhead.",
+            ("route",),
+        )
+        self.shed = MetricCounter(
+            "docdb_proxy_shed_total", "Requests refused by admission control.", ("route", "reason")
+        )
+        self.startup_seconds = MetricCounter(
+            "docdb_proxy_startup_seconds",
+            "Seconds from module import and from process start to listening, and spent in warm-up.",
+            ("phase",),
+            kind="gauge",
+        )
+
+    @contextlib.contextmanager
+    def upstream(self, name: str):
+        """Time the enclosed blocking call as upstream *name*."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.upstream_seconds.observe((name,), elapsed)
+            trace = getattr(_trace_local, "fields", None)
+            if trace is not None:
+                trace["upstream_s"] = trace.get("upstream_s", 0.0) + elapsed
+
+    def render(self) -> bytes:
+        families = (
+            self.requests, self.upstream_seconds, self.serialize_seconds,
+            self.responses, self.response_bytes, self.in_flight,
+            self.admission_wait_seconds, self.shed, self.startup_seconds,
+        )
+        return ("\n".join(line for f in families for line in f.render()) + "\n").encode()
+
+
+metrics = ProxyMetrics()
+
+# Trace fields for the request the current thread is handling; see
+# DocDbProxyHandler._observed. Upstream calls made on executor threads
+# (batch sub-queries, S3 fan-out) are not attributed.
+_trace_local = threading.local()
+
+
+def _trace_note(**fields):
+    """Attach fields to the current request's trace line, if one is being recorded."""
+    trace = getattr(_trace_local, "fields", None)
+    if trace is not None:
+        trace.update(fields)
+
+
+def _canonical(value) -> str:
+    """Key-sorted compact JSON, so equal filters log identically."""
+    text = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return text if len(text) <= TRACE_MAX_CHARS else text[:TRACE_MAX_CHARS] + "..."
+
+
+def _sample_stacks(seconds: float, interval: float) -> Counter:
+    """Count collapsed stacks of every other thread, sampled every *interval* seconds."""
+    me = threading.get_ident()
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+_profile_lock = threading.Lock()
+
+
+def _metrics_route(path: str) -> str:
+    """Bound label cardinality: known routes by path, everything else as "other"."""
+    path = path.split("?", 1)[0]
+    return path if path in METRICS_ROUTES else "other"
+
+
+# Deadline (time.monotonic) of the request the current thread is serving;
+# see DocDbProxyHandler._observed and _with_budget.
+_budget_local = threading.local()
+
+
+def _remaining_budget() -> float | None:
+    deadline = getattr(_budget_local, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _with_budget(deadline, fn, *args):
+    """Run *fn* on an executor thread under the submitting request's deadline."""
+    _budget_local.deadline = deadline
+    try:
+        return fn(*args)
+    finally:
+        _budget_local.deadline = None
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling the upstream while its circuit breaker is open."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} unavailable (circuit open), retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class UpstreamTimeout(TimeoutError):
+    """An upstream call ran past its deadline."""
+
+
+def _is_client_error(error: Exception) -> bool:
+    """True for HTTP 4xx from the upstream: the request was bad, not the upstream."""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500
+
+
+class UpstreamGuard:
+    """Hedged calls, a circuit breaker and deadlines for one blocking upstream.
+
+    :meth:`call` runs *fn* on *executor* and waits at most *timeout*
+    seconds. Once it has *min_samples* latencies, a call still running past
+    their p95 (never less than *hedge_min_delay*) gets a duplicate, and
+    whichever finishes first successfully is returned; the loser runs to
+    completion in the background. Hedges are paid from a budget that grows
+    by *hedge_max_ratio* per call. After *failures* consecutive errors the
+    breaker opens and calls raise UpstreamUnavailable for *cooldown*
+    seconds; then a single trial call closes it again or re-opens it.
+    HTTP 4xx errors count as successes for the breaker, and calls cut short
+    by the caller's own budget count as neither (see :meth:`call`).
+    """
+
+    def __init__(self, name, executor, hedge_min_delay, hedge_max_ratio, window, min_samples,
+                 failures, cooldown, clock=time.monotonic):
+        self.name = name
+        self._executor = executor
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.min_samples = min_samples
+        self.failures = failures
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latencies: deque = deque(maxlen=window)
+        self._hedge_budget = 1.0
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._stats = dict.fromkeys(
+            ("calls", "hedges", "hedge_wins", "timeouts", "expired", "rejected", "opens"), 0
+        )
+
+    def call(self, fn, timeout: float, budget: float | None = None):
+        """Return ``fn()``, hedged and bounded by *timeout*; see the class docstring.
+
+        *budget* is what is left of the caller's own deadline. With none left
+        the call raises UpstreamTimeout without touching the upstream or the
+        breaker. A call that times out on its budget before reaching
+        *timeout* says nothing about upstream health, so the breaker ignores
+        it (a half-open trial is handed to the next call).
+        """
+        limit = timeout if budget is None else min(timeout, budget)
+        if limit <= 0:
+            with self._lock:
+                self._stats["expired"] += 1
+            raise UpstreamTimeout(f"{self.name}: request deadline already passed")
+        trial = self._enter()
+        outcome = False
+        try:
+            result = self._hedged(fn, limit, hedge=not trial)
+            outcome = True
+            return result
+        except UpstreamTimeout:
+            outcome = None if limit < timeout else False
+            raise
+        except Exception as e:
+            outcome = _is_client_error(e)
+            raise
+        finally:
+            self._exit(outcome, trial)
+
+    def _enter(self) -> bool:
+        """Check the breaker; return True if this call is the half-open trial."""
+        with self._lock:
+            self._stats["calls"] += 1
+            self._hedge_budget = min(10.0, self._hedge_budget + self.hedge_max_ratio)
+            if self._opened_at is None:
+                return False
+            remaining = self.cooldown - (self._clock() - self._opened_at)
+            if remaining > 0 or self._trial:
+                self._stats["rejected"] += 1
+                raise UpstreamUnavailable(self.name, max(1, math.ceil(remaining)))
+            self._trial = True
+            return True
+
+    def _exit(self, ok: bool | None, trial: bool):
+        """Record a call's outcome: True closes the breaker, False counts a failure, None neither."""
+        with self._lock:
+            if trial:
+                self._trial = False
+            if ok is None:
+                return
+            if ok:
+                self._consecutive_failures = 0
+                self._opened_at = None
+                return
+            self._consecutive_failures += 1
+            if trial or self._consecutive_failures >= self.failures:
+                if self._opened_at is None or trial:
+                    self._stats["opens"] += 1
+                self._opened_at = self._clock()
+
+    def _hedged(self, fn, timeout: float, hedge: bool):
+        deadline = self._clock() + timeout
+        futures = [self._submit(fn)]
+        delay = self._hedge_delay() if hedge else None
+        if delay is not None and delay < timeout:
+            wait(futures, timeout=delay)
+            if not futures[0].done() and self._take_hedge():
+                futures.append(self._submit(fn))
+                _trace_note(hedged=True)
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - self._clock()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        with self._lock:
+                            self._stats["hedge_wins"] += 1
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        with self._lock:
+            self._stats["timeouts"] += 1
+        raise UpstreamTimeout(f"{self.name} call exceeded {timeout:.1f}s")
+
+    def _submit(self, fn):
+        start = self._clock()
+        future = self._executor.submit(fn)
+        future.add_done_callback(lambda _: self._record(self._clock() - start))
+        return future
+
+    def _record(self, elapsed: float):
+        with self._lock:
+            self._latencies.append(elapsed)
+
+    def _hedge_delay(self) -> float | None:
+        with self._lock:
+            if not self._latencies or len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return max(self.hedge_min_delay, ordered[int(0.95 * (len(ordered) - 1))])
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._hedge_budget < 1:
+                return False
+            self._hedge_budget -= 1
+            self._stats["hedges"] += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = "closed" if self._opened_at is None else "half_open" if self._trial else "open"
+            return {**self._stats, "state": state, "consecutive_failures": self._consecutive_failures}
+
+
+docdb_call_executor = ThreadPoolExecutor(max_workers=DOCDB_CALL_WORKERS, thread_name_prefix="docdb-call")
+
+docdb_guards = {
+    version: UpstreamGuard(
+        f"docdb_{version}",
+        docdb_call_executor,
+        DOCDB_HEDGE_MIN_DELAY,
+        DOCDB_HEDGE_MAX_RATIO,
+        DOCDB_HEDGE_WINDOW,
+        DOCDB_HEDGE_MIN_SAMPLES,
+        DOCDB_BREAKER_FAILURES,
+        DOCDB_BREAKER_COOLDOWN,
+    )
+    for version in ("v1", "v2")
+}
+
+
+def _docdb_error_status(error: Exception) -> int:
+    """503 while the DocDB breaker is open, 504 past the deadline, else 500."""
+    if isinstance(error, UpstreamUnavailable):
+        return 503
+    if isinstance(error, UpstreamTimeout):
+        return 504
+    return 500
+
+
+def _docdb_retrieve(db_client, **kwargs):
+    """Fetch DocDB records through the version's UpstreamGuard."""
+    guard = docdb_guards[db_client.version]
+    with metrics.upstream(f"docdb_{db_client.version}"):
+        return guard.call(
+            functools.partial(db_client.retrieve_docdb_records, **kwargs), DOCDB_CALL_TIMEOUT, _remaining_budget()
+        )
 
 
 def _client_address_to_instrument(addr: str) -> str:
@@ -100,124 +857,2084 @@ def _client_address_to_instrument(addr: str) -> str:
     return addr.split(" / ", 1)[0].strip()
 
 
-# Legacy alias used by existing code paths
-client = client_v2
+def _camstim_completed_query(req: dict) -> tuple[str, tuple]:
+    """Return ``(sql, args)`` for camstim 'Action, Completed' rows in a date range."""
+    sql = (
+        f"SELECT datetime, client_address, version, message "
+        f"FROM {req['table']} "
+        "WHERE logname='camstim' AND level='INFO' "
+        "AND message LIKE %s "
+        "AND datetime >= %s AND datetime < %s "
+        "ORDER BY datetime DESC"
+    )
+    return sql, ("%Action, Completed%", req["start_date"], req["end_date"])
+
+
+def _camstim_completed_rows(raw_rows) -> list:
+    """Shape log rows for the client, keeping usable 'Action, Completed' events."""
+    out = []
+    for r in raw_rows:
+        parsed = parse_completed(r.get("message") or "")
+        if parsed is None:
+            continue
+        mid = (parsed.get("MID") or "").strip()
+        uid = (parsed.get("UID") or "").strip()
+        if not mid or mid.lower() == "none" or not uid or uid.lower() == "none":
+            continue
+        out.append({
+            "datetime": r["datetime"].isoformat() if r.get("datetime") else None,
+            "client_address": r.get("client_address") or "",
+            "instrument_id": _client_address_to_instrument(r.get("client_address") or ""),
+            "version": r.get("version") or "",
+            "fields": parsed,
+            "raw_message": r.get("message") or "",
+        })
+    return out
+
+
+def _iter_camstim_completed(req: dict):
+    """Yield ``(rows, {"scanned": n})`` batches from an unbuffered cursor.
+
+    Rows are parsed and filtered as they arrive, so memory stays bounded by
+    LOG_SERVER_STREAM_BATCH regardless of the date range. Closing the
+    generator early discards the connection, since an unbuffered cursor with
+    unread rows can't be reused.
+    """
+    import pymysql.cursors
+
+    scanned = 0
+    with log_server_pool.connection(req["user"], req["password"]) as conn:
+        with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+            with metrics.upstream("mysql"):
+                cur.execute(*_camstim_completed_query(req))
+            while True:
+                with metrics.upstream("mysql"):
+                    batch = cur.fetchmany(LOG_SERVER_STREAM_BATCH)
+                if not batch:
+                    break
+                scanned += len(batch)
+                yield _camstim_completed_rows(batch), {"scanned": scanned}
+
+
+class LogServerConnectError(Exception):
+    """Opening a log-server connection failed; the cause is chained."""
+
+
+def _is_log_server_auth_error(error) -> bool:
+    """True for MySQL access-denied errors (1045, 1044, 1698)."""
+    import pymysql
+
+    return (
+        isinstance(error, pymysql.err.OperationalError)
+        and bool(error.args)
+        and error.args[0] in LOG_SERVER_AUTH_ERROR_CODES
+    )
+
+
+def _log_server_connect(user: str, password: str):
+    import pymysql
+    import pymysql.cursors
+
+    with metrics.upstream("mysql"):
+        return pymysql.connect(
+            host=LOG_SERVER_HOST,
+            port=LOG_SERVER_PORT,
+            user=user,
+            password=password,
+            database=LOG_SERVER_DATABASE,
+            connect_timeout=LOG_SERVER_CONNECT_TIMEOUT,
+            read_timeout=LOG_SERVER_READ_TIMEOUT,
+            cursorclass=pymysql.cursors.DictCursor,
+        )
+
+
+class LogServerPool:
+    """Reusable eng-logtools connections, keyed by a digest of the credentials.
+
+    Only digests are used as keys and nothing is written to disk; a caller
+    gets a pooled connection only if it presents the same user and password
+    that opened it. Idle connections are pinged before reuse and closed once
+    idle for *idle_timeout* seconds. An access-denied error on connect drops
+    every idle connection for that user, whatever password opened it: MySQL
+    keeps existing sessions alive across a password change, so otherwise a
+    revoked password could still be served from the pool.
+    """
+
+    def __init__(self, connect, max_idle, idle_timeout, clock=time.monotonic):
+        self._connect = connect
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._idle: dict[str, list[tuple[float, object]]] = {}
+        self._user_keys: dict[str, set[str]] = {}
+        self._stats = dict.fromkeys(("created", "reused", "discarded", "invalidated"), 0)
+
+    @staticmethod
+    def _key(user: str, password: str) -> str:
+        return hashlib.sha256(f"{user}\0{password}".encode()).hexdigest()
+
+    @staticmethod
+    def _user_key(user: str) -> str:
+        return hashlib.sha256(user.encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def connection(self, user: str, password: str, fresh: bool = False):
+        """Yield a live connection; raise LogServerConnectError if none can be opened.
+
+        With *fresh*, a new connection is opened (so the credentials are
+        checked by the server) even when an idle one could be reused. The
+        connection goes back to the pool only if the block exits cleanly.
+        """
+        key = self._key(user, password)
+        with self._lock:
+            self._user_keys.setdefault(self._user_key(user), set()).add(key)
+        conn = None if fresh else self._checkout(key)
+        if conn is None:
+            try:
+                conn = self._connect(user, password)
+            except Exception as e:
+                if _is_log_server_auth_error(e):
+                    self.invalidate_user(user)
+                raise LogServerConnectError(str(e)) from e
+            with self._lock:
+                self._stats["created"] += 1
+        try:
+            yield conn
+        except BaseException:
+            self._close(conn)
+            raise
+        self._checkin(key, conn)
+
+    def _checkout(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                released_at, conn = idle.pop()
+            if self._clock() - released_at < self.idle_timeout:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    pass
+                else:
+                    with self._lock:
+                        self._stats["reused"] += 1
+                    return conn
+            self._close(conn)
+
+    def _checkin(self, key, conn):
+        now = self._clock()
+        expired = []
+        with self._lock:
+            for k in list(self._idle):
+                keep = [(t, c) for t, c in self._idle[k] if now - t < self.idle_timeout]
+                expired.extend(c for t, c in self._idle[k] if now - t >= self.idle_timeout)
+                if keep:
+                    self._idle[k] = keep
+                else:
+                    del self._idle[k]
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((now, conn))
+                conn = None
+        for c in expired + ([conn] if conn is not None else []):
+            self._close(c)
+
+    def invalidate_user(self, user: str):
+        """Close every idle connection opened for *user*."""
+        with self._lock:
+            dropped = [
+                entry
+                for key in self._user_keys.pop(self._user_key(user), ())
+                for entry in self._idle.pop(key, [])
+            ]
+            self._stats["invalidated"] += len(dropped)
+        for _, conn in dropped:
+            self._close(conn)
+
+    def _close(self, conn):
+        with self._lock:
+            self._stats["discarded"] += 1
+        with contextlib.suppress(Exception):
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "idle": sum(len(v) for v in self._idle.values())}
+
+
+def _log_server_auth_ping(user: str, password: str):
+    """Check *user*/*password* against the log server without running a query.
+
+    Always opens a fresh connection: a pooled session outlives a password
+    change, and mirrored rows never reach MySQL otherwise. The connection is
+    then pooled for the sync that follows. Raises LogServerConnectError.
+    """
+    with log_server_pool.connection(user, password, fresh=True):
+        pass
+
+
+class CamstimMirror:
+    """Local SQLite copy of shaped camstim 'Action, Completed' rows.
+
+    The mirror covers everything from *low* (the earliest start date asked
+    for so far) onwards. A request starting before *low* backfills the gap
+    from *source_table*; otherwise, at most every *sync_interval* seconds,
+    rows at or after the watermark (the newest mirrored datetime) are pulled
+    in. Rows are keyed by a digest of (datetime, client_address, message),
+    so re-reading the watermark second is harmless. Syncs use the requesting
+    caller's credentials through *fetch*; none are stored.
+
+    Upstream reads run outside the sync lock, which only guards planning a
+    sync and committing its rows: a request the mirror already covers never
+    waits on another request's fetch, and a refresh already in flight is not
+    started twice.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            digest TEXT PRIMARY KEY,
+            datetime TEXT NOT NULL,
+            instrument_id TEXT NOT NULL,
+            row TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_datetime ON events (datetime);
+        CREATE TABLE IF NOT EXISTS coverage (source TEXT PRIMARY KEY, low TEXT NOT NULL);
+    """
+
+    def __init__(self, path, source_table, sync_interval, fetch, clock=time.monotonic):
+        self.path = path
+        self.source_table = source_table
+        self.sync_interval = sync_interval
+        self._fetch = fetch
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._synced_at = None
+        self._refreshing = False
+        self._stats = dict.fromkeys(("syncs", "backfills", "added", "served"), 0)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(self._SCHEMA)
+
+    @contextlib.contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _coverage(self, db) -> tuple[str | None, str | None]:
+        low = db.execute("SELECT low FROM coverage WHERE source = ?", (self.source_table,)).fetchone()
+        (watermark,) = db.execute("SELECT max(datetime) FROM events").fetchone()
+        return (low[0] if low else None), watermark
+
+    def sync(self, req: dict):
+        """Extend the mirror to cover *req*'s start date and pull new rows if due."""
+        start = req["start_date"]
+        with self._sync_lock:
+            with self._db() as db:
+                low, watermark = self._coverage(db)
+            refresh = low is not None and not self._refreshing and (
+                self._synced_at is None or self._clock() - self._synced_at >= self.sync_interval
+            )
+            self._refreshing = self._refreshing or refresh
+        if low is None or start < low:
+            self._load(req, start, low or "9999-12-31", new_low=start)
+            with self._lock:
+                self._stats["backfills"] += 1
+            if low is None:
+                with self._sync_lock:
+                    self._synced_at = self._clock()
+        if refresh:
+            try:
+                # MySQL wants a space, not isoformat's "T", between date and time.
+                self._load(req, (watermark or low).replace("T", " "), "9999-12-31")
+            finally:
+                with self._sync_lock:
+                    self._refreshing = False
+            with self._sync_lock:
+                self._synced_at = self._clock()
+            with self._lock:
+                self._stats["syncs"] += 1
+
+    def _load(self, req, start, end, new_low=None):
+        source = {**req, "table": self.source_table, "start_date": start, "end_date": end}
+        entries = [self._entry(r) for rows, _ in self._fetch(source) for r in rows if r["datetime"]]
+        # One transaction per load, so readers never see a partial range;
+        # concurrent backfills may overlap, so coverage only ever moves down.
+        with self._sync_lock, self._db() as db:
+            cur = db.executemany("INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?)", entries)
+            if new_low is not None:
+                db.execute(
+                    "INSERT INTO coverage VALUES (?, ?) "
+                    "ON CONFLICT (source) DO UPDATE SET low = min(low, excluded.low)",
+                    (self.source_table, new_low),
+                )
+        with self._lock:
+            self._stats["added"] += max(cur.rowcount, 0)
+
+    @staticmethod
+    def _entry(row: dict) -> tuple:
+        digest = hashlib.sha256(
+            f"{row['datetime']}\0{row['client_address']}\0{row['raw_message']}".encode()
+        ).hexdigest()
+        return digest, row["datetime"], row["instrument_id"], json.dumps(row)
+
+    def rows(self, start_date: str, end_date: str) -> list[str]:
+        """Return JSON-encoded rows in ``[start_date, end_date)``, newest first."""
+        with self._db() as db:
+            rows = [
+                row for (row,) in db.execute(
+                    "SELECT row FROM events WHERE datetime >= ? AND datetime < ? "
+                    "ORDER BY datetime DESC",
+                    (start_date, end_date),
+                )
+            ]
+        with self._lock:
+            self._stats["served"] += 1
+        return rows
+
+    def stats(self) -> dict:
+        with self._db() as db:
+            low, watermark = self._coverage(db)
+            (count,) = db.execute("SELECT count(*) FROM events").fetchone()
+        with self._lock:
+            stats = dict(self._stats)
+        return {**stats, "rows": count, "low": low, "watermark": watermark}
+
+
+def _iter_camstim_mirror(req: dict):
+    """Yield ``(rows, {})`` pages from ``camstim_mirror`` after an auth ping and sync."""
+    _log_server_auth_ping(req["user"], req["password"])
+    camstim_mirror.sync(req)
+    rows = camstim_mirror.rows(req["start_date"], req["end_date"])
+    for i in range(0, len(rows), LOG_SERVER_STREAM_BATCH):
+        yield [json.loads(r) for r in rows[i:i + LOG_SERVER_STREAM_BATCH]], {}
+
+
+def _as_number(value) -> float:
+    """Parse a camstim numeric field; blanks, "None" and garbage count as 0."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return number if math.isfinite(number) else 0.0
+
+
+def _add_to_bucket(bucket: dict, fields: dict):
+    bucket["count"] += 1
+    bucket["duration_min"] += _as_number(fields.get("Duration_min"))
+    bucket["long_frames"] += int(_as_number(fields.get("Long_frames")))
+    code = (fields.get("Return_code") or "").strip()
+    bucket["return_codes"][code] = bucket["return_codes"].get(code, 0) + 1
+
+
+def _summarize_camstim(pages) -> dict:
+    """Fold camstim-completed row pages into per (instrument_id, MID, date) buckets.
+
+    Single pass over ``(rows, meta)`` pages, so only the buckets are held in
+    memory. Each bucket has the event count, total Duration_min, total
+    Long_frames and a Return_code histogram.
+    """
+    buckets: dict[tuple, dict] = {}
+    count = 0
+    for rows, _ in pages:
+        for row in rows:
+            fields = row["fields"]
+            key = (row["instrument_id"], fields.get("MID", ""), (row["datetime"] or "")[:10])
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = {
+                    "count": 0, "duration_min": 0.0, "long_frames": 0, "return_codes": {},
+                }
+            _add_to_bucket(bucket, fields)
+        count += len(rows)
+    return {
+        "buckets": [
+            {
+                "instrument_id": instrument_id, "mid": mid, "date": date,
+                **bucket, "duration_min": round(bucket["duration_min"], 3),
+            }
+            for (instrument_id, mid, date), bucket in sorted(buckets.items())
+        ],
+        "count": count,
+    }
+
+
+def _iter_search_pages(db_client, filter_query, projection, limit, cursor, batch_size):
+    """Yield ``(page, {"cursor": last_id})`` in ``_id`` order after *cursor*.
+
+    Each page is fetched with an ``_id > cursor`` bound rather than a skip
+    offset, so a page boundary can be resumed later from ``last_id``. A *limit*
+    of 0 reads until DocDB runs out of matches. ``_id`` is always fetched for
+    the cursor and dropped again if the caller's projection excluded it.
+    """
+    strip_id = bool(projection) and not projection.get("_id", 1)
+    if projection:
+        projection = {**projection, "_id": 1}
+    remaining = limit or None
+    while remaining is None or remaining > 0:
+        query = filter_query or {}
+        if cursor is not None:
+            bound = {"_id": {"$gt": cursor}}
+            query = {"$and": [query, bound]} if query else bound
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        kwargs = dict(filter_query=query, sort={"_id": 1}, limit=size)
+        if projection:
+            kwargs["projection"] = projection
+        page = _docdb_retrieve(db_client, **kwargs)
+        if not page:
+            return
+        cursor = page[-1]["_id"]
+        if strip_id:
+            for record in page:
+                record.pop("_id", None)
+        yield page, {"cursor": cursor}
+        if remaining is not None:
+            remaining -= len(page)
+        if len(page) < size:
+            return
+
+
+def _lift_deadline_after_first(pages):
+    """Yield *pages*, dropping the request deadline once the first is out.
+
+    A streamed search holds its first page to the request's admission
+    deadline (nothing has reached the client yet); later pages may run well
+    past it, so each only gets the per-call DOCDB_CALL_TIMEOUT.
+    """
+    try:
+        for page in pages:
+            yield page
+            _budget_local.deadline = None
+    finally:
+        pages.close()
+
+
+class _ConnectionPool:
+    """Idle keep-alive HTTP(S) connections, reused per (scheme, host).
+
+    Connections return to the pool only after their response was read to
+    the end. A reused connection that the server has since closed is retried
+    once on a fresh one.
+    """
+
+    def __init__(self, max_idle, timeout):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, str], list] = {}
+
+    @contextlib.contextmanager
+    def get(self, url: str):
+        """Yield the response to GET *url*; non-200 raises ``HTTPError``."""
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        for attempt in (0, 1):
+            conn, reused = self._acquire(host)
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused or attempt:
+                    raise
+        try:
+            if resp.status != 200:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            yield resp
+            resp.read()
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _acquire(self, host):
+        with self._lock:
+            idle = self._idle.get(host)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = host
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(netloc, timeout=self.timeout), False
+
+
+s3_pool = _ConnectionPool(S3_POOL_MAX_IDLE, S3_LIST_TIMEOUT)
+s3_executor = ThreadPoolExecutor(max_workers=S3_LIST_WORKERS, thread_name_prefix="s3-list")
+
+
+_S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+def _parse_list_page(stream, base: str, images: list, sub_prefixes: list):
+    """Parse one ListObjectsV2 page incrementally, clearing each element.
+
+    Appends to *images* and *sub_prefixes*; returns
+    ``(last_key, next_token)`` where *next_token* is None on the last page.
+    """
+    last_key = token = None
+    truncated = False
+    for _, el in ET.iterparse(stream, events=("end",)):
+        tag = el.tag.removeprefix(_S3_NS)
+        if tag == "Contents":
+            key = el.findtext(f"{_S3_NS}Key")
+            if key:
+                last_key = key
+                if key.lower().endswith(S3_IMAGE_EXTENSIONS):
+                    images.append({
+                        "key": key,
+                        "url": base + urllib.parse.quote(key),
+                        "name": key.rsplit("/", 1)[-1],
+                        "etag": (el.findtext(f"{_S3_NS}ETag") or "").strip('"'),
+                    })
+            el.clear()
+        elif tag == "CommonPrefixes":
+            sub = el.findtext(f"{_S3_NS}Prefix")
+            if sub:
+                sub_prefixes.append(sub)
+            el.clear()
+        elif tag == "IsTruncated":
+            truncated = el.text == "true"
+        elif tag == "NextContinuationToken":
+            token = el.text
+    return last_key, token if truncated else None
+
+
+def _s3_list_prefix(base: str, prefix: str, delimiter=None, start_after=None):
+    """List one prefix page by page over pooled connections.
+
+    Returns ``(images, sub_prefixes, last_key)``; *sub_prefixes* is only
+    populated when *delimiter* is given.
+    """
+    images: list[dict] = []
+    sub_prefixes: list[str] = []
+    last_key = None
+    token = None
+
+    while True:
+        qs = {"list-type": "2", "prefix": prefix, "max-keys": "1000"}
+        if delimiter:
+            qs["delimiter"] = delimiter
+        if token:
+            qs["continuation-token"] = token
+        elif start_after:
+            qs["start-after"] = start_after
+        with metrics.upstream("s3"), s3_pool.get(base + "?" + urllib.parse.urlencode(qs)) as resp:
+            page_last, token = _parse_list_page(resp, base, images, sub_prefixes)
+        last_key = page_last or last_key
+        if not token:
+            break
+
+    return images, sub_prefixes, last_key
+
+
+def _s3_list_objects(bucket: str, prefix: str, start_after: str | None = None):
+    """Enumerate image objects under a bucket/prefix via the public S3 REST API.
+
+    Returns ``(images, last_key)`` with *images* sorted by key and
+    *last_key* the greatest key seen (image or not), suitable as the next
+    ``start-after``. A full listing first walks S3_LIST_FANOUT_DEPTH levels
+    of ``delimiter=/`` sub-prefixes, listing each level's prefixes
+    concurrently, so latency follows prefix depth rather than key count.
+    Incremental listings (*start_after*) are usually short and run serially.
+    """
+    base = S3_ENDPOINT.format(bucket=bucket)
+    if start_after:
+        images, _, last_key = _s3_list_prefix(base, prefix, start_after=start_after)
+        images.sort(key=lambda item: item["key"])
+        return images, last_key or start_after
+
+    images: list[dict] = []
+    last_keys = []
+    level = [prefix]
+    for depth in range(S3_LIST_FANOUT_DEPTH + 1):
+        delimiter = "/" if depth < S3_LIST_FANOUT_DEPTH else None
+        results = s3_executor.map(lambda p: _s3_list_prefix(base, p, delimiter), level)
+        level = []
+        for found, sub_prefixes, last_key in results:
+            images.extend(found)
+            level.extend(sub_prefixes)
+            if last_key:
+                last_keys.append(last_key)
+        if not level:
+            break
+
+    images.sort(key=lambda item: item["key"])
+    return images, max(last_keys, default=None)
+
+
+def _s3_fetch_object(bucket: str, key: str, max_bytes: int) -> bytes:
+    """Download one object over the pooled connections, up to *max_bytes*."""
+    url = S3_ENDPOINT.format(bucket=bucket) + urllib.parse.quote(key)
+    with metrics.upstream("s3"), s3_pool.get(url) as resp:
+        data = resp.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ValueError(f"Object larger than {max_bytes} bytes")
+    return data
+
+
+def _make_thumbnail(data: bytes, width: int) -> tuple[bytes, str]:
+    """Downscale an image to at most *width* pixels wide.
+
+    Returns ``(encoded, content_type)``: WebP when Pillow was built with it,
+    JPEG otherwise. Height is bounded to 4x the width for very tall figures.
+    """
+    from PIL import Image, features
+
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((width, width * 4))
+        out = io.BytesIO()
+        if features.check("webp"):
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            img.save(out, "WEBP", quality=THUMB_QUALITY, method=4)
+            return out.getvalue(), "image/webp"
+        img.convert("RGB").save(out, "JPEG", quality=THUMB_QUALITY, optimize=True)
+        return out.getvalue(), "image/jpeg"
+
+
+def _thumb_width(raw) -> int | None:
+    """Clamp a requested width and round it up to THUMB_WIDTH_STEP."""
+    try:
+        width = int(raw)
+    except (TypeError, ValueError):
+        return None
+    width = min(max(width, THUMB_WIDTH_STEP), THUMB_MAX_WIDTH)
+    return -(-width // THUMB_WIDTH_STEP) * THUMB_WIDTH_STEP
+
+
+def _thumb_url(bucket: str, key: str, etag: str | None = None) -> str | None:
+    """Return the /s3-thumb URL for a listed image, or None if not raster.
+
+    The object's ETag rides along as ``v``, so an overwritten object gets a
+    new URL (past browser caches) and a new thumbnail cache digest.
+    """
+    if not key.lower().endswith(THUMB_SOURCE_EXTENSIONS):
+        return None
+    qs = {"bucket": bucket, "key": key, "w": THUMB_DEFAULT_WIDTH}
+    if etag:
+        qs["v"] = etag
+    return f"/s3-thumb?{urllib.parse.urlencode(qs)}"
+
+
+class ThumbnailCache:
+    """Size-bounded on-disk cache of image derivatives.
+
+    Files are named by the digest of what they were derived from and hold the
+    content type on the first line. Recency is kept in memory and mirrored to
+    file mtimes, so LRU order survives a restart; the directory is scanned
+    lazily on first use. Concurrent requests for one digest share a single
+    derivation.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files: OrderedDict[str, int] | None = None
+        self._bytes = 0
+        self._inflight: dict[str, _Flight] = {}
+        self._stats = dict.fromkeys(("hits", "misses", "coalesced", "evictions"), 0)
+
+    @staticmethod
+    def digest(*parts) -> str:
+        return hashlib.sha256("\0".join(map(str, parts)).encode()).hexdigest()
+
+    def get_or_create(self, digest: str, make) -> tuple[bytes, str]:
+        """Return ``(data, content_type)``, calling *make* on a miss."""
+        path = os.path.join(self.directory, digest)
+        with self._lock:
+            self._scan()
+            cached = digest in self._files
+            if cached:
+                self._files.move_to_end(digest)
+        if cached:
+            try:
+                with open(path, "rb") as f:
+                    content_type, data = f.read().split(b"\n", 1)
+                os.utime(path)
+                with self._lock:
+                    self._stats["hits"] += 1
+                return data, content_type.decode()
+            except (OSError, ValueError):
+                self._forget(digest)
+
+        with self._lock:
+            flight = self._inflight.get(digest)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[digest] = _Flight()
+                self._stats["misses"] += 1
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+        else:
+            try:
+                flight.value = make()
+                self._write(digest, path, *flight.value)
+            except Exception as e:
+                flight.error = e
+            with self._lock:
+                self._inflight.pop(digest, None)
+            flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _scan(self):
+        if self._files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        found.sort()
+        self._files = OrderedDict((name, size) for _, name, size in found)
+        self._bytes = sum(self._files.values())
+
+    def _write(self, digest, path, data, content_type):
+        payload = content_type.encode() + b"\n" + data
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        evict = []
+        with self._lock:
+            self._bytes += len(payload) - self._files.pop(digest, 0)
+            self._files[digest] = len(payload)
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                name, size = self._files.popitem(last=False)
+                self._bytes -= size
+                self._stats["evictions"] += 1
+                evict.append(name)
+        for name in evict:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.directory, name))
+
+    def _forget(self, digest):
+        with self._lock:
+            self._bytes -= self._files.pop(digest, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            files = len(self._files or ())
+            return {**self._stats, "files": files, "bytes": self._bytes}
+
+
+def _strong_etag(body: bytes) -> str:
+    return '"%s"' % hashlib.sha256(body).hexdigest()
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of *etag* against an If-None-Match header value.
+
+    nginx downgrades ETags to ``W/"..."`` when it gzips a response, so the
+    weakness prefix is ignored as RFC 9110 requires for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+class _Listing:
+    """Indexed images for one (bucket, prefix), plus the ETag last served for them."""
+
+    def __init__(self, images, last_key, now):
+        self.images = images
+        self.last_key = last_key
+        self.checked_at = now
+        self.full_at = now
+        self.etag = None
+
+
+class S3ListingIndex:
+    """Memory-bounded index of S3 image listings keyed by (bucket, prefix).
+
+    A listing younger than *ttl* is served as-is. An older one is refreshed
+    by listing only keys after the last key seen (``start-after``); analysis
+    outputs are written once under new keys, so that picks up new figures
+    without re-walking the prefix. Every *full_refresh* seconds the prefix
+    is re-listed from scratch to drop deleted keys and catch keys that sort
+    before the last one. Concurrent refreshes of one prefix share a single
+    listing, and least recently used prefixes are dropped once the index
+    holds more than *max_images* entries.
+    """
+
+    def __init__(self, ttl, full_refresh, max_images, clock=time.monotonic):
+        self.ttl = ttl
+        self.full_refresh = full_refresh
+        self.max_images = max_images
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._listings: OrderedDict[tuple[str, str], _Listing] = OrderedDict()
+        self._inflight: dict[tuple[str, str], _Flight] = {}
+        self._size = 0
+        self._stats = dict.fromkeys(
+            ("hits", "full_lists", "incremental_lists", "coalesced", "evictions"), 0
+        )
+
+    def images(self, bucket: str, prefix: str, lister) -> list:
+        """Return the sorted images under *prefix*, listing via *lister*.
+
+        *lister* has the signature of ``_s3_list_objects``.
+        """
+        key = (bucket, prefix)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is not None and self._clock() - listing.checked_at < self.ttl:
+                self._listings.move_to_end(key)
+                self._stats["hits"] += 1
+                return list(listing.images)
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._stats["coalesced"] += 1
+
+        if leader:
+            try:
+                flight.value = self._refresh(key, listing, lister)
+            except Exception as e:
+                flight.error = e
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return list(flight.value)
+
+    def etag(self, bucket: str, prefix: str) -> str | None:
+        """Return the ETag stored for a listing that is still fresh, or None."""
+        with self._lock:
+            listing = self._listings.get((bucket, prefix))
+            if listing is None or self._clock() - listing.checked_at >= self.ttl:
+                return None
+            return listing.etag
+
+    def set_etag(self, bucket: str, prefix: str, images: list, etag: str):
+        """Store *etag* for the indexed listing that *images* was copied from.
+
+        Refreshes build a new listing, and full ones new image dicts, so the
+        tag is dropped if the listing changed since *images* was returned.
+        """
+        with self._lock:
+            listing = self._listings.get((bucket, prefix))
+            if listing is None or len(listing.images) != len(images):
+                return
+            if images and (listing.images[0] is not images[0] or listing.images[-1] is not images[-1]):
+                return
+            listing.etag = etag
+
+    def _refresh(self, key, listing, lister) -> list:
+        now = self._clock()
+        if listing is None or now - listing.full_at >= self.full_refresh:
+            images, last_key = lister(*key)
+            fresh = _Listing(images, last_key, now)
+            stat = "full_lists"
+        else:
+            new, last_key = lister(*key, start_after=listing.last_key)
+            # Everything listed after last_key sorts after every indexed key.
+            fresh = _Listing(listing.images + new, last_key, now)
+            fresh.full_at = listing.full_at
+            stat = "incremental_lists"
+
+        with self._lock:
+            self._stats[stat] += 1
+            old = self._listings.pop(key, None)
+            if old is not None:
+                self._size -= len(old.images)
+            if len(fresh.images) <= self.max_images:
+                self._listings[key] = fresh
+                self._size += len(fresh.images)
+            while self._size > self.max_images:
+                _, evicted = self._listings.popitem(last=False)
+                self._size -= len(evicted.images)
+                self._stats["evictions"] += 1
+        return fresh.images
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "prefixes": len(self._listings), "images": self._size}
+
+
+def _flatten_record(record: dict, prefix: str = "", out: dict | None = None) -> dict:
+    """Flatten nested objects into dotted keys, e.g. ``subject.subject_id``.
+
+    Lists stay whole leaf values; they are encoded by ``_records_to_table``.
+    """
+    if out is None:
+        out = {}
+    for key, value in record.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            _flatten_record(value, path + ".", out)
+        else:
+            out[path] = value
+    return out
+
+
+def _records_to_table(records: list):
+    """Build a pyarrow Table from DocDB records with dotted column names.
+
+    Columns appear in first-seen order and are null where a record lacks the
+    path. Columns holding lists, empty objects or mixed scalar types that
+    Arrow can't unify are stored as JSON text.
+    """
+    import pyarrow as pa
+
+    rows = [_flatten_record(r) for r in records]
+    columns = list(dict.fromkeys(k for row in rows for k in row))
+    arrays = []
+    for name in columns:
+        values = [row.get(name) for row in rows]
+        try:
+            if any(isinstance(v, (list, dict)) for v in values):
+                raise pa.ArrowInvalid("nested values")
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array(
+                [v if v is None or isinstance(v, str) else json.dumps(v) for v in values],
+                type=pa.string(),
+            ))
+    return pa.Table.from_arrays(arrays, names=columns)
+
+
+def _encode_table(table, fmt: str) -> bytes:
+    """Serialize *table* as an Arrow IPC stream or a Parquet file."""
+    import pyarrow as pa
+
+    sink = pa.BufferOutputStream()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, sink, compression="zstd")
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class _Flight:
+    """An in-progress upstream load that concurrent callers wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SearchResultCache:
+    """Byte-bounded LRU cache of encoded search responses.
+
+    Entries hold the encoded JSON body and its strong ETag, so eviction
+    accounts for real size and a hit skips re-serialization and hashing.
+    Loads are single-flight: callers asking for a key that is already being
+    fetched wait on the same upstream call. An entry past its TTL but inside
+    the stale window is served as-is while one background refresh replaces
+    it, and one up to *stale_if_error* seconds old is served in place of a
+    failed load.
+    """
+
+    def __init__(self, max_bytes, ttl, stale_ttl, stale_if_error=0, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stale_if_error = stale_if_error
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, bytes, str]] = OrderedDict()
+        self._inflight: dict[str, _Flight] = {}
+        self._bytes = 0
+        self._stats = dict.fromkeys(
+            ("hits", "stale_hits", "misses", "coalesced", "evictions", "errors", "stale_errors"), 0
+        )
+
+    @staticmethod
+    def make_key(version, filter_query, projection, limit) -> str:
+        """Canonical key: dict ordering in the request body must not matter."""
+        return json.dumps(
+            [version, filter_query, projection, limit],
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+
+    def get_or_load(self, key, loader):
+        """Return ``(body, status)`` for *key*, calling *loader* on a miss.
+
+        *status* is one of ``hit``, ``stale``, ``stale-error``, ``miss`` or
+        ``coalesced``.
+        Loader exceptions propagate to every caller waiting on that load.
+        """
+        body, _, status = self.get_with_etag(key, loader)
+        return body, status
+
+    def get_with_etag(self, key, loader):
+        """Like :meth:`get_or_load` but return ``(body, etag, status)``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            age = self._clock() - entry[0] if entry is not None else None
+            if age is not None and age < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[1], entry[2], "hit"
+            if age is not None and age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self._stats["stale_hits"] += 1
+                refresh = None
+                if key not in self._inflight:
+                    refresh = self._inflight[key] = _Flight()
+            else:
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+                    self._stats["misses"] += 1
+                else:
+                    self._stats["coalesced"] += 1
+                fallback = entry if age is not None and age < self.ttl + self.stale_if_error else None
+                entry = None
+
+        if entry is not None:
+            if refresh is not None:
+                threading.Thread(
+                    target=self._load, args=(key, loader, refresh), daemon=True
+                ).start()
+            return entry[1], entry[2], "stale"
+
+        if leader:
+            self._load(key, loader, flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            if fallback is None:
+                raise flight.error
+            with self._lock:
+                self._stats["stale_errors"] += 1
+            return fallback[1], fallback[2], "stale-error"
+        return *flight.value, "miss" if leader else "coalesced"
+
+    def _load(self, key, loader, flight):
+        try:
+            body = loader()
+            flight.value = body, _strong_etag(body)
+        except Exception as e:
+            flight.error = e
+        with self._lock:
+            self._inflight.pop(key, None)
+            if flight.error is None:
+                self._store(key, *flight.value)
+            else:
+                self._stats["errors"] += 1
+        flight.done.set()
+
+    def _store(self, key, body, etag):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        if len(body) > self.max_bytes:
+            return
+        self._entries[key] = (self._clock(), body, etag)
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+search_cache = SearchResultCache(
+    SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL, SEARCH_CACHE_STALE_IF_ERROR
+)
+
+
+class _NameGroup:
+    """Batching state for one (client version, projection) shape."""
+
+    def __init__(self):
+        self.pending: list[tuple[list[str], _Flight]] = []
+        self.scheduled = False
+        self.inflight = 0
+
+
+class NameLookupBatcher:
+    """DataLoader-style batcher that resolves asset names through DocDB.
+
+    Callers block in :meth:`lookup`. The first caller of an idle shape sends
+    its query straight away; callers that arrive while a query for that shape
+    is running are collected for *window* seconds and sent together, one
+    ``$in`` query per *max_names* names, then each caller gets back just the
+    names it asked for.
+    """
+
+    def __init__(self, window, max_names):
+        self.window = window
+        self.max_names = max_names
+        self._lock = threading.Lock()
+        self._groups: dict[str, _NameGroup] = {}
+        self._stats = {"lookups": 0, "batches": 0, "upstream_calls": 0}
+
+    def lookup(self, db_client, names: list[str], projection=None) -> dict:
+        """Return ``{name: record or None}`` for *names*."""
+        key = json.dumps([db_client.version, projection], sort_keys=True)
+        waiter = _Flight()
+        with self._lock:
+            self._stats["lookups"] += 1
+            group = self._groups.setdefault(key, _NameGroup())
+            group.pending.append((names, waiter))
+            leader = not group.scheduled
+            group.scheduled = True
+            delay = self.window if group.inflight else 0
+        if leader:
+            if delay:
+                time.sleep(delay)
+            self._flush(db_client, projection, group)
+        waiter.done.wait()
+        if waiter.error is not None:
+            raise waiter.error
+        return {name: waiter.value.get(name) for name in names}
+
+    def _flush(self, db_client, projection, group):
+        with self._lock:
+            batch, group.pending = group.pending, []
+            group.scheduled = False
+            group.inflight += 1
+            self._stats["batches"] += 1
+
+        names = list(dict.fromkeys(n for wanted, _ in batch for n in wanted))
+        found: dict = {}
+        error = None
+        try:
+            for i in range(0, len(names), self.max_names):
+                found.update(self._fetch(db_client, names[i:i + self.max_names], projection))
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                group.inflight -= 1
+
+        for _, waiter in batch:
+            waiter.value, waiter.error = found, error
+            waiter.done.set()
+
+    def _fetch(self, db_client, names, projection) -> dict:
+        # Records are matched back to callers by name, so it must be returned.
+        if projection and any(v for k, v in projection.items() if k != "_id"):
+            projection = {**projection, "name": 1}
+        elif projection:
+            projection = {k: v for k, v in projection.items() if k != "name"} or None
+        kwargs = dict(filter_query={"name": {"$in": names}}, limit=0)
+        if projection:
+            kwargs["projection"] = projection
+        with self._lock:
+            self._stats["upstream_calls"] += 1
+        out: dict = {}
+        for record in _docdb_retrieve(db_client, **kwargs):
+            out.setdefault(record.get("name"), record)
+        return out
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+class AdmissionRejected(Exception):
+    """A request refused by :class:`AdmissionController`; answer *status* with Retry-After."""
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Bulkhead:
+    """Cost units in use and waiting for one route."""
+
+    def __init__(self, capacity, deadline):
+        self.capacity = capacity
+        self.deadline = deadline
+        self.in_use = 0
+        self.queued = 0
+        self.waiters: OrderedDict[str, deque] = OrderedDict()
+        # Moving average of seconds per cost unit, learned from completions.
+        self.unit_seconds = 0.0
+
+
+class _Ticket:
+    """One request's claim on a bulkhead, returned by ``acquire``."""
+
+    def __init__(self, route, client, cost):
+        self.route = route
+        self.client = client
+        self.cost = cost
+        self.admitted = threading.Event()
+        self.started = None
+        self.waited = 0.0
+
+
+class AdmissionController:
+    """Per-route bulkheads, per-client token buckets and deadline-aware shedding.
+
+    :meth:`acquire` claims *cost* units of a route's bulkhead for a client.
+    When the bulkhead is full the request waits; freed units go to waiting
+    clients in round-robin order, so one client's burst queues behind its own
+    requests rather than everyone's, and a light request that fits is let in
+    ahead of a heavy one that does not. A request is refused with 503 if the
+    queue is full, if its estimated wait plus service time would pass the
+    route deadline, or if it is still waiting when that deadline comes; with
+    429 if its client's token bucket is short of *cost*. Routes without a
+    bulkhead are not limited.
+    """
+
+    def __init__(self, bulkheads, deadlines, default_deadline, queue_max,
+                 client_rate, client_burst, max_clients=ADMISSION_MAX_CLIENTS, clock=time.monotonic):
+        self._bulkheads = {
+            route: _Bulkhead(capacity, deadlines.get(route, default_deadline))
+            for route, capacity in bulkheads.items()
+        }
+        self.queue_max = queue_max
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._stats = dict.fromkeys(("admitted", "queued", "rate_limited", "shed"), 0)
+
+    def acquire(self, route: str, client: str, cost: int) -> _Ticket | None:
+        """Wait for room for the request; return a ticket for :meth:`release`.
+
+        Returns None for unlimited routes and raises AdmissionRejected when
+        the request is refused.
+        """
+        bulkhead = self._bulkheads.get(route)
+        if bulkhead is None:
+            return None
+        ticket = _Ticket(route, client, min(cost, bulkhead.capacity))
+        with self._lock:
+            now = self._clock()
+            self._spend(client, ticket.cost, now)
+            if not bulkhead.waiters and bulkhead.in_use + ticket.cost <= bulkhead.capacity:
+                self._admit(bulkhead, ticket, now)
+                return ticket
+            budget = self._queue_budget(bulkhead, ticket)
+            self._stats["queued"] += 1
+            bulkhead.waiters.setdefault(client, deque()).append(ticket)
+            bulkhead.queued += ticket.cost
+
+        arrived = now
+        if ticket.admitted.wait(budget):
+            ticket.waited = ticket.started - arrived
+            return ticket
+        with self._lock:
+            if ticket.started is not None:
+                ticket.waited = ticket.started - arrived
+                return ticket
+            self._dequeue(bulkhead, ticket)
+            self._refund(client, ticket.cost)
+            self._stats["shed"] += 1
+        raise AdmissionRejected(503, "deadline", max(1, math.ceil(budget)))
+
+    def _queue_budget(self, bulkhead: _Bulkhead, ticket: _Ticket) -> float:
+        """Seconds *ticket* may wait, or raise if it should be shed now (lock held)."""
+        service = ticket.cost * bulkhead.unit_seconds
+        ahead = max(0, bulkhead.in_use + bulkhead.queued + ticket.cost - bulkhead.capacity)
+        wait = ahead * bulkhead.unit_seconds / bulkhead.capacity
+        reason = None
+        if sum(len(q) for q in bulkhead.waiters.values()) >= self.queue_max:
+            reason = "queue_full"
+        elif wait + service > bulkhead.deadline:
+            reason = "deadline"
+        if reason is not None:
+            self._refund(ticket.client, ticket.cost)
+            self._stats["shed"] += 1
+            raise AdmissionRejected(503, reason, max(1, math.ceil(wait)))
+        return bulkhead.deadline - service
+
+    def release(self, ticket: _Ticket | None):
+        """Return *ticket*'s units and admit whichever waiters now fit."""
+        if ticket is None:
+            return
+        bulkhead = self._bulkheads[ticket.route]
+        with self._lock:
+            now = self._clock()
+            per_unit = (now - ticket.started) / ticket.cost
+            bulkhead.unit_seconds = per_unit if not bulkhead.unit_seconds else (
+                0.8 * bulkhead.unit_seconds + 0.2 * per_unit
+            )
+            bulkhead.in_use -= ticket.cost
+            self._drain(bulkhead, now)
+
+    def _drain(self, bulkhead: _Bulkhead, now: float):
+        progress = True
+        while progress and bulkhead.waiters:
+            progress = False
+            for client in list(bulkhead.waiters):
+                queue = bulkhead.waiters[client]
+                if bulkhead.in_use + queue[0].cost > bulkhead.capacity:
+                    continue
+                ticket = queue.popleft()
+                bulkhead.queued -= ticket.cost
+                if queue:
+                    bulkhead.waiters.move_to_end(client)
+                else:
+                    del bulkhead.waiters[client]
+                self._admit(bulkhead, ticket, now)
+                progress = True
+
+    def _admit(self, bulkhead: _Bulkhead, ticket: _Ticket, now: float):
+        bulkhead.in_use += ticket.cost
+        ticket.started = now
+        self._stats["admitted"] += 1
+        ticket.admitted.set()
+
+    def _dequeue(self, bulkhead: _Bulkhead, ticket: _Ticket):
+        queue = bulkhead.waiters[ticket.client]
+        queue.remove(ticket)
+        bulkhead.queued -= ticket.cost
+        if not queue:
+            del bulkhead.waiters[ticket.client]
+
+    def _spend(self, client: str, cost: int, now: float):
+        """Take *cost* tokens from *client*'s bucket or raise 429 (lock held)."""
+        tokens, updated = self._buckets.pop(client, (self.client_burst, now))
+        tokens = min(self.client_burst, tokens + (now - updated) * self.client_rate)
+        if tokens < cost:
+            self._buckets[client] = (tokens, now)
+            self._stats["rate_limited"] += 1
+            raise AdmissionRejected(429, "rate_limited", max(1, math.ceil((cost - tokens) / self.client_rate)))
+        self._buckets[client] = (tokens - cost, now)
+        if len(self._buckets) > self.max_clients:
+            # Least recently seen first; their buckets have refilled the most.
+            del self._buckets[next(iter(self._buckets))]
+
+    def _refund(self, client: str, cost: int):
+        tokens, updated = self._buckets.get(client, (self.client_burst, self._clock()))
+        self._buckets[client] = (min(self.client_burst, tokens + cost), updated)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "clients": len(self._buckets),
+                "routes": {
+                    route: {
+                        "in_use": b.in_use,
+                        "queued": b.queued,
+                        "capacity": b.capacity,
+                        "unit_ms": round(b.unit_seconds * 1000, 1),
+                    }
+                    for route, b in self._bulkheads.items()
+                    if b.in_use or b.queued
+                },
+            }
+
+
+name_batcher = NameLookupBatcher(NAME_BATCH_WINDOW, NAME_BATCH_MAX_NAMES)
+
+admission = AdmissionController(
+    ADMISSION_BULKHEADS,
+    ADMISSION_DEADLINES,
+    ADMISSION_DEFAULT_DEADLINE,
+    ADMISSION_QUEUE_MAX,
+    ADMISSION_CLIENT_RATE,
+    ADMISSION_CLIENT_BURST,
+)
+
+s3_index = S3ListingIndex(S3_INDEX_TTL, S3_INDEX_FULL_REFRESH, S3_INDEX_MAX_IMAGES)
+
+thumb_cache = ThumbnailCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES)
+
+log_server_pool = LogServerPool(
+    _log_server_connect, LOG_SERVER_POOL_MAX_IDLE, LOG_SERVER_POOL_IDLE_TIMEOUT
+)
+
+camstim_mirror = CamstimMirror(
+    CAMSTIM_MIRROR_PATH,
+    CAMSTIM_MIRROR_SOURCE_TABLE,
+    CAMSTIM_MIRROR_SYNC_INTERVAL,
+    _iter_camstim_completed,
+) if CAMSTIM_MIRROR_PATH else None
+
+# Shared by client_v1 and client_v2 so the proxy, not the number of queued
+# sub-queries, decides how many DocDB calls run at once.
+docdb_executor = ThreadPoolExecutor(
+    max_workers=SEARCH_BATCH_WORKERS, thread_name_prefix="docdb"
+)
+
+
+def _docdb_client(version: str):
+    """Return the MetadataDbClient for an API version, or None."""
+    return {"v1": client_v1, "v2": client_v2}.get(version)
+
+
+def _cached_search(db_client, filter_query, projection, limit):
+    """Run a search through ``search_cache``; return ``(body, etag, cache_status)``."""
+
+    def load():
+        kwargs = dict(filter_query=filter_query, limit=limit)
+        if projection:
+            kwargs["projection"] = projection
+        records = _docdb_retrieve(db_client, **kwargs)
+        _trace_note(records=len(records))
+        return json.dumps(records).encode()
+
+    key = search_cache.make_key(db_client.version, filter_query, projection, limit)
+    return search_cache.get_with_etag(key, load)
+
+
+aggregate_cache = SearchResultCache(AGGREGATE_CACHE_MAX_BYTES, AGGREGATE_CACHE_TTL, 0)
+_duckdb_lock = threading.Lock()
+_duckdb_connection = None
+
+
+def _aggregate_param(name: str, kind: str, value):
+    if kind == "int":
+        if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= AGGREGATE_MAX_INT:
+            raise ValueError(f"{name} must be an integer between 1 and {AGGREGATE_MAX_INT}")
+    elif not isinstance(value, str) or not _CACHE_NAME_RE.match(value):
+        raise ValueError(f"Invalid {name}: {value}")
+    return value
+
+
+def _resolve_aggregate(body: dict) -> tuple[str, str, dict]:
+    """Validate a /cache-aggregate body into ``(query, version, params)``.
+
+    Raises ValueError (a 400) for unknown queries, versions or params.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object")
+    name = body.get("query")
+    spec = CACHE_AGGREGATES.get(name) if isinstance(name, str) else None
+    if spec is None:
+        raise ValueError(f"Unknown query: {name}")
+    version = body.get("version") or CACHE_AGGREGATE_SOURCES[spec["source"]]["version"]
+    if not isinstance(version, str) or not _CACHE_NAME_RE.match(version):
+        raise ValueError(f"Invalid version: {version}")
+    given = body.get("params") or {}
+    if not isinstance(given, dict):
+        raise ValueError("params must be an object")
+    unknown = set(given) - set(spec["params"])
+    if unknown:
+        raise ValueError(f"Unknown params: {', '.join(sorted(unknown))}")
+    params = {}
+    for param, (kind, default) in spec["params"].items():
+        value = given.get(param, default)
+        if value is None:
+            raise ValueError(f"Missing param: {param}")
+        params[param] = _aggregate_param(param, kind, value)
+    return name, version, params
+
+
+def _duckdb_cursor():
+    """Return a cursor on the process-wide in-memory DuckDB (one per query thread)."""
+    global _duckdb_connection
+    import duckdb
+
+    with _duckdb_lock:
+        if _duckdb_connection is None:
+            _duckdb_connection = duckdb.connect()
+        return _duckdb_connection.cursor()
+
+
+def _run_aggregate(name: str, version: str, params: dict) -> bytes:
+    """Run one catalogue query and return the result as an Arrow IPC stream."""
+    spec = CACHE_AGGREGATES[name]
+    source = CACHE_AGGREGATE_SOURCES[spec["source"]]
+    url = f"{source['base']}/{version}/{spec['table'].format(**params)}"
+    sql = spec["sql"].format(table=f"read_parquet('{url}')")
+    bound = {k: v for k, v in params.items() if f"${k}" in sql}
+    with metrics.upstream("parquet"), contextlib.closing(_duckdb_cursor()) as cursor:
+        result = cursor.execute(sql, bound).arrow()
+        table = result.read_all() if hasattr(result, "read_all") else result
+    _trace_note(rows=table.num_rows)
+    return _encode_table(table, "arrow")
+
+
+def _reencode_aggregate(body: bytes, fmt: str) -> bytes:
+    import pyarrow as pa
+
+    table = pa.ipc.open_stream(body).read_all()
+    if fmt == "json":
+        return json.dumps(table.to_pylist(), default=str).encode()
+    return _encode_table(table, fmt)
+
+
+def _cached_aggregate(name: str, version: str, params: dict, fmt: str):
+    """Run a catalogue query through ``aggregate_cache``; return ``(body, etag, cache_status)``.
+
+    The Arrow result is memoized first and other formats are re-encoded
+    from it, so each (query, version, params) is scanned once.
+    """
+    key = json.dumps([name, version, params], sort_keys=True, separators=(",", ":"))
+
+    def arrow():
+        return aggregate_cache.get_with_etag(key, lambda: _run_aggregate(name, version, params))
+
+    if fmt == "arrow":
+        return arrow()
+    return aggregate_cache.get_with_etag(f"{key}|{fmt}", lambda: _reencode_aggregate(arrow()[0], fmt))
+
+
+def _aggregate_catalogue() -> dict:
+    return {
+        name: {
+            "source": spec["source"],
+            "version": CACHE_AGGREGATE_SOURCES[spec["source"]]["version"],
+            "params": {p: {"type": kind, "default": default} for p, (kind, default) in spec["params"].items()},
+        }
+        for name, spec in CACHE_AGGREGATES.items()
+    }
+
+
+def _run_search_batch(queries: list) -> bytes:
+    """Run sub-queries concurrently and encode ``{"results": [...]}`` in order.
+
+    Each result is ``{"status": 200, "records": [...]}`` or
+    ``{"status": <code>, "error": str}``; a failing or slow sub-query only
+    affects its own slot. Cached bodies are spliced in without re-encoding.
+    """
+    slots: list = [None] * len(queries)
+    futures = {}
+    deadline = getattr(_budget_local, "deadline", None)
+    for i, query in enumerate(queries):
+        if not isinstance(query, dict):
+            slots[i] = {"status": 400, "error": "Sub-query must be an object"}
+            continue
+        db_client = _docdb_client(query.get("version") or "v2")
+        filter_query = query.get("filter", {})
+        if db_client is None:
+            slots[i] = {"status": 400, "error": f"Invalid version: {query.get('version')}"}
+            continue
+        if not isinstance(filter_query, dict):
+            slots[i] = {"status": 400, "error": "filter must be an object"}
+            continue
+        future = docdb_executor.submit(
+            _with_budget,
+            deadline,
+            _cached_search,
+            db_client,
+            filter_query,
+            query.get("projection") or None,
+            query.get("limit", 1000),
+        )
+        futures[future] = i
+
+    done, _ = wait(futures, timeout=SEARCH_BATCH_TIMEOUT)
+    for future, i in futures.items():
+        if future not in done:
+            future.cancel()
+            slots[i] = {"status": 504, "error": "DocDB query timed out"}
+        elif future.exception() is not None:
+            log.error("DocDB batch sub-query %d failed: %s", i, future.exception())
+            slots[i] = {"status": _docdb_error_status(future.exception()), "error": str(future.exception())}
+        else:
+            slots[i] = b'{"status":200,"records":' + future.result()[0] + b"}"
+
+    parts = [s if isinstance(s, bytes) else json.dumps(s).encode() for s in slots]
+    return b'{"results":[' + b",".join(parts) + b"]}"
+
+
+def _search_cost(query) -> int:
+    limit = query.get("limit", 1000) if isinstance(query, dict) else None
+    if not isinstance(limit, int):
+        return 1
+    return ADMISSION_MAX_COST if limit <= 0 else 1 + limit // ADMISSION_ROWS_PER_COST
+
+
+def _date_span_days(body: dict) -> int:
+    try:
+        return (date.fromisoformat(body["endDate"]) - date.fromisoformat(body["startDate"])).days
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def _request_cost(route: str, body) -> int:
+    """Estimate the load of a request in admission cost units from its JSON body."""
+    if route in ("/metadata/search", "/v1/metadata/search"):
+        cost = _search_cost(body)
+    elif route == "/metadata/search/batch":
+        queries = body.get("queries") if isinstance(body, dict) else body
+        cost = sum(_search_cost(q) for q in queries) if isinstance(queries, list) else 1
+    elif route == "/metadata/by-name" and isinstance(body, dict) and isinstance(body.get("names"), list):
+        cost = 1 + len(body["names"]) // NAME_BATCH_MAX_NAMES
+    elif route.startswith("/log-server/") and isinstance(body, dict):
+        cost = 1 + _date_span_days(body) // ADMISSION_DAYS_PER_COST
+    else:
+        cost = 1
+    return max(1, min(cost, ADMISSION_MAX_COST))
+
+
+class Warmup:
+    """Pre-loads DocDB clients, hot searches and S3 listings after startup.
+
+    :meth:`run` builds both DocDB clients, then replays *searches* through
+    the search cache and lists *s3_prefixes* into the S3 index concurrently,
+    giving up on whatever is still running after *timeout* seconds.
+    Failures are logged and counted but do not hold back readiness.
+    """
+
+    def __init__(self, searches, s3_prefixes, timeout):
+        self.searches = searches
+        self.s3_prefixes = s3_prefixes
+        self.timeout = timeout
+        self.ready = threading.Event()
+        self.import_to_listen = None
+        self.process_to_listen = None
+        self._stats = {"searches": 0, "s3_prefixes": 0, "errors": 0, "seconds": None}
+
+    def start(self):
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            for lazy in (client_v1, client_v2):
+                lazy.get()
+            tasks = [functools.partial(self._search, q) for q in self.searches]
+            tasks += [functools.partial(self._list, loc) for loc in self.s3_prefixes]
+            if tasks:
+                with ThreadPoolExecutor(max_workers=min(len(tasks), 8), thread_name_prefix="warmup") as pool:
+                    futures = [pool.submit(task) for task in tasks]
+                    done, _ = wait(futures, timeout=self.timeout)
+                    errors = sum(1 for f in futures if f not in done or f.exception() is not None)
+                    self._stats["errors"] += errors
+        except Exception as e:
+            log.warning("Warm-up failed: %s", e)
+            self._stats["errors"] += 1
+        finally:
+            self._stats["seconds"] = round(time.monotonic() - start, 3)
+            metrics.startup_seconds.inc(("warmup",), self._stats["seconds"])
+            log.info("Warm-up finished in %.2fs (%s)", self._stats["seconds"], self._stats)
+            self.ready.set()
+
+    def _search(self, query: dict):
+        db_client = _docdb_client(query.get("version") or "v2")
+        try:
+            _cached_search(
+                db_client, query.get("filter", {}), query.get("projection") or None, query.get("limit", 1000)
+            )
+        except Exception as e:
+            log.warning("Warm-up search %s failed: %s", _canonical(query), e)
+            raise
+        self._stats["searches"] += 1
+
+    def _list(self, loc: str):
+        bucket, _, prefix = loc.removeprefix("s3://").partition("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        try:
+            s3_index.images(bucket, prefix, _s3_list_objects)
+        except Exception as e:
+            log.warning("Warm-up listing %s failed: %s", loc, e)
+            raise
+        self._stats["s3_prefixes"] += 1
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "ready": self.ready.is_set(),
+            "import_to_listen_s": self.import_to_listen,
+            "process_to_listen_s": self.process_to_listen,
+        }
+
+
+warmup = Warmup(WARMUP_SEARCHES, WARMUP_S3_PREFIXES, WARMUP_TIMEOUT)
+
+
+def _process_age() -> float | None:
+    """Seconds since this process started, from /proc (Linux only)."""
+    try:
+        with open("/proc/self/stat") as f:
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - started_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _on_listening(host, port, mode, worker):
+    """Report startup time and start warm-up once the port is bound.
+
+    import_to_listen covers this module's body; process_to_listen (Linux)
+    also covers interpreter start-up and imports, and for forked workers
+    is measured from the fork.
+    """
+    elapsed = round(time.monotonic() - _IMPORT_STARTED, 3)
+    age = _process_age()
+    warmup.import_to_listen = elapsed
+    warmup.process_to_listen = None if age is None else round(age, 2)
+    metrics.startup_seconds.inc(("import_to_listen",), elapsed)
+    if age is not None:
+        metrics.startup_seconds.inc(("process_to_listen",), age)
+    log.info(
+        "%s %d listening on %s:%d (%s), %.3fs after import, %s after process start",
+        "Worker" if worker else "Process", os.getpid(), host, port, mode, elapsed,
+        "?" if age is None else f"{age:.2f}s",
+    )
+    warmup.start()
+
+
+# Legacy alias used by existing code paths
+client = client_v2
+
+
+class DocDbProxyHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so streamed responses can use chunked transfer encoding. Every
+    # buffered response carries Content-Length, so keep-alive stays correct.
+    protocol_version = "HTTP/1.1"
+    # Socket timeout: an idle keep-alive connection is closed after this long.
+    timeout = KEEPALIVE_TIMEOUT
+
+    # Per-request metrics state, reset by _observed.
+    _route = "other"
+    _status = None
+    _sent_bytes = 0
+    _raw_body = None
+
+    def do_GET(self):
+        self._observed(self._route_get)
+
+    def do_POST(self):
+        self._observed(self._route_post)
+
+    def _observed(self, dispatch):
+        """Run *dispatch*, recording metrics and a trace line for the route."""
+        route = self._route = _metrics_route(self.path)
+        self._status = None
+        self._sent_bytes = 0
+        self._raw_body = None
+        _trace_local.fields = {}
+        _budget_local.deadline = time.monotonic() + ADMISSION_DEADLINES.get(route, ADMISSION_DEFAULT_DEADLINE)
+        metrics.in_flight.inc((route,))
+        start = time.perf_counter()
+        try:
+            self._admitted(dispatch)
+        finally:
+            _budget_local.deadline = None
+            elapsed = time.perf_counter() - start
+            metrics.in_flight.inc((route,), -1)
+            metrics.requests.observe((route, self.command), elapsed)
+            metrics.responses.inc((route, str(self._status)))
+            metrics.response_bytes.inc((route,), self._sent_bytes)
+            self._log_trace(route, elapsed, _trace_local.__dict__.pop("fields"))
+
+    def _admitted(self, dispatch):
+        """Run *dispatch* once admission control lets the request in, or refuse it."""
+        if self._route not in ADMISSION_BULKHEADS:
+            dispatch()
+            return
+        try:
+            body = json.loads(self._read_body()) if self.command == "POST" else None
+        except Exception:
+            body = None  # the route handler answers 400
+        cost = _request_cost(self._route, body)
+        client = self.headers.get("X-Real-IP") or self.client_address[0]
+        try:
+            ticket = admission.acquire(self._route, client, cost)
+        except AdmissionRejected as e:
+            metrics.shed.inc((self._route, e.reason))
+            _trace_note(cost=cost, shed=e.reason)
+            self._send_body(
+                e.status,
+                json.dumps({"error": f"Proxy overloaded ({e.reason}), retry later"}).encode(),
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            return
+        metrics.admission_wait_seconds.observe((self._route,), ticket.waited)
+        _trace_note(cost=cost, queued_ms=round(ticket.waited * 1000, 1))
+        try:
+            dispatch()
+        finally:
+            admission.release(ticket)
+
+    def _read_body(self) -> bytes:
+        """Read the request body once; later calls return the same bytes."""
+        if self._raw_body is None:
+            length = int(self.headers.get("Content-Length", 0))
+            self._raw_body = self.rfile.read(length) if length else b"{}"
+        return self._raw_body
+
+    def _log_trace(self, route: str, elapsed: float, fields: dict):
+        if route == "/debug/profile":
+            return
+        slow = elapsed >= SLOW_REQUEST_SECONDS
+        if not slow and not trace_log.isEnabledFor(TRACE_LOG_LEVEL):
+            return
+        entry = {
+            "route": route,
+            "method": self.command,
+            "status": self._status,
+            "ms": round(elapsed * 1000, 1),
+            "upstream_ms": round(fields.pop("upstream_s", 0.0) * 1000, 1),
+            "bytes": self._sent_bytes,
+            **fields,
+        }
+        line = json.dumps(entry, default=str)
+        if slow:
+            slow_log.warning(line)
+        else:
+            trace_log.log(TRACE_LOG_LEVEL, line)
 
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
 
-class DocDbProxyHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
+    def _route_get(self):
         if self.path.startswith("/s3-list"):
             self._handle_s3_list()
+        elif self.path.startswith("/s3-thumb"):
+            self._handle_s3_thumb()
+        elif self.path == "/metadata/cache-stats":
+            self._respond(200, {
+                **search_cache.stats(),
+                "by_name": name_batcher.stats(),
+                "s3_index": s3_index.stats(),
+                "thumbnails": thumb_cache.stats(),
+                "log_server_pool": log_server_pool.stats(),
+                "camstim_mirror": camstim_mirror.stats() if camstim_mirror else None,
+                "admission": admission.stats(),
+                "docdb": {version: guard.stats() for version, guard in docdb_guards.items()},
+                "aggregates": aggregate_cache.stats(),
+            })
+        elif self.path == "/metrics":
+            self._send_body(200, metrics.render(), PROMETHEUS_CONTENT_TYPE)
+        elif self.path == "/healthz":
+            self._respond(200, {"status": "ok"})
+        elif self.path == "/readyz":
+            ready = warmup.ready.is_set()
+            body = json.dumps({**warmup.stats(), "docdb": {v: g.stats()["state"] for v, g in docdb_guards.items()}})
+            self._send_body(200 if ready else 503, body.encode(), headers=None if ready else {"Retry-After": "1"})
+        elif self.path == "/cache-aggregate":
+            self._respond(200, {"queries": _aggregate_catalogue()})
+        elif self.path.startswith("/debug/profile"):
+            self._handle_profile()
         else:
             self._respond(404, {"error": "Not found"})
 
-    def do_POST(self):
+    def _route_post(self):
         if self.path == "/v1/metadata/search":
             self._handle_search(client_v1)
         elif self.path == "/metadata/search":
             self._handle_search(client_v2)
+        elif self.path == "/metadata/search/batch":
+            self._handle_search_batch()
+        elif self.path == "/metadata/by-name":
+            self._handle_by_name()
         elif self.path == "/log-server/camstim-completed":
             self._handle_camstim_completed()
+        elif self.path == "/log-server/camstim-summary":
+            self._handle_camstim_summary()
+        elif self.path == "/cache-aggregate":
+            self._handle_cache_aggregate()
         else:
             self._respond(404, {"error": "Not found"})
 
     def _handle_camstim_completed(self):
+        req = self._read_log_server_request()
+        if req is None:
+            return
         try:
-            length = int(self.headers.get("Content-Length", 0))
-            body = json.loads(self.rfile.read(length) if length else b"{}")
+            import pymysql  # noqa: F401
+        except ImportError:
+            self._respond(501, {"error": "Log server support unavailable (pymysql not installed)"})
+            return
+
+        _trace_note(table=req["table"], start_date=req["start_date"], end_date=req["end_date"])
+        stream = req["body"].get("stream") or NDJSON_CONTENT_TYPE in self.headers.get("Accept", "")
+        if camstim_mirror is not None:
+            self._serve_camstim_mirror(req, stream)
+            return
+        if stream:
+            self._send_ndjson(
+                _iter_camstim_completed(req),
+                {"count": 0, "scanned": 0, "table": req["table"]},
+                on_error=self._respond_log_server_error,
+            )
+            return
+
+        try:
+            with log_server_pool.connection(req["user"], req["password"]) as conn:
+                with conn.cursor() as cur, metrics.upstream("mysql"):
+                    cur.execute(*_camstim_completed_query(req))
+                    raw_rows = cur.fetchall()
         except Exception as e:
-            self._respond(400, {"error": f"Invalid JSON: {e}"})
+            self._respond_log_server_error(e)
             return
 
-        user = (body.get("user") or "").strip()
-        password = body.get("password") or ""
-        table = (body.get("table") or "last_year").strip()
-        start_date = (body.get("startDate") or "").strip()
-        end_date = (body.get("endDate") or "").strip()
+        out = _camstim_completed_rows(raw_rows)
+        _trace_note(scanned=len(raw_rows), records=len(out))
+        self._respond(200, {"rows": out, "count": len(out), "table": req["table"]})
 
-        if not user or not password:
-            self._respond(400, {"error": "Missing credentials"})
+    def _handle_profile(self):
+        """Sample all thread stacks for ?seconds=N (default 10) and return collapsed stacks."""
+        if self.client_address[0] not in ("127.0.0.1", "::1") or "X-Forwarded-For" in self.headers:
+            self._respond(403, {"error": "Profiling is only available locally"})
             return
-        if table not in LOG_SERVER_ALLOWED_TABLES:
-            self._respond(400, {"error": f"Invalid table: {table}"})
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            seconds = float(params.get("seconds", ["10"])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            self._respond(400, {"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}]"})
             return
-        if not _DATE_RE.match(start_date) or not _DATE_RE.match(end_date):
-            self._respond(400, {"error": "Invalid date range (expected YYYY-MM-DD)"})
+        if not _profile_lock.acquire(blocking=False):
+            self._respond(409, {"error": "A profile is already running"})
             return
+        try:
+            stacks = _sample_stacks(seconds, PROFILE_INTERVAL)
+        finally:
+            _profile_lock.release()
+        body = "".join(f"{stack} {n}\n" for stack, n in stacks.most_common()).encode()
+        self._send_body(200, body, "text/plain; charset=utf-8")
+
+    def _handle_camstim_summary(self):
+        """Per (instrument_id, MID, date) rollups of camstim-completed events.
 
+        Takes the same body as /log-server/camstim-completed and answers
+        {"buckets": [{"instrument_id", "mid", "date", "count",
+        "duration_min", "long_frames", "return_codes": {code: n}}, ...],
+        "count": rows, "table": str}.
+        """
+        req = self._read_log_server_request()
+        if req is None:
+            return
         try:
-            import pymysql
-            import pymysql.cursors
+            import pymysql  # noqa: F401
         except ImportError:
             self._respond(501, {"error": "Log server support unavailable (pymysql not installed)"})
             return
 
+        _trace_note(table=req["table"], start_date=req["start_date"], end_date=req["end_date"])
+        if camstim_mirror is not None:
+            pages, table = _iter_camstim_mirror(req), camstim_mirror.source_table
+        else:
+            pages, table = _iter_camstim_completed(req), req["table"]
         try:
-            conn = pymysql.connect(
-                host=LOG_SERVER_HOST,
-                port=LOG_SERVER_PORT,
-                user=user,
-                password=password,
-                database=LOG_SERVER_DATABASE,
-                connect_timeout=LOG_SERVER_CONNECT_TIMEOUT,
-                read_timeout=LOG_SERVER_READ_TIMEOUT,
-                cursorclass=pymysql.cursors.DictCursor,
+            summary = _summarize_camstim(pages)
+        except Exception as e:
+            self._respond_log_server_error(e)
+            return
+        finally:
+            pages.close()
+        self._respond(200, {**summary, "table": table})
+
+    def _serve_camstim_mirror(self, req: dict, stream: bool):
+        """Answer camstim-completed from the local mirror after an auth ping.
+
+        The mirror only holds CAMSTIM_MIRROR_SOURCE_TABLE, so that is the
+        table reported, whatever view the request named.
+        """
+        headers = {"X-Cache": "MIRROR"}
+        table = camstim_mirror.source_table
+        if stream:
+            self._send_ndjson(
+                _iter_camstim_mirror(req),
+                {"count": 0, "table": table},
+                headers,
+                on_error=self._respond_log_server_error,
             )
-        except pymysql.err.OperationalError as e:
-            code = e.args[0] if e.args else None
-            if code in (1045, 1044, 1698):
-                self._respond(401, {"error": "Authentication failed"})
-                return
-            log.error("Log server connect failed: %s", e)
-            self._respond(502, {"error": f"Log server connect failed: {e}"})
             return
+        try:
+            _log_server_auth_ping(req["user"], req["password"])
+            camstim_mirror.sync(req)
+            rows = camstim_mirror.rows(req["start_date"], req["end_date"])
         except Exception as e:
-            log.error("Log server connect failed: %s", e)
-            self._respond(502, {"error": f"Log server connect failed: {e}"})
-            return
-
-        try:
-            with conn:
-                with conn.cursor() as cur:
-                    sql = (
-                        f"SELECT datetime, client_address, version, message "
-                        f"FROM {table} "
-                        "WHERE logname='camstim' AND level='INFO' "
-                        "AND message LIKE %s "
-                        "AND datetime >= %s AND datetime < %s "
-                        "ORDER BY datetime DESC"
-                    )
-                    cur.execute(sql, ("%Action, Completed%", start_date, end_date))
-                    raw_rows = cur.fetchall()
-        except Exception as e:
-            log.error("Log server query failed: %s", e)
-            self._respond(502, {"error": f"Log server query failed: {e}"})
+            self._respond_log_server_error(e)
             return
 
-        out = []
-        for r in raw_rows:
-            parsed = _parse_camstim_message(r.get("message") or "")
-            if parsed.get("Action") != "Completed":
-                continue
-            mid = (parsed.get("MID") or "").strip()
-            uid = (parsed.get("UID") or "").strip()
-            if not mid or mid.lower() == "none" or not uid or uid.lower() == "none":
-                continue
-            out.append({
-                "datetime": r["datetime"].isoformat() if r.get("datetime") else None,
-                "client_address": r.get("client_address") or "",
-                "instrument_id": _client_address_to_instrument(r.get("client_address") or ""),
-                "version": r.get("version") or "",
-                "fields": parsed,
-                "raw_message": r.get("message") or "",
-            })
+        # Mirrored rows are stored encoded, so splice them in as-is.
+        body = b'{"rows":[%s],"count":%d,"table":%s}' % (
+            ",".join(rows).encode(), len(rows), json.dumps(table).encode()
+        )
+        self._send_body(200, body, headers=headers)
+
+    def _read_log_server_request(self) -> dict | None:
+        """Parse and validate a log-server POST body; respond 400 and return None on error."""
+        try:
+            body = json.loads(self._read_body())
+        except Exception as e:
+            self._respond(400, {"error": f"Invalid JSON: {e}"})
+            return None
+
+        req = {
+            "user": (body.get("user") or "").strip(),
+            "password": body.get("password") or "",
+            "table": (body.get("table") or "last_year").strip(),
+            "start_date": (body.get("startDate") or "").strip(),
+            "end_date": (body.get("endDate") or "").strip(),
+            "body": body,
+        }
+        if not req["user"] or not req["password"]:
+            self._respond(400, {"error": "Missing credentials"})
+            return None
+        if req["table"] not in LOG_SERVER_ALLOWED_TABLES:
+            self._respond(400, {"error": f"Invalid table: {req['table']}"})
+            return None
+        if not _DATE_RE.match(req["start_date"]) or not _DATE_RE.match(req["end_date"]):
+            self._respond(400, {"error": "Invalid date range (expected YYYY-MM-DD)"})
+            return None
+        return req
 
-        self._respond(200, {"rows": out, "count": len(out), "table": table})
+    def _respond_log_server_error(self, error):
+        if not isinstance(error, LogServerConnectError):
+            log.error("Log server query failed: %s", error)
+            self._respond(502, {"error": f"Log server query failed: {error}"})
+            return
+        cause = error.__cause__
+        if _is_log_server_auth_error(cause):
+            self._respond(401, {"error": "Authentication failed"})
+            return
+        log.error("Log server connect failed: %s", cause)
+        self._respond(502, {"error": f"Log server connect failed: {cause}"})
 
     def _handle_search(self, db_client):
         try:
-            length = int(self.headers.get("Content-Length", 0))
-            body = json.loads(self.rfile.read(length) if length else b"{}")
+            body = json.loads(self._read_body())
         except Exception as e:
             self._respond(400, {"error": f"Invalid JSON: {e}"})
             return
@@ -225,108 +2942,830 @@ class DocDbProxyHandler(BaseHTTPRequestHandler):
         filter_query = body.get("filter", {})
         limit = body.get("limit", 1000)
         projection = body.get("projection") or None
+        _trace_note(
+            version=db_client.version,
+            filter=_canonical(filter_query),
+            projection=_canonical(projection),
+            limit=limit,
+        )
+
+        if body.get("stream") or NDJSON_CONTENT_TYPE in self.headers.get("Accept", ""):
+            self._stream_search(db_client, filter_query, projection, limit, body)
+            return
+        fmt = self._requested_format(body)
+        if fmt is None:
+            return
 
         try:
-            kwargs = dict(filter_query=filter_query, limit=limit)
-            if projection:
-                kwargs["projection"] = projection
-            records = db_client.retrieve_docdb_records(**kwargs)
-            self._respond(200, records)
+            body, etag, status = _cached_search(db_client, filter_query, projection, limit)
         except Exception as e:
             log.error("DocDB query failed: %s", e)
-            self._respond(500, {"error": str(e)})
+            self._respond_docdb_error(e)
+            return
+        _trace_note(cache=status, format=fmt)
+        if fmt != "json":
+            self._respond_columnar(body, etag, fmt, status)
+            return
+        headers = {"ETag": etag, "Cache-Control": SEARCH_CACHE_CONTROL, "Vary": SEARCH_VARY}
+        if self._not_modified(headers):
+            return
+        self._send_body(200, body, headers={**headers, "X-Cache": status.upper()})
+
+    def _requested_format(self, body: dict) -> str | None:
+        """Return "json" or a COLUMNAR_FORMATS key from the body or Accept; None after a 400."""
+        fmt = body.get("format") or next(
+            (f for f, ctype in COLUMNAR_FORMATS.items() if ctype in self.headers.get("Accept", "")), "json"
+        )
+        if not isinstance(fmt, str) or (fmt != "json" and fmt not in COLUMNAR_FORMATS):
+            self._respond(400, {"error": f"Invalid format: {fmt}"})
+            return None
+        return fmt
+
+    def _respond_columnar(self, body: bytes, etag: str, fmt: str, cache_status: str):
+        """Re-encode a cached JSON search body as Arrow IPC or Parquet.
+
+        The encoding is a pure function of the JSON body, so its ETag is
+        derived from the JSON one and a revalidation skips re-encoding.
+        """
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            self._respond(501, {"error": "Columnar output unavailable (pyarrow not installed)"})
+            return
+        headers = {
+            "ETag": f'{etag[:-1]}.{fmt}"',
+            "Cache-Control": SEARCH_CACHE_CONTROL,
+            "Vary": SEARCH_VARY,
+        }
+        if self._not_modified(headers):
+            return
+        try:
+            data = _encode_table(_records_to_table(json.loads(body)), fmt)
+        except Exception as e:
+            log.error("Columnar encoding failed: %s", e)
+            self._respond(500, {"error": f"Columnar encoding failed: {e}"})
+            return
+        self._send_body(
+            200, data, COLUMNAR_FORMATS[fmt], headers={**headers, "X-Cache": cache_status.upper()}
+        )
+
+    def _handle_cache_aggregate(self):
+        try:
+            body = json.loads(self._read_body())
+        except Exception as e:
+            self._respond(400, {"error": f"Invalid JSON: {e}"})
+            return
+        try:
+            name, version, params = _resolve_aggregate(body)
+        except ValueError as e:
+            self._respond(400, {"error": str(e)})
+            return
+        fmt = self._requested_format(body)
+        if fmt is None:
+            return
+        try:
+            import duckdb  # noqa: F401
+            import pyarrow  # noqa: F401
+        except ImportError:
+            self._respond(501, {"error": "Aggregates unavailable (duckdb and pyarrow required)"})
+            return
+
+        _trace_note(query=name, version=version, params=_canonical(params), format=fmt)
+        try:
+            data, etag, status = _cached_aggregate(name, version, params, fmt)
+        except Exception as e:
+            log.error("Aggregate %s failed: %s", name, e)
+            self._respond(502, {"error": f"Aggregate query failed: {e}"})
+            return
+        _trace_note(cache=status)
+        self._respond_aggregate(data, etag, COLUMNAR_FORMATS.get(fmt, "application/json"), status)
+
+    def _respond_aggregate(self, body: bytes, etag: str, content_type: str, cache_status: str):
+        headers = {"ETag": etag, "Cache-Control": AGGREGATE_CACHE_CONTROL, "Vary": SEARCH_VARY}
+        if self._not_modified(headers):
+            return
+        self._send_body(200, body, content_type, headers={**headers, "X-Cache": cache_status.upper()})
+
+    def _handle_search_batch(self):
+        try:
+            body = json.loads(self._read_body())
+        except Exception as e:
+            self._respond(400, {"error": f"Invalid JSON: {e}"})
+            return
+
+        queries = body.get("queries") if isinstance(body, dict) else body
+        if not isinstance(queries, list):
+            self._respond(400, {"error": "Expected a list of queries"})
+            return
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            self._respond(400, {"error": f"Too many queries (max {SEARCH_BATCH_MAX_QUERIES})"})
+            return
+
+        _trace_note(queries=len(queries))
+        self._send_body(200, _run_search_batch(queries))
+
+    def _handle_by_name(self):
+        try:
+            body = json.loads(self._read_body())
+        except Exception as e:
+            self._respond(400, {"error": f"Invalid JSON: {e}"})
+            return
+
+        names = body.get("names")
+        if names is None and body.get("name"):
+            names = [body["name"]]
+        if not isinstance(names, list) or not names or not all(isinstance(n, str) for n in names):
+            self._respond(400, {"error": "Expected \"name\" or a non-empty \"names\" list"})
+            return
+        db_client = _docdb_client(body.get("version") or "v2")
+        if db_client is None:
+            self._respond(400, {"error": f"Invalid version: {body.get('version')}"})
+            return
+
+        try:
+            records = name_batcher.lookup(db_client, names, body.get("projection") or None)
+        except Exception as e:
+            log.error("DocDB name lookup failed: %s", e)
+            self._respond_docdb_error(e)
+            return
+        _trace_note(names=len(names), records=sum(1 for r in records.values() if r))
+        self._respond(200, {"records": records})
+
+    def _stream_search(self, db_client, filter_query, projection, limit, body):
+        """Write search results as chunked NDJSON, one record per line.
+
+        Optional body fields: "cursor" (resume after this _id) and
+        "batch_size". The trailing meta line carries the cursor to resume from.
+        """
+        cursor = body.get("cursor")
+        try:
+            batch_size = int(body.get("batch_size") or SEARCH_STREAM_BATCH_SIZE)
+            limit = int(limit or 0)
+        except (TypeError, ValueError):
+            self._respond(400, {"error": "Invalid batch_size or limit"})
+            return
+        batch_size = max(1, min(batch_size, SEARCH_STREAM_MAX_BATCH_SIZE))
+
+        pages = _iter_search_pages(db_client, filter_query, projection, limit, cursor, batch_size)
+        self._send_ndjson(_lift_deadline_after_first(pages), {"count": 0, "cursor": cursor}, {"X-Cache": "BYPASS"})
+
+    def _send_ndjson(self, pages, meta, headers=None, on_error=None):
+        """Stream ``(rows, meta_update)`` pages as chunked NDJSON.
+
+        The first page is pulled before the status line is sent, so an
+        upstream that fails outright still gets a normal error response
+        (*on_error(exc)*, or a plain 500). After that, the body ends with a
+        ``{"_meta": {...}}`` line holding *meta* (plus each page's update),
+        "count", "complete", and "error" if a later page failed, since the
+        status can no longer change. *pages* is closed when the response
+        ends, so generators can release upstream resources.
+        """
+        try:
+            self._write_ndjson(pages, meta, headers, on_error)
+        finally:
+            if hasattr(pages, "close"):
+                pages.close()
+
+    def _write_ndjson(self, pages, meta, headers, on_error):
+        try:
+            first = next(pages, None)
+        except Exception as e:
+            (on_error or self._respond_upstream_error)(e)
+            return
+        if first is not None:
+            pages = itertools.chain([first], pages)
+
+        self.send_response(200)
+        self.send_header("Content-Type", NDJSON_CONTENT_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        meta = {"count": 0, **meta, "complete": False}
+        try:
+            for rows, update in pages:
+                if rows:
+                    self._write_chunk("".join(json.dumps(r) + "\n" for r in rows).encode())
+                meta["count"] += len(rows)
+                meta.update(update)
+            meta["complete"] = True
+        except (BrokenPipeError, ConnectionResetError):
+            _trace_note(records=meta["count"], complete=False)
+            log.info("Stream closed by client after %d rows", meta["count"])
+            self.close_connection = True
+            return
+        except Exception as e:
+            log.error("Upstream stream failed after %d rows: %s", meta["count"], e)
+            meta["error"] = str(e)
+        _trace_note(records=meta["count"], complete=meta["complete"])
+        self._write_chunk(json.dumps({"_meta": meta}).encode() + b"\n")
+        self._write_chunk(b"")
+
+    def _respond_upstream_error(self, error):
+        log.error("Upstream query failed: %s", error)
+        self._respond_docdb_error(error)
+
+    def _respond_docdb_error(self, error):
+        headers = {"Retry-After": str(error.retry_after)} if isinstance(error, UpstreamUnavailable) else None
+        body = json.dumps({"error": str(error)}).encode()
+        self._send_body(_docdb_error_status(error), body, headers=headers)
+
+    def _write_chunk(self, data: bytes):
+        """Write one HTTP/1.1 chunk; an empty *data* terminates the body."""
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self._sent_bytes += len(data)
 
     def _handle_s3_list(self):
         """List image objects under a public S3 prefix.
 
         Query params: ?loc=s3://bucket/prefix   (or ?bucket=..&prefix=..)
-        Responds with {"images": [{"key": str, "url": str, "name": str}, ...]}.
+        Responds with {"images": [{"key": str, "url": str, "name": str,
+        "thumb_url": str | None}, ...]}.
         Only buckets in S3_LIST_ALLOWED_BUCKETS are permitted.
         """
-        query = urllib.parse.urlparse(self.path).query
-        params = urllib.parse.parse_qs(query)
-        loc = (params.get("loc", [""])[0]).strip()
-        bucket = (params.get("bucket", [""])[0]).strip()
-        prefix = (params.get("prefix", [""])[0]).strip()
-
-        if loc:
-            if loc.startswith("s3://"):
-                loc = loc[len("s3://"):]
-            parts = loc.split("/", 1)
-            bucket = parts[0]
-            prefix = parts[1] if len(parts) > 1 else ""
-
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        bucket, prefix = self._s3_location(params, "prefix")
         if bucket not in S3_LIST_ALLOWED_BUCKETS:
             self._respond(400, {"error": f"Bucket not allowed: {bucket}"})
             return
 
         if prefix and not prefix.endswith("/"):
             prefix += "/"
+        _trace_note(bucket=bucket, prefix=prefix)
+
+        headers = {"Cache-Control": S3_LIST_CACHE_CONTROL, "Vary": S3_LIST_VARY}
+        etag = s3_index.etag(bucket, prefix)
+        if etag is not None and self._not_modified({**headers, "ETag": etag}):
+            _trace_note(cache="etag")
+            return
 
         try:
-            images = self._s3_list_images(bucket, prefix)
+            listed = self._s3_list_images(bucket, prefix)
         except Exception as e:
             log.error("S3 list failed (%s/%s): %s", bucket, prefix, e)
             self._respond(502, {"error": f"S3 list failed: {e}"})
             return
 
-        self._respond(200, {"images": images})
+        _trace_note(records=len(listed))
+        images = [{**img, "thumb_url": _thumb_url(bucket, img["key"], img.get("etag"))} for img in listed]
+        start = time.perf_counter()
+        body = json.dumps({"images": images}).encode()
+        metrics.serialize_seconds.observe((self._route,), time.perf_counter() - start)
+        headers["ETag"] = _strong_etag(body)
+        s3_index.set_etag(bucket, prefix, listed, headers["ETag"])
+        if self._not_modified(headers):
+            return
+        self._send_body(200, body, headers=headers)
+
+    def _handle_s3_thumb(self):
+        """Serve a downscaled copy of one listed image.
+
+        Query params: ?loc=s3://bucket/key  (or ?bucket=..&key=..), &w=width,
+        and &v=<source ETag> as put in /s3-list thumb_url values; thumbnails
+        are cached by source version, so an overwritten object is re-derived.
+        Uses the same bucket allow-list as /s3-list. SVGs are redirected to
+        the original since they are already small and scale freely.
+        """
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        bucket, key = self._s3_location(params, "key")
+        if bucket not in S3_LIST_ALLOWED_BUCKETS:
+            self._respond(400, {"error": f"Bucket not allowed: {bucket}"})
+            return
+        if key.lower().endswith(".svg"):
+            self._send_body(302, b"", headers={
+                "Location": S3_ENDPOINT.format(bucket=bucket) + urllib.parse.quote(key),
+            })
+            return
+        if not key.lower().endswith(THUMB_SOURCE_EXTENSIONS):
+            self._respond(400, {"error": f"Not a supported image: {key}"})
+            return
+        width = _thumb_width(params.get("w", [THUMB_DEFAULT_WIDTH])[0])
+        if width is None:
+            self._respond(400, {"error": "Invalid width"})
+            return
+        _trace_note(bucket=bucket, key=key, width=width)
+        self._serve_thumbnail(bucket, key, width, params.get("v", [""])[0])
+
+    def _serve_thumbnail(self, bucket: str, key: str, width: int, version: str):
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            self._respond(501, {"error": "Thumbnails unavailable (Pillow not installed)"})
+            return
+
+        def make():
+            return _make_thumbnail(_s3_fetch_object(bucket, key, THUMB_MAX_SOURCE_BYTES), width)
+
+        try:
+            data, content_type = thumb_cache.get_or_create(
+                thumb_cache.digest(bucket, key, version, width, THUMB_QUALITY), make
+            )
+        except Exception as e:
+            # The public buckets answer 403 rather than 404 for missing keys.
+            if isinstance(e, urllib.error.HTTPError) and e.code in (403, 404):
+                self._respond(404, {"error": f"S3 object not found: {key}"})
+                return
+            log.error("Thumbnail failed (%s/%s): %s", bucket, key, e)
+            self._respond(502, {"error": f"Thumbnail failed: {e}"})
+            return
+        # Analysis outputs are written once, so derivatives can be cached hard.
+        self._send_body(200, data, content_type, headers={"Cache-Control": "public, max-age=604800"})
+
+    @staticmethod
+    def _s3_location(params: dict, path_param: str) -> tuple[str, str]:
+        """Read (bucket, path) from ?loc=s3://bucket/path or ?bucket=&<path_param>=."""
+        loc = (params.get("loc", [""])[0]).strip()
+        bucket = (params.get("bucket", [""])[0]).strip()
+        path = (params.get(path_param, [""])[0]).strip()
+
+        if loc:
+            if loc.startswith("s3://"):
+                loc = loc[len("s3://"):]
+            parts = loc.split("/", 1)
+            bucket = parts[0]
+            path = parts[1] if len(parts) > 1 else ""
+        return bucket, path
 
     @staticmethod
     def _s3_list_images(bucket: str, prefix: str) -> list:
-        """Enumerate image objects under a bucket/prefix via the public S3 REST API."""
-        ns = "{http://s3.amazonaws.com/doc/2006-03-01/}"
-        base = f"https://{bucket}.s3.amazonaws.com/"
-        images: list[dict] = []
-        token = None
-
-        while True:
-            qs = {"list-type": "2", "prefix": prefix, "max-keys": "1000"}
-            if token:
-                qs["continuation-token"] = token
-            url = base + "?" + urllib.parse.urlencode(qs)
-            with urllib.request.urlopen(url, timeout=S3_LIST_TIMEOUT) as resp:
-                root = ET.fromstring(resp.read())
-
-            for contents in root.findall(f"{ns}Contents"):
-                key_el = contents.find(f"{ns}Key")
-                if key_el is None or not key_el.text:
-                    continue
-                key = key_el.text
-                if key.lower().endswith(S3_IMAGE_EXTENSIONS):
-                    images.append({
-                        "key": key,
-                        "url": base + urllib.parse.quote(key),
-                        "name": key.rsplit("/", 1)[-1],
-                    })
+        """Return image objects under a bucket/prefix, sorted by key."""
+        return s3_index.images(bucket, prefix, _s3_list_objects)
 
-            truncated = root.find(f"{ns}IsTruncated")
-            if truncated is not None and truncated.text == "true":
-                next_token = root.find(f"{ns}NextContinuationToken")
-                token = next_token.text if next_token is not None else None
-                if not token:
-                    break
-            else:
-                break
+    def _not_modified(self, headers: dict) -> bool:
+        """Send a bodiless 304 if If-None-Match matches ``headers["ETag"]``.
 
-        images.sort(key=lambda item: item["key"])
-        return images
+        Search is a read-only POST, so it is revalidated like a GET rather
+        than answered with 412.
+        """
+        if not _etag_matches(self.headers.get("If-None-Match"), headers["ETag"]):
+            return False
+        self.send_response(304)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        return True
 
     def _respond(self, status, data):
+        start = time.perf_counter()
         body = json.dumps(data).encode()
+        metrics.serialize_seconds.observe((self._route,), time.perf_counter() - start)
+        self._send_body(status, body)
+
+    def _send_body(self, status, body, content_type="application/json", headers=None):
         self.send_response(status)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status >= 400:
+            # The request body may be unread; don't reuse the connection.
+            self.send_header("Connection", "close")
+            self.close_connection = True
         self.end_headers()
         self.wfile.write(body)
+        self._sent_bytes += len(body)
 
     def log_message(self, fmt, *args):
         log.info(fmt, *args)
 
 
+def _upstream_for(path: str) -> str:
+    """Name the upstream a request path will block on (a key of UPSTREAM_LIMITS)."""
+    if path.startswith("/v1/metadata/"):
+        return "docdb_v1"
+    if path == "/metadata/search/batch":
+        return "docdb_batch"
+    if path.startswith("/metadata/") and path != "/metadata/cache-stats":
+        return "docdb_v2"
+    if path.startswith("/s3-"):
+        return "s3"
+    if path.startswith("/log-server/"):
+        return "mysql"
+    if path == "/cache-aggregate":
+        return "parquet"
+    return "local"
+
+
+def _request_head_info(head: bytes) -> tuple[str, int | None]:
+    """Return ``(path, content_length)``; length is None for chunked bodies."""
+    lines = head.split(b"\r\n")
+    parts = lines[0].split(b" ")
+    path = parts[1].decode("latin-1") if len(parts) == 3 else ""
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"transfer-encoding" and value.strip().lower() != b"identity":
+            return path, None
+    return path, length
+
+
+class _LoopWriter:
+    """File-like ``wfile`` that writes to an asyncio StreamWriter from a worker thread.
+
+    Each write waits for the transport to drain, so a slow client holds back
+    its own handler instead of buffering without bound, and a disconnect
+    surfaces as ConnectionResetError just like on a socket.
+    """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    async def _write(self, data: bytes):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data) -> int:
+        if self._writer.is_closing():
+            raise ConnectionResetError("client disconnected")
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class AsyncProxyServer:
+    """asyncio front end that runs *handler_class* on a bounded thread pool.
+
+    Connections (including keep-alive) are handled on the event loop. Each
+    request waits up to *queue_timeout* seconds for a slot of the upstream it
+    will block on (see _upstream_for and *limits*), and is answered 503 with
+    Retry-After if none frees up. The handler then runs unchanged in a
+    worker thread, so routes, status codes and bodies match the threaded
+    server; the pool has one thread per slot, so thread count is fixed.
+    """
+
+    def __init__(self, host, port, handler_class=None, limits=None,
+                 queue_timeout=None, keepalive_timeout=None):
+        self.host = host
+        self.port = port
+        self.handler_class = handler_class or DocDbProxyHandler
+        self.limits = dict(limits or UPSTREAM_LIMITS)
+        self.queue_timeout = UPSTREAM_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        self.keepalive_timeout = keepalive_timeout or KEEPALIVE_TIMEOUT
+        self._executor = ThreadPoolExecutor(
+            max_workers=sum(self.limits.values()), thread_name_prefix="async-handler"
+        )
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._writers: set = set()
+        self._tasks: set = set()
+        self._active = 0
+        self._server = None
+        self.server_port = None
+
+    async def start(self, reuse_port=False):
+        self._semaphores = {name: asyncio.Semaphore(n) for name, n in self.limits.items()}
+        self._server = await asyncio.start_server(
+            self._serve_connection, self.host, self.port,
+            reuse_address=True, reuse_port=reuse_port or None,
+        )
+        self.server_port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self, grace=0):
+        """Stop accepting, let running requests finish for up to *grace* seconds, then disconnect."""
+        self._server.close()
+        deadline = time.monotonic() + grace
+        while self._active and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for writer in list(self._writers):
+            writer.close()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=1)
+            for task in pending:
+                task.cancel()
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self._writers.add(writer)
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while await self._serve_request(reader, writer, peer[:2]):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            self._writers.discard(writer)
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+    async def _serve_request(self, reader, writer, peer) -> bool:
+        """Handle one request; return True to keep the connection open."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+        except TimeoutError:
+            return False
+        try:
+            path, length = _request_head_info(head)
+        except ValueError:
+            await self._reject(writer, 400, "Malformed request")
+            return False
+        if length is None:
+            await self._reject(writer, 411, "Chunked request bodies are not supported")
+            return False
+        if length > ASYNC_MAX_BODY_BYTES:
+            await self._reject(writer, 413, "Request body too large")
+            return False
+        body = await reader.readexactly(length) if length else b""
+
+        upstream = _upstream_for(path)
+        semaphore = self._semaphores[upstream]
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except TimeoutError:
+            log.warning("Rejected %s: %s queue wait exceeded %ss", path, upstream, self.queue_timeout)
+            await self._reject(writer, 503, f"Upstream busy: {upstream}", {"Retry-After": "1"})
+            return False
+        self._active += 1
+        try:
+            loop = asyncio.get_running_loop()
+            close = await loop.run_in_executor(
+                self._executor, self._run_handler, head + body, _LoopWriter(loop, writer), peer
+            )
+        finally:
+            self._active -= 1
+            semaphore.release()
+        return not close
+
+    def _run_handler(self, raw: bytes, wfile, peer) -> bool:
+        """Run one request through the handler class; return its close_connection."""
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.request = None
+        handler.server = self
+        handler.client_address = peer
+        handler.rfile = io.BytesIO(raw)
+        handler.wfile = wfile
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            return True
+        return handler.close_connection
+
+    @staticmethod
+    async def _reject(writer, status: int, error: str, headers=None):
+        body = json.dumps({"error": error}).encode()
+        lines = [
+            f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+            *(f"{name}: {value}" for name, value in (headers or {}).items()),
+        ]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+
+
+class ProxyHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that can share its port with sibling workers."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler_class, reuse_port=False):
+        self.reuse_port = reuse_port
+        super().__init__(address, handler_class)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def _serve_threaded(host, port, worker, on_ready):
+    server = ProxyHTTPServer((host, port), DocDbProxyHandler, reuse_port=worker)
+    _on_listening(host, port, "threaded", worker)
+    if worker:
+        # Drain on SIGTERM: stop accepting, then server_close() joins the
+        # request threads still running.
+        server.daemon_threads = False
+        server.block_on_close = True
+        signal.signal(
+            signal.SIGTERM,
+            lambda *_: threading.Thread(target=server.shutdown, daemon=True).start(),
+        )
+    if on_ready:
+        on_ready()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+async def _serve_async(host, port, worker, on_ready):
+    server = AsyncProxyServer(host, port)
+    await server.start(reuse_port=worker)
+    _on_listening(host, port, "asyncio", worker)
+    if not worker:
+        await server.serve_forever()
+        return
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    if on_ready:
+        on_ready()
+    await stop.wait()
+    await server.close(grace=WORKER_GRACEFUL_TIMEOUT)
+
+
+def serve(host, port, use_async=False, worker=False, on_ready=None):
+    """Serve until stopped. Workers bind with SO_REUSEPORT and drain on SIGTERM."""
+    if use_async:
+        asyncio.run(_serve_async(host, port, worker, on_ready))
+    else:
+        _serve_threaded(host, port, worker, on_ready)
+
+
+class PreforkSupervisor:
+    """Forks *workers* processes running ``serve(on_ready=...)`` and keeps them running.
+
+    Runs in the foreground, so process managers like supervisord see one
+    long-lived process. Signals:
+      SIGTERM/SIGINT  drain every worker (SIGKILL after *graceful_timeout*) and exit
+      SIGHUP          start a new set of workers, then drain the old set once
+                      the new ones are listening, so the port is never unserved
+    A worker that exits unexpectedly is replaced; one that dies within
+    *restart_delay* seconds of starting is replaced after that delay, so a
+    crash loop doesn't spin.
+
+    Workers are forked from the already-imported module, so a reload
+    replaces processes (dropping their caches) but not code; restart the
+    supervisor to deploy new code.
+    """
+
+    _SIGNALS = (signal.SIGCHLD, signal.SIGHUP, signal.SIGINT, signal.SIGTERM)
+
+    def __init__(self, workers, serve_worker, graceful_timeout=None, restart_delay=None):
+        self.workers = workers
+        self._serve_worker = serve_worker
+        self.graceful_timeout = WORKER_GRACEFUL_TIMEOUT if graceful_timeout is None else graceful_timeout
+        self.restart_delay = WORKER_RESTART_DELAY if restart_delay is None else restart_delay
+        self._pids: dict[int, float] = {}
+        self._retiring: dict[int, float] = {}
+        self._stopping = False
+
+    def run(self) -> int:
+        signal.pthread_sigmask(signal.SIG_BLOCK, self._SIGNALS)
+        log.info("Supervisor %d starting %d workers", os.getpid(), self.workers)
+        for _ in range(self.workers):
+            os.close(self._spawn())
+        while self._pids:
+            info = signal.sigtimedwait(self._SIGNALS, 1.0)
+            if info is not None and info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                self._stop()
+            elif info is not None and info.si_signo == signal.SIGHUP and not self._stopping:
+                self._reload()
+            self._reap()
+            self._kill_overdue()
+        log.info("Supervisor %d exiting", os.getpid())
+        return 0
+
+    def _spawn(self) -> int:
+        """Fork a worker; return a pipe fd that becomes readable once it listens."""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            code = 1
+            try:
+                for signum in self._SIGNALS:
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, self._SIGNALS)
+                self._serve_worker(on_ready=functools.partial(self._signal_ready, ready_w))
+                code = 0
+            except BaseException:
+                log.exception("Worker %d failed", os.getpid())
+            finally:
+                os._exit(code)
+        os.close(ready_w)
+        self._pids[pid] = time.monotonic()
+        return ready_r
+
+    @staticmethod
+    def _signal_ready(fd):
+        # The supervisor only listens on reload; otherwise the read end is closed.
+        with contextlib.suppress(OSError):
+            os.write(fd, b"1")
+        os.close(fd)
+
+    def _reload(self):
+        old = [pid for pid in self._pids if pid not in self._retiring]
+        log.info("Supervisor reloading %d workers", len(old))
+        pending = [self._spawn() for _ in range(self.workers)]
+        deadline = time.monotonic() + WORKER_READY_TIMEOUT
+        while pending and time.monotonic() < deadline:
+            readable, _, _ = select.select(pending, [], [], max(0, deadline - time.monotonic()))
+            for fd in readable:
+                pending.remove(fd)
+                os.close(fd)
+        for fd in pending:
+            os.close(fd)
+        if pending:
+            log.warning("%d new workers not ready after %ss", len(pending), WORKER_READY_TIMEOUT)
+        self._retire(old)
+
+    def _stop(self):
+        if not self._stopping:
+            self._stopping = True
+            log.info("Supervisor stopping %d workers", len(self._pids))
+        self._retire(list(self._pids))
+
+    def _retire(self, pids):
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in pids:
+            if pid not in self._retiring:
+                self._retiring[pid] = deadline
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while self._pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            started = self._pids.pop(pid, None)
+            if self._retiring.pop(pid, None) is not None or self._stopping or started is None:
+                continue
+            log.warning("Worker %d exited (status %d); restarting", pid, status)
+            wait = started + self.restart_delay - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            os.close(self._spawn())
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in self._retiring.items():
+            if now >= deadline:
+                log.warning("Worker %d did not drain in %ss; killing", pid, self.graceful_timeout)
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(pid, signal.SIGKILL)
+                self._retiring[pid] = float("inf")
+
+
+def _cgroup_cpu_quota(root: str = CGROUP_ROOT) -> float | None:
+    """Return the cgroup CPU quota in cores, or None when unlimited or unknown."""
+    candidates = (("cpu.max",), ("cpu/cpu.cfs_quota_us", "cpu/cpu.cfs_period_us"))
+    for names in candidates:
+        try:
+            fields = []
+            for name in names:
+                with open(os.path.join(root, name)) as f:
+                    fields.extend(f.read().split())
+            quota, period = fields[:2]
+            if quota in ("max", "-1"):
+                return None
+            return int(quota) / int(period)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def _worker_count(value: str) -> int:
+    if value == "auto":
+        cores = len(os.sched_getaffinity(0))
+        quota = _cgroup_cpu_quota()
+        if quota is not None:
+            cores = min(cores, max(1, math.ceil(quota)))
+        return min(cores, WORKER_AUTO_MAX)
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError("must be >= 1 or 'auto'")
+    return count
+
+
 if __name__ == "__main__":
-    ThreadingHTTPServer.allow_reuse_address = True
-    ThreadingHTTPServer.daemon_threads = True
-    server = ThreadingHTTPServer((HOST, PORT), DocDbProxyHandler)
-    log.info("Listening on %s:%d", HOST, PORT)
-    server.serve_forever()
+    parser = argparse.ArgumentParser(description="Local HTTP proxy for server-side data services.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true",
+        help="serve from an asyncio loop with per-upstream concurrency limits",
+    )
+    parser.add_argument(
+        "--workers", type=_worker_count, default=1,
+        help="pre-fork N worker processes sharing the port via SO_REUSEPORT "
+        "('auto' = one per usable core); SIGHUP reloads them gracefully",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        raise SystemExit(PreforkSupervisor(
+            args.workers,
+            functools.partial(serve, args.host, args.port, args.use_async, True),
+        ).run())
+    serve(args.host, args.port, args.use_async)
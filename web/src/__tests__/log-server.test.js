@@ -10,6 +10,7 @@ import {
   learnInstrumentMap,
   mergeLogSessions,
   normalizeLogInstrument,
+  splitNdjson,
 } from '../lib/log-server.js';
 
 describe('quarterDateRange', () => {
@@ -188,3 +189,15 @@ describe('mergeLogSessions', () => {
     expect(out.merged.length).toBe(existing.length + 1);
   });
 });
+
+describe('splitNdjson', () => {
+  it('parses complete lines and keeps the partial tail', () => {
+    expect(splitNdjson('{"a":1}\n\n{"b":2}\n{"c"')).toEqual({
+      records: [{ a: 1 }, { b: 2 }],
+      rest: '{"c"',
+    });
+  });
+  it('returns no records until a newline arrives', () => {
+    expect(splitNdjson('{"a":1}')).toEqual({ records: [], rest: '{"a":1}' });
+  });
+});
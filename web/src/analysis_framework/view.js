@@ -645,7 +645,8 @@ export function createAnalysisFrameworkView(_coord) {
           imgWrap.innerHTML = images
             .map(
               (img) => `<figure class="af-fig">
-                <img class="af-fig-img" loading="lazy" src="${escHtml(img.url)}"
+                <img class="af-fig-img" loading="lazy" src="${escHtml(img.thumb_url || img.url)}"
+                     data-full="${escHtml(img.url)}"
                      alt="${escHtml(img.name)}" title="Click to view fullscreen" />
                 <figcaption>${escHtml(img.name)}</figcaption>
               </figure>`
@@ -698,7 +699,8 @@ export function createAnalysisFrameworkView(_coord) {
   }
   els.assetsBody.addEventListener('click', (e) => {
     const img = e.target.closest('.af-fig-img');
-    if (img) openLightbox(img.src, img.alt);
+    // Grid cells show /s3-thumb derivatives; the lightbox loads full resolution.
+    if (img) openLightbox(img.dataset.full || img.src, img.alt);
   });
   els.lightbox.addEventListener('click', closeLightbox); // click anywhere (incl. ✕) closes
   document.addEventListener('keydown', (e) => {
@@ -3,7 +3,8 @@
  *
  * Fetches "Action, Completed" events emitted by the camstim agent on every
  * behavior/stim rig at the end of each session. Credentials are passed
- * through on every request; nothing is cached server-side.
+ * through on every request and never stored server-side (the proxy only
+ * pools open connections in memory).
  */
 
 export const LOG_SERVER_BASE = '/log-server';
@@ -32,13 +33,67 @@ export function quarterDateRange(quarterLabel) {
   return { startDate: fmt(start), endDate: fmt(end) };
 }
 
-export async function fetchCamstimCompleted({ user, password, table, startDate, endDate, signal } = {}) {
+/**
+ * Split buffered NDJSON text into parsed complete lines and the unparsed tail.
+ *
+ * @param {string} buffer
+ * @returns {{ records: object[], rest: string }}
+ */
+export function splitNdjson(buffer) {
+  const parts = buffer.split('\n');
+  const rest = parts.pop();
+  const records = parts.filter((line) => line.trim()).map((line) => JSON.parse(line));
+  return { records, rest };
+}
+
+async function readCamstimStream(res, onRows) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  const rows = [];
+  let meta = {};
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    buffer += done ? decoder.decode() : decoder.decode(value, { stream: true });
+    const { records, rest } = splitNdjson(done ? `${buffer}\n` : buffer);
+    buffer = rest;
+    const batch = [];
+    for (const record of records) {
+      if (record._meta) meta = record._meta;
+      else batch.push(record);
+    }
+    if (batch.length) {
+      rows.push(...batch);
+      onRows(batch, rows.length);
+    }
+    if (done) break;
+  }
+  if (meta.error || !meta.complete) {
+    const err = new Error(meta.error || 'Log server stream ended early');
+    err.rows = rows;
+    throw err;
+  }
+  return { rows, count: rows.length, table: meta.table, scanned: meta.scanned };
+}
+
+/**
+ * Fetch camstim "Action, Completed" rows for a date range.
+ *
+ * When `onRows(batch, totalSoFar)` is given the proxy streams NDJSON and
+ * rows are reported as they arrive; the resolved value has the same
+ * `{ rows, count, table }` shape either way.
+ */
+export async function fetchCamstimCompleted({ user, password, table, startDate, endDate, signal, onRows } = {}) {
+  const stream = typeof onRows === 'function';
   const res = await fetch(`${LOG_SERVER_BASE}/camstim-completed`, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ user, password, table, startDate, endDate }),
+    body: JSON.stringify({ user, password, table, startDate, endDate, stream }),
     signal,
   });
+  if (res.ok && stream && res.body && (res.headers.get('Content-Type') || '').includes('ndjson')) {
+    return readCamstimStream(res, onRows);
+  }
   const data = await res.json().catch(() => ({}));
   if (!res.ok) {
     const err = new Error(data?.error || `HTTP ${res.status}`);
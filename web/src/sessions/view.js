@@ -783,7 +783,7 @@ export function createSessionsView(coord) {
       const qLabel = selectedQuarter ? selectedQuarter.replace('-Q', ' Q') : 'this quarter';
       let statusHtml;
       if (logBusy) {
-        statusHtml = '<span class="sessions-log-status">Loading…</span>';
+        statusHtml = `<span class="sessions-log-status">${escHtml(logStatusText || 'Loading…')}</span>`;
       } else if (logStatusText) {
         statusHtml = `<span class="sessions-log-status">${escHtml(logStatusText)}</span>`;
       } else if (hasLoaded) {
@@ -844,6 +844,10 @@ export function createSessionsView(coord) {
           table,
           startDate: range.startDate,
           endDate: range.endDate,
+          onRows: (_batch, total) => {
+            logStatusText = `Loading… ${total} events`;
+            renderLogControl();
+          },
         });
         const rawLogs = data?.rows ?? [];
         const instrumentMap = learnInstrumentMap(allRows, rawLogs);
@@ -56,6 +56,16 @@ export default defineConfig({
       '/s3-list': {
         target: 'http://localhost:3001',
       },
+      // Forward /s3-thumb → docdb_proxy.py (downscaled, disk-cached copies of
+      // the images /s3-list returns).
+      '/s3-thumb': {
+        target: 'http://localhost:3001',
+      },
+      // Forward /cache-aggregate → docdb_proxy.py (server-side DuckDB
+      // aggregates over the data-asset-cache Parquet).
+      '/cache-aggregate': {
+        target: 'http://localhost:3001',
+      },
       '/qc-presign': {
         target: 'https://qc.allenneuraldynamics.org',
         changeOrigin: true,